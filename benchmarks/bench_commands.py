@@ -0,0 +1,137 @@
+"""Command parsing: the grammar of commands.py vs the split()-based parsers it replaced
+
+usage: python benchmarks/bench_commands.py [--messages 20000] [--seed 0]
+
+Messages are generated as students type them: extra spaces, tabs, trailing
+newlines, /grade@bot, usernames without @, plus broken ones (missing or
+extra tokens, scores out of range). A misparse is a correct command which is
+rejected, a broken one which is accepted, or an exception other than ValueError.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from peer_review_bot import commands
+
+
+def legacy_parse_task_number(message_text):
+    workshop, task = message_text.strip('\n').strip(' ').split('.')
+    return int(workshop), int(task)
+
+
+def legacy_parse_grade_message(message_text):
+    """utils.parse_grade_message before the grammar, for comparison"""
+    _, username, task_str, score = message_text.strip('\n').strip(' ').split(' ')
+    username = username.strip('@')
+    workshop, task = legacy_parse_task_number(task_str)
+    score = int(score)
+    if not (0 <= score <= 10):
+        raise ValueError('Score is not an integer between 0 and 10')
+    return {'tg_username': username, 'workshop': workshop, 'task': task, 'score': score}
+
+
+def legacy_parse_get_task_message(message_text):
+    _, username, task_str = message_text.strip('\n').strip(' ').split(' ')
+    workshop, task = legacy_parse_task_number(task_str)
+    return {'tg_username': username.strip('@'), 'workshop': workshop, 'task': task}
+
+
+def legacy_parse_send_task_message(message_text):
+    _, task_str = message_text.strip('\n').strip(' ').split(' ')
+    workshop, task = legacy_parse_task_number(task_str)
+    return {'workshop': workshop, 'task': task}
+
+
+LEGACY = {'grade': legacy_parse_grade_message,
+          'get_task': legacy_parse_get_task_message,
+          'send_task': legacy_parse_send_task_message}
+
+
+def legacy_parse(text):
+    command = text.strip().split()[0].lstrip('/').split('@')[0]
+    return LEGACY[command](text)
+
+
+def new_parse(text):
+    return commands.parse(text).args
+
+
+def noise(rng):
+    return rng.choice([' ', ' ', ' ', '  ', '\t', ' \n'])
+
+
+def generate(n_messages, seed):
+    """returns: list of (text, expected args or None for a broken message)"""
+    rng = random.Random(seed)
+    messages = []
+    for _ in range(n_messages):
+        command = rng.choice(sorted(LEGACY))
+        name = f'/{command}' + ('@peer_review_bot' if rng.random() < 0.1 else '')
+        username = rng.choice(['alice', 'bob_1', 'Carol99'])
+        workshop, task, score = rng.randint(1, 12), rng.randint(1, 9), rng.randint(0, 10)
+        args = {'grade': {'tg_username': username, 'workshop': workshop, 'task': task, 'score': score},
+                'get_task': {'tg_username': username, 'workshop': workshop, 'task': task},
+                'send_task': {'workshop': workshop, 'task': task}}[command]
+        tokens = [name]
+        if 'tg_username' in args:
+            tokens.append(('@' if rng.random() < 0.8 else '') + username)
+        tokens.append(f'{workshop}.{task}')
+        if 'score' in args:
+            tokens.append(str(score))
+
+        expected = args
+        broken = rng.random()
+        if broken < 0.1:
+            tokens.pop()
+            expected = None
+        elif broken < 0.2:
+            tokens.append('extra')
+            expected = None
+        elif broken < 0.25 and 'score' in args:
+            tokens[-1] = str(rng.choice([11, 42, 100]))
+            expected = None
+
+        text = tokens[0] + ''.join(noise(rng) + token for token in tokens[1:])
+        if rng.random() < 0.2:
+            text += rng.choice(['\n', ' ', '  \n'])
+        messages.append((text, expected))
+    return messages
+
+
+def run(parse, messages):
+    """returns: (seconds per message, misparse rate, crash rate)"""
+    n_misparsed = n_crashed = 0
+    start = time.perf_counter()
+    for text, expected in messages:
+        try:
+            args = parse(text)
+        except ValueError:
+            args = None
+        except Exception:
+            args = None
+            n_crashed += 1
+        if args != expected:
+            n_misparsed += 1
+    elapsed = time.perf_counter() - start
+    return elapsed / len(messages), n_misparsed / len(messages), n_crashed / len(messages)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    messages = generate(args.messages, args.seed)
+    print(f'{args.messages} messages, {sum(e is None for _, e in messages)} of them broken')
+    print(f'{"parser":8} {"us/msg":>8} {"misparse":>9} {"crash":>7}')
+    for name, parse in (('split', legacy_parse), ('grammar', new_parse)):
+        seconds, misparse, crash = run(parse, messages)
+        print(f'{name:8} {seconds * 1e6:8.2f} {misparse:9.2%} {crash:7.2%}')
+
+
+if __name__ == "__main__":
+    main()
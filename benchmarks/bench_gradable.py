@@ -0,0 +1,100 @@
+"""get_gradable / get_graders latency: one batched $in query vs a find_one per row
+
+usage: python benchmarks/bench_gradable.py [--users 1000] [--dbhost mongodb://localhost]
+
+Without --dbhost mongomock is used, it shows the number of queries but not the network cost.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from peer_review_bot.dbutils import TasksDB
+from peer_review_bot.data_structures import User
+
+
+def get_gradable_per_row(user):
+    """get_gradable before batching, for comparison"""
+    user_info = TasksDB.get_user_info(user)
+    res = []
+    for task in TasksDB._db.task.find({'graders': user_info.get('_id')}):
+        tg_username = TasksDB._db.user.find_one({'_id': task['user_id']})['tg_username']
+        res.append({'workshop_number': task['workshop_number'],
+                    'task_number': task['task_number'],
+                    'tg_username': tg_username})
+    return res
+
+
+def get_graders_per_row(user):
+    user_info = TasksDB.get_user_info(user)
+    res = []
+    for task in TasksDB._db.task.find({'user_id': user_info.get('_id'), 'graders.0': {'$exists': 1}}):
+        for grader in task['graders']:
+            tg_username = TasksDB._db.user.find_one({'_id': grader})['tg_username']
+            res.append({'workshop_number': task['workshop_number'],
+                        'task_number': task['task_number'],
+                        'tg_username': tg_username})
+    return res
+
+
+def seed(n_users, n_workshops, n_tasks, n_graders):
+    user_ids = TasksDB._db.user.insert_many(
+        [{'tg_id': i, 'tg_username': f'user{i}', 'username': f'user{i}'} for i in range(n_users)]
+    ).inserted_ids
+    tasks = []
+    for w in range(1, n_workshops + 1):
+        for t in range(1, n_tasks + 1):
+            for user_id in user_ids:
+                graders = random.sample([u for u in user_ids[:50] if u != user_id], n_graders)
+                tasks.append({'user_id': user_id, 'workshop_number': w, 'task_number': t,
+                              'graders': graders, 'scores': []})
+    TasksDB._db.task.insert_many(tasks)
+    TasksDB.ensure_indexes()
+
+
+def measure(func, users, repeat):
+    times = []
+    for _ in range(repeat):
+        for user in users:
+            start = time.perf_counter()
+            func(user)
+            times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000, max(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--workshops', type=int, default=4)
+    parser.add_argument('--tasks', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dbhost', default=None)
+    args = parser.parse_args()
+
+    if args.dbhost:
+        from pymongo import MongoClient
+        client = MongoClient(args.dbhost)
+        client.drop_database('peer_review_benchmark')
+        TasksDB._db = client.peer_review_benchmark
+    else:
+        import mongomock
+        TasksDB._db = mongomock.MongoClient().peer_review_benchmark
+
+    seed(args.users, args.workshops, args.tasks, n_graders=2)
+    # the first users grade the most
+    users = [User(tg_id=i) for i in range(10)]
+
+    for name, before, after in [('get_gradable', get_gradable_per_row, TasksDB.get_gradable),
+                                ('get_graders', get_graders_per_row, TasksDB.get_graders)]:
+        assert sorted(map(repr, before(users[0]))) == sorted(map(repr, after(users[0])))
+        n_rows = len(after(users[0]))
+        for label, func in [('per-row find_one', before), ('batched $in', after)]:
+            median, worst = measure(func, users, args.repeat)
+            print(f'{name:12} {label:17} rows: {n_rows:4} median: {median:8.2f} ms  max: {worst:8.2f} ms')
+
+
+if __name__ == "__main__":
+    main()
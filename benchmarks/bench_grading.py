@@ -0,0 +1,98 @@
+"""Grading storm right after a deadline: many graders call add_score at once
+
+usage: python benchmarks/bench_grading.py [--users 500] [--threads 16] [--dbhost mongodb://localhost]
+
+Compares add_score (one conditional find_one_and_update + scored_tasks push)
+with the previous find_one + three updates. Without --dbhost mongomock is used.
+"""
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from peer_review_bot.dbutils import TasksDB
+from peer_review_bot.data_structures import User
+
+
+def add_score_four_round_trips(grader, graded, workshop_number, task_number, score):
+    """add_score before the conditional update, for comparison"""
+    grader_info = TasksDB.get_user_info(grader)
+    graded_info = TasksDB.get_user_info(graded)
+    task = TasksDB._db.task.find_one({'user_id': graded_info.get('_id'),
+                                      'workshop_number': workshop_number,
+                                      'task_number': task_number})
+    if grader_info.get('_id') not in task['graders']:
+        raise RuntimeError('Error. You should not grade this task')
+    TasksDB._db.task.update_one({'_id': task['_id']}, {'$push': {'scores': score}})
+    TasksDB._db.task.update_one({'_id': task['_id']}, {'$pull': {'graders': grader_info.get('_id')},
+                                                       '$inc': {'n_pending_graders': -1}})
+    TasksDB._db.user.update_one({'_id': grader_info.get('_id')},
+                                {'$push': {'scored_tasks': {'workshop_number': workshop_number,
+                                                            'task_number': task_number,
+                                                            'score': score,
+                                                            'user': graded_info.get('_id')}}})
+
+
+def seed(n_users, n_graders=2):
+    """Every user's task is graded by the next n_graders users"""
+    TasksDB._db.user.drop()
+    TasksDB._db.task.drop()
+    user_ids = TasksDB._db.user.insert_many(
+        [{'tg_id': i, 'tg_username': f'user{i}', 'username': f'user{i}', 'scored_tasks': []}
+         for i in range(n_users)]
+    ).inserted_ids
+    TasksDB._db.task.insert_many([
+        {'user_id': user_id, 'workshop_number': 1, 'task_number': 1, 'scores': [],
+         'graders': [user_ids[(i + k) % n_users] for k in range(1, n_graders + 1)],
+         'n_pending_graders': n_graders, 'n_assigned_graders': n_graders}
+        for i, user_id in enumerate(user_ids)
+    ])
+    TasksDB.ensure_indexes()
+    # each request is sent twice, as impatient students do
+    grades = [(User(tg_id=(i + k) % n_users), User(tg_id=i))
+              for i in range(n_users) for k in range(1, n_graders + 1)]
+    return grades + grades
+
+
+def storm(add_score, grades, n_threads):
+    def grade(pair):
+        grader, graded = pair
+        try:
+            add_score(grader, graded, 1, 1, 10)
+            return True
+        except RuntimeError:
+            return False
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(n_threads) as executor:
+        accepted = sum(executor.map(grade, grades))
+    return time.perf_counter() - start, accepted
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--dbhost', default=None)
+    args = parser.parse_args()
+
+    if args.dbhost:
+        from pymongo import MongoClient
+        TasksDB._db = MongoClient(args.dbhost).peer_review_benchmark
+    else:
+        import mongomock
+        TasksDB._db = mongomock.MongoClient().peer_review_benchmark
+
+    for label, add_score in [('find_one + 3 updates', add_score_four_round_trips),
+                             ('conditional update', TasksDB.add_score)]:
+        grades = seed(args.users)
+        elapsed, accepted = storm(add_score, grades, args.threads)
+        n_scores = sum(len(t['scores']) for t in TasksDB._db.task.find())
+        print(f'{label:22} {len(grades) / elapsed:8.0f} requests/s  '
+              f'accepted: {accepted}  scores stored: {n_scores} (expected {len(grades) // 2})')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""Replay a synthetic deadline-night update stream through the telegram_ui handlers
+
+usage: python benchmarks/load_test.py [--students 300] [--workers 16] [--dbhost mongodb://localhost]
+
+Phases, each one a shuffled stream which keeps the order of a student's updates:
+registration (/start + nickname), submission (/send_task + document),
+/get_gradable and /get_task, then a /grade burst for every assignment.
+Updates go through the webhook worker pool into telegram_ui.process_update,
+Bot API calls are answered by a fake sender. Reports p50/p99 handler latency,
+mongo operations per update and throughput for every command.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import statistics
+from datetime import datetime, timedelta
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('PRB_TOKEN', '1:loadtest')
+# handlers run in the pool threads, as in the webhook runtime
+os.environ['PRB_RUNTIME'] = 'webhook'
+
+import telebot
+from peer_review_bot import config, datautils, telegram_ui, webhook
+from peer_review_bot.dbutils import TasksDB
+
+MONGO_OPERATIONS = {'find', 'find_one', 'find_one_and_update', 'insert_one', 'insert_many', 'update_one',
+                    'update_many', 'replace_one', 'delete_one', 'delete_many', 'aggregate', 'bulk_write',
+                    'count_documents'}
+_local = threading.local()
+
+
+class CountingCollection:
+    """Counts operations of the current thread, mongomock does not emit command events"""
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in MONGO_OPERATIONS:
+            return attr
+
+        def counted(*args, **kwargs):
+            _local.n_ops = getattr(_local, 'n_ops', 0) + 1
+            return attr(*args, **kwargs)
+        return counted
+
+
+class CountingDatabase:
+    def __init__(self, db):
+        self._db = db
+
+    def __getattr__(self, name):
+        return CountingCollection(getattr(self._db, name))
+
+    def __getitem__(self, name):
+        return CountingCollection(self._db[name])
+
+
+class FakeResponse:
+    status_code = 200
+    reason = 'OK'
+
+    def __init__(self, result):
+        self.text = json.dumps({'ok': True, 'result': result})
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def fake_api(method, url, params=None, files=None, timeout=None, proxies=None):
+    params = params or {}
+    return FakeResponse({'message_id': 1, 'date': 0, 'text': params.get('text', ''),
+                         'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'}})
+
+
+class Stream:
+    def __init__(self):
+        self.update_id = 0
+
+    def update(self, student, text=None, document=None):
+        self.update_id += 1
+        message = {'message_id': self.update_id, 'date': int(time.time()),
+                   'chat': {'id': student, 'type': 'private'},
+                   'from': {'id': student, 'is_bot': False, 'first_name': 'Student', 'username': f's{student}'}}
+        if text is not None:
+            message['text'] = text
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split(' ')[0])}]
+        if document is not None:
+            message['document'] = document
+        return {'update_id': self.update_id, 'message': message}
+
+
+def interleave(per_student):
+    """Shuffle updates of different students keeping the order of each student's updates"""
+    queues = [list(updates) for updates in per_student if updates]
+    res = []
+    while queues:
+        queue = random.choice(queues)
+        res.append(queue.pop(0))
+        if not queue:
+            queues.remove(queue)
+    return res
+
+
+def phases(stream, students, workshop=1, task=1):
+    yield 'registration', interleave([[stream.update(s, '/start'), stream.update(s, f'nick{s}')]
+                                      for s in students])
+
+    document = lambda s: {'file_id': f'file{s}', 'file_unique_id': f'u{s}', 'file_name': 'solution.zip',
+                          'file_size': 1000, 'mime_type': 'application/zip'}
+    yield 'submission', interleave([[stream.update(s, f'/send_task {workshop}.{task}'),
+                                     stream.update(s, document=document(s))] for s in students])
+
+    gradable = {s: TasksDB.get_gradable(telegram_ui.User(tg_id=s)) for s in students}
+    yield 'browsing', interleave([
+        [stream.update(s, '/get_gradable'), stream.update(s, '/get_scores')] +
+        [stream.update(s, f'/get_task @{g["tg_username"]} {workshop}.{task}') for g in gradable[s]]
+        for s in students])
+
+    yield 'grading', interleave([
+        [stream.update(s, f'/grade @{g["tg_username"]} {workshop}.{task} {random.randint(0, 10)}')
+         for g in gradable[s]] for s in students])
+
+
+def command_of(update):
+    message = update['message']
+    if 'document' in message:
+        return 'document'
+    text = message['text']
+    return text.split(' ')[0] if text.startswith('/') else 'text'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--students', type=int, default=300)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--dbhost', default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    if args.dbhost:
+        from pymongo import MongoClient
+        client = MongoClient(args.dbhost)
+        client.drop_database('peer_review_loadtest')
+        TasksDB._db = CountingDatabase(client.peer_review_loadtest)
+    else:
+        import mongomock
+        TasksDB._db = CountingDatabase(mongomock.MongoClient().peer_review_loadtest)
+    TasksDB.ensure_indexes()
+
+    tmpdir = tempfile.TemporaryDirectory()
+    datautils.set_store(datautils.DialogStateStore(datautils.SQLiteBackend(os.path.join(tmpdir.name, 's.sqlite'))))
+    telebot.apihelper.CUSTOM_REQUEST_SENDER = fake_api
+    telegram_ui.bot.threaded = False
+    config.deadlines = {1: datetime.now() + timedelta(days=1)}
+
+    latencies = defaultdict(list)
+    n_ops = defaultdict(list)
+    lock = threading.Lock()
+
+    def process(update):
+        _local.n_ops = 0
+        start = time.perf_counter()
+        telegram_ui.process_update(update)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies[command_of(update)].append(elapsed)
+            n_ops[command_of(update)].append(_local.n_ops)
+
+    stream = Stream()
+    pool = webhook.ShardedWorkerPool(process, args.workers, queue_size=10 ** 6)
+    print(f'{args.students} students, {args.workers} workers, {"mongod" if args.dbhost else "mongomock"}')
+    for phase, updates in phases(stream, list(range(1, args.students + 1))):
+        start = time.perf_counter()
+        for update in updates:
+            pool.submit(update)
+        pool.join()
+        elapsed = time.perf_counter() - start
+        print(f'{phase:12} {len(updates):6} updates  {len(updates) / elapsed:8.0f} updates/s')
+    pool.shutdown()
+    telegram_ui.outbox.flush(60)
+
+    print(f'\n{"command":14} {"count":>6} {"p50 ms":>8} {"p99 ms":>8} {"mongo ops":>10}')
+    for command in sorted(latencies):
+        times = sorted(latencies[command])
+        p50 = 1000 * times[len(times) // 2]
+        p99 = 1000 * times[min(len(times) - 1, int(len(times) * 0.99))]
+        print(f'{command:14} {len(times):6} {p50:8.2f} {p99:8.2f} {statistics.mean(n_ops[command]):10.1f}')
+    tmpdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
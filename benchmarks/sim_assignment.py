@@ -0,0 +1,110 @@
+"""Replay a submission timeline and report how long solutions wait for all their scores
+
+usage: python benchmarks/sim_assignment.py [--students 200] [--days 7] [--balance-every 6]
+
+Students submit over --days, most of them on the last day. A grader scores a
+solution after a random delay (mean --grading-hours) from the moment it is
+assigned. Each engine of assignment.py is replayed on the same timeline, with
+and without TasksDB.balance_graders every --balance-every hours.
+Reports hours from submission to config.n_graders scores.
+"""
+import os
+import sys
+import heapq
+import random
+import argparse
+import itertools
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import mongomock
+from peer_review_bot import config, assignment
+from peer_review_bot.dbutils import TasksDB
+from peer_review_bot.data_structures import User, Document
+
+
+def timeline(n_students, days, seed):
+    """Submission hours, a third spread over the period and the rest in the last day"""
+    rng = random.Random(seed)
+    hours = [rng.uniform(0, 24 * days) if rng.random() < 1 / 3 else 24 * days - rng.expovariate(1 / 6)
+             for _ in range(n_students)]
+    return sorted(max(h, 0.) for h in hours)
+
+
+def simulate(engine, submissions, grading_hours, balance_every, seed):
+    rng = random.Random(seed)
+    TasksDB._db = mongomock.MongoClient().peer_review_simulation
+    TasksDB.assignment = assignment.get_engine(engine)
+    TasksDB.ensure_indexes()
+
+    users = [User(tg_id=i, tg_username=f'user{i}', username=f'user{i}') for i in range(len(submissions))]
+    for user in users:
+        TasksDB.register_new_user(user)
+    tg_id_of = {u['_id']: u['tg_id'] for u in TasksDB._db.user.find()}
+
+    order = itertools.count()
+    events = [(hour, next(order), 'submit', i) for i, hour in enumerate(submissions)]
+    if balance_every:
+        end = submissions[-1] + 24 * 14
+        events += [(hour, next(order), 'balance', None)
+                   for hour in range(int(balance_every), int(end), int(balance_every))]
+    heapq.heapify(events)
+
+    submitted_at = {}
+    fully_graded_at = {}
+    scheduled = set()
+
+    def schedule_new_assignments(now):
+        for task in TasksDB._db.task.find({}, {'user_id': 1, 'graders': 1}):
+            for grader in task['graders']:
+                pair = (tg_id_of[grader], tg_id_of[task['user_id']])
+                if pair not in scheduled:
+                    scheduled.add(pair)
+                    heapq.heappush(events, (now + rng.expovariate(1 / grading_hours), next(order), 'grade', pair))
+
+    while events:
+        now, _, kind, data = heapq.heappop(events)
+        if kind == 'submit':
+            submitted_at[data] = now
+            TasksDB.add_task(users[data], 1, 1, Document('file', 'solution.zip', 1, 'application/zip'))
+            TasksDB.add_graders(users[data], 1, 1)
+            schedule_new_assignments(now)
+        elif kind == 'balance':
+            if TasksDB.balance_graders(1, 1):
+                schedule_new_assignments(now)
+        else:
+            grader, graded = data
+            task = TasksDB.add_score(users[grader], users[graded], 1, 1, rng.randint(0, 10))
+            if len(task['scores']) == config.n_graders:
+                fully_graded_at[graded] = now
+
+    return [fully_graded_at[i] - submitted_at[i] for i in fully_graded_at], len(submissions) - len(fully_graded_at)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--students', type=int, default=200)
+    parser.add_argument('--days', type=float, default=7)
+    parser.add_argument('--grading-hours', type=float, default=12)
+    parser.add_argument('--balance-every', type=float, default=6)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    submissions = timeline(args.students, args.days, args.seed)
+    print(f'{args.students} students, {config.n_graders} graders per solution, hours to fully graded:')
+    print(f'{"engine":10} {"balance":>8} {"p50":>7} {"p90":>7} {"max":>7} {"never":>6}')
+    for engine in sorted(assignment.engines):
+        for balance_every in (0, args.balance_every):
+            waits, n_never = simulate(engine, submissions, args.grading_hours, balance_every, args.seed)
+            balance = f'{balance_every:g}h' if balance_every else 'no'
+            print(f'{engine:10} {balance:>8} {percentile(waits, 0.5):7.1f} {percentile(waits, 0.9):7.1f} '
+                  f'{max(waits, default=float("nan")):7.1f} {n_never:6}')
+
+
+if __name__ == "__main__":
+    main()
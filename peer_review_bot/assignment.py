@@ -0,0 +1,90 @@
+"""Assignment engines: in which order solutions get graders
+
+TasksDB.add_graders takes the sort orders from the engine named by
+config.assignment_engine. Both orders are served by the
+(workshop_number, task_number, n_assigned_graders, submitted_at) index,
+so picking the next solution is one index seek.
+
+- pending: solutions with the fewest pending graders first, the original behaviour.
+  Solutions whose graders have already scored look free again and collect more graders.
+- fair: solutions with the fewest assigned graders first, the longest waiting among them.
+  Every solution reaches config.n_graders before any gets more.
+
+GraderQueue is used by TasksDB.balance_graders to give the solutions left
+without graders to the least loaded students.
+"""
+import heapq
+
+
+class AssignmentEngine:
+    name = None
+    # order of solutions a new submitter grades
+    gradable_sort = []
+    # order of earlier submitters who grade the new solution, by their own solution
+    graders_sort = []
+
+
+class PendingFirst(AssignmentEngine):
+    name = 'pending'
+    gradable_sort = [('n_pending_graders', 1)]
+    graders_sort = [('n_assigned_graders', 1)]
+
+
+class Fair(AssignmentEngine):
+    name = 'fair'
+    gradable_sort = [('n_assigned_graders', 1), ('submitted_at', 1)]
+    graders_sort = [('n_assigned_graders', 1), ('submitted_at', 1)]
+
+
+engines = {engine.name: engine for engine in (PendingFirst(), Fair())}
+
+
+def get_engine(name):
+    if name not in engines:
+        raise ValueError(f'Unknown assignment engine {name}, choose from {sorted(engines)}')
+    return engines[name]
+
+
+class GraderQueue:
+    """Min-heap of graders by the number of solutions they have to grade
+
+    take and release are O(log n); outdated heap entries are skipped lazily.
+    - loads: dict(grader: number of pending solutions)
+    """
+    def __init__(self, loads):
+        self.loads = dict(loads)
+        self._heap = [(load, i, grader) for i, (grader, load) in enumerate(self.loads.items())]
+        heapq.heapify(self._heap)
+        self._counter = len(self._heap)
+
+    def __len__(self):
+        return len(self.loads)
+
+    def _push(self, grader):
+        self._counter += 1
+        heapq.heappush(self._heap, (self.loads[grader], self._counter, grader))
+
+    def take(self, exclude=()):
+        """Least loaded grader not in exclude, its load is increased. None if there is none"""
+        skipped = []
+        grader = None
+        while self._heap:
+            load, _, candidate = heapq.heappop(self._heap)
+            if self.loads.get(candidate) != load:
+                continue  # outdated entry
+            if candidate in exclude:
+                skipped.append(candidate)
+                continue
+            grader = candidate
+            break
+        for candidate in skipped:
+            self._push(candidate)
+        if grader is not None:
+            self.loads[grader] += 1
+            self._push(grader)
+        return grader
+
+    def release(self, grader):
+        """Undo take, e.g. when the assignment could not be saved"""
+        self.loads[grader] -= 1
+        self._push(grader)
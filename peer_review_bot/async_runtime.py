@@ -0,0 +1,141 @@
+"""Asyncio runtime: updates are fetched with aiohttp and handled concurrently
+
+Handlers and TasksDB stay synchronous and run in a thread pool, so a slow
+database call blocks only the chat it belongs to. Updates of one chat are
+handled one at a time in the order of arrival. At most max_pending updates
+wait or run at a time, beyond that polling pauses and telegram keeps the updates.
+"""
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+try:
+    from aiohttp_socks import ProxyConnector
+except ImportError:
+    ProxyConnector = None
+
+from peer_review_bot.utils import chat_id_of
+
+logger = logging.getLogger(__name__)
+
+
+class BotAPIError(RuntimeError):
+    pass
+
+
+class BotAPIClient:
+    """Minimal Bot API client, only what is needed to receive updates
+
+    aiohttp supports only http proxies, socks proxies need aiohttp-socks
+    raises: ValueError for a socks proxy without aiohttp-socks
+    """
+    def __init__(self, token, api_url='https://api.telegram.org', proxy=None):
+        self._url = f'{api_url}/bot{token}/'
+        self._proxy = proxy
+        self._socks_proxy = None
+        if proxy and not proxy.startswith(('http://', 'https://')):
+            if ProxyConnector is None:
+                raise ValueError(f'The async runtime supports {proxy.split(":", 1)[0]} proxies only with '
+                                 f'aiohttp-socks installed, install it or use PRB_RUNTIME=polling')
+            self._proxy, self._socks_proxy = None, proxy
+        self._session = None
+
+    async def call(self, method, request_timeout=None, **params):
+        if self._session is None:
+            connector = ProxyConnector.from_url(self._socks_proxy) if self._socks_proxy else None
+            self._session = aiohttp.ClientSession(connector=connector)
+        params = {k: v for k, v in params.items() if v is not None}
+        async with self._session.post(self._url + method, json=params, proxy=self._proxy,
+                                      timeout=aiohttp.ClientTimeout(total=request_timeout)) as resp:
+            data = await resp.json()
+        if not data.get('ok'):
+            raise BotAPIError(f'{method} failed: {data.get("error_code")} {data.get("description")}')
+        return data['result']
+
+    async def get_updates(self, offset=None, timeout=30):
+        return await self.call('getUpdates', request_timeout=timeout + 10, offset=offset, timeout=timeout)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class ChatDispatcher:
+    """Runs process_update in a thread pool, sequentially within a chat
+
+    - process_update: function(update_dict), called in a worker thread
+    - max_workers: number of updates handled at the same time
+    - max_pending: number of submitted updates not handled yet, submit waits beyond it
+    """
+    def __init__(self, process_update, max_workers=16, max_pending=256):
+        self._process_update = process_update
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='update')
+        self._queues = {}
+        self._workers = set()
+        self._slots = asyncio.Semaphore(max_pending)
+
+    async def submit(self, update):
+        """Queue the update of its chat, waits while max_pending updates are not handled"""
+        await self._slots.acquire()
+        chat_id = chat_id_of(update)
+        queue = self._queues.get(chat_id)
+        if queue is not None:
+            queue.append(update)
+            return
+
+        self._queues[chat_id] = deque([update])
+        worker = asyncio.get_running_loop().create_task(self._work(chat_id))
+        self._workers.add(worker)
+        worker.add_done_callback(self._workers.discard)
+
+    async def _work(self, chat_id):
+        loop = asyncio.get_running_loop()
+        queue = self._queues[chat_id]
+        while queue:
+            update = queue.popleft()
+            try:
+                await loop.run_in_executor(self._executor, self._process_update, update)
+            except Exception:
+                logger.exception(f'Update {update.get("update_id")} of chat {chat_id} failed')
+            finally:
+                self._slots.release()
+        # no await between the check and the deletion, so nothing can be appended in between
+        del self._queues[chat_id]
+
+    async def join(self):
+        while self._workers:
+            await asyncio.gather(*list(self._workers))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+async def run(process_update, token, api_url='https://api.telegram.org', proxy=None,
+              max_workers=16, max_pending=256, polling_timeout=30, stop=None):
+    """Long-poll getUpdates and dispatch updates until stop (asyncio.Event) is set
+
+    raises: ValueError if the proxy is not supported
+    """
+    client = BotAPIClient(token, api_url, proxy)
+    dispatcher = ChatDispatcher(process_update, max_workers, max_pending)
+    offset = None
+    try:
+        while stop is None or not stop.is_set():
+            try:
+                updates = await client.get_updates(offset, polling_timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError, BotAPIError) as e:
+                logger.warning(f'getUpdates failed: {e}')
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                offset = update['update_id'] + 1
+                await dispatcher.submit(update)
+        await dispatcher.join()
+    finally:
+        await client.close()
+        dispatcher.shutdown()
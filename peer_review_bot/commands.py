@@ -0,0 +1,235 @@
+"""Grammar of the bot commands and the router of text messages
+
+Every command has a regex of its arguments compiled once at import.
+parse() takes a message text to (command, args) with typed values, tokens
+may be separated by any whitespace, the bot name suffix (/grade@bot) and the
+@ before usernames are optional. A text which does not fit the grammar
+raises ParseError with the command, the reason and the usage message.
+Free text (not a command) is parsed as command None with args {'text': text}.
+A batch command takes one item per line, its args are then
+{'lines': [(line, args or ParseError)]}, so one broken line does not reject
+the others.
+
+Router maps (command, dialog state) to handlers, a route without a state
+serves every state. The state is only looked up for commands which have
+state specific routes.
+"""
+import re
+import io
+import csv
+from collections import namedtuple
+
+from peer_review_bot import config
+
+ANY = '*'  # route for every dialog state
+
+USERNAME = r'@?(?P<tg_username>[A-Za-z0-9_]{1,32})'
+TASK = r'(?P<workshop>\d{1,4})\.(?P<task>\d{1,4})'
+SCORE = r'(?P<score>\d{1,3})'
+MAX_SCORE = 10
+
+_COMMAND = re.compile(r'\s*/([A-Za-z_]+)(?:@\w+)?(?=\s|\Z)')
+_ARGS = re.compile(r'\s*(.*?)\s*\Z', re.S)
+_CONVERTERS = {'workshop': int, 'task': int, 'score': int, 'tg_id': int}
+
+Parsed = namedtuple('Parsed', 'command args')
+
+
+class ParseError(ValueError):
+    """
+    - command: name of the command
+    - reason: what is wrong, for logs and for the user
+    - usage: message explaining the syntax, may be None
+    """
+    def __init__(self, command, reason, usage=None):
+        super().__init__(reason)
+        self.command = command
+        self.reason = reason
+        self.usage = usage
+
+
+class Command:
+    """
+    - pattern: regex of the arguments, None accepts and ignores any arguments
+    - optional: arguments may be omitted, args are then {}
+    - check: function(args) -> args, raises ParseError for values out of range
+    - batch: several lines of arguments are accepted
+    """
+    def __init__(self, name, pattern=None, syntax=None, usage=None, optional=False, check=None, batch=False):
+        self.name = name
+        # matched right after the command name: whitespace, the arguments, trailing whitespace
+        self.pattern = None if pattern is None else re.compile(
+            r'(?:\s+' + pattern.replace(' ', r'\s+') + r')?\s*\Z')
+        self._line_pattern = None if pattern is None else re.compile(
+            r'\s*' + pattern.replace(' ', r'[ \t]+') + r'\s*\Z')
+        self._converters = [] if pattern is None else [
+            (group, _CONVERTERS.get(group, str)) for group in self.pattern.groupindex]
+        self.syntax = syntax
+        self.usage = usage
+        self.optional = optional
+        self.check = check
+        self.batch = batch
+
+    def parse_args(self, text, pos=0):
+        """Arguments in text[pos:], typed
+
+        raises: ParseError
+        """
+        if self.pattern is None:
+            return {}
+        match = self.pattern.match(text, pos)
+        if match is None:
+            args_text = text[pos:].strip()
+            if self.batch and '\n' in args_text:
+                return {'lines': self.parse_lines(args_text.splitlines())}
+            raise ParseError(self.name, f'Expected {self.syntax}, got /{self.name} {args_text}', self.usage)
+        values = match.groups()
+        if values[0] is None:
+            if self.optional:
+                return {}
+            raise ParseError(self.name, f'/{self.name} needs arguments: {self.syntax}', self.usage)
+        return self._typed(values)
+
+    def _typed(self, values):
+        args = {group: convert(value) for (group, convert), value in zip(self._converters, values)}
+        return self.check(args) if self.check else args
+
+    def parse_line(self, line):
+        """Arguments of one line of a batch
+
+        raises: ParseError
+        """
+        match = self._line_pattern.match(line)
+        if match is None:
+            raise ParseError(self.name, f'Expected {self.syntax[len(self.name) + 2:]}, got {line.strip()}',
+                             self.usage)
+        return self._typed(match.groups())
+
+    def parse_lines(self, lines):
+        """returns: list of (line, args or ParseError) for non-empty lines"""
+        res = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                res.append((line.strip(), self.parse_line(line)))
+            except ParseError as e:
+                res.append((line.strip(), e))
+        return res
+
+
+def csv_rows(text):
+    """Rows of a CSV file as lines of arguments; a first row without digits is a header
+
+    returns: list of (number of the row's first line in the file, line)
+    """
+    reader = csv.reader(io.StringIO(text))
+    rows = []
+    line_number = 1
+    for row in reader:
+        if any(row):
+            rows.append((line_number, ' '.join(cell.strip() for cell in row)))
+        line_number = reader.line_num + 1
+    if rows and not any(c.isdigit() for c in rows[0][1]):
+        rows = rows[1:]
+    return rows
+
+
+def csv_lines(text):
+    """Rows of a CSV file as lines of arguments, see csv_rows"""
+    return [line for _, line in csv_rows(text)]
+
+
+def _check_score(args):
+    if not 0 <= args['score'] <= MAX_SCORE:
+        raise ParseError('grade', f'Score is not an integer between 0 and {MAX_SCORE}', config.grade_format_message)
+    return args
+
+
+COMMANDS = {command.name: command for command in (
+    Command('start', r'(?P<course_id>[\w-]{1,64})', '/start [course id]', optional=True),
+    Command('help'),
+    Command('info'),
+    Command('cancel'),
+    Command('get_gradable'),
+    Command('get_graders'),
+    Command('get_scores'),
+    Command('late_days'),
+    Command('send_task', TASK, '/send_task 1.4', config.send_task_help_message),
+    Command('get_task', f'{USERNAME} {TASK}', '/get_task @username 1.4', config.get_task_format_message),
+    Command('grade', f'{USERNAME} {TASK} {SCORE}', '/grade @username 1.4 10', config.grade_format_message,
+            check=_check_score, batch=True),
+    Command('sudo', r'(?P<tg_id>\d+) (?P<command>\w+)', '/sudo <tg_id> <handler>'),
+)}
+
+
+def _split(text):
+    """returns: (command name or None for free text, position where the arguments start)"""
+    match = _COMMAND.match(text or '')
+    if match is None:
+        return None, 0
+    return match.group(1).lower(), match.end()
+
+
+def split(text):
+    """returns: (command name or None for free text, text of the arguments)"""
+    name, pos = _split(text)
+    if name is None:
+        return None, text
+    return name, _ARGS.match(text, pos).group(1)
+
+
+def parse(text):
+    """returns: Parsed(command, args)
+
+    raises: ParseError if the command is unknown or its arguments do not fit the grammar
+    """
+    return _parse(text, *_split(text))
+
+
+def _parse(text, name, pos):
+    if name is None:
+        return Parsed(None, {'text': text})
+    command = COMMANDS.get(name)
+    if command is None:
+        raise ParseError(name, f'Unknown command /{name}')
+    return Parsed(name, command.parse_args(text, pos))
+
+
+class Router:
+    def __init__(self):
+        self._routes = {}  # (command, state) -> handler
+        self._commands = set()
+        self._stateful = set()  # commands with state specific routes
+
+    def route(self, command, state=ANY):
+        """Decorator: handle the command (None for free text) in the dialog state"""
+        def decorator(handler):
+            self._routes[command, state] = handler
+            self._commands.add(command)
+            if state != ANY:
+                self._stateful.add(command)
+            return handler
+        return decorator
+
+    def resolve(self, command, state=ANY):
+        """returns: handler or None"""
+        handler = self._routes.get((command, state))
+        return handler if handler is not None else self._routes.get((command, ANY))
+
+    def dispatch(self, message, get_state=None):
+        """Call the handler of the message text as handler(message, args)
+
+        - get_state: function(message) -> dialog state, called only when the route depends on it
+        returns: result of the handler, None if no route matches
+        raises: ParseError
+        """
+        name, pos = _split(message.text)
+        if name not in self._commands:
+            return None  # e.g. commands of other bots in a group chat
+        command, args = _parse(message.text, name, pos)
+        state = get_state(message) if command in self._stateful and get_state is not None else ANY
+        handler = self.resolve(command, state)
+        if handler is None:
+            return None
+        return handler(message, args)
@@ -3,18 +3,91 @@ from datetime import datetime
 
 # Telegram-related
 use_proxy = True
-token = os.environ['PRB_TOKEN']
+token = os.environ.get('PRB_TOKEN')
 proxy = os.environ.get('PRB_PROXY')
+api_url = os.environ.get('PRB_API_URL', 'https://api.telegram.org')
+
+# Bot API connections, shared by all threads (see transport.py)
+api_pool_size = 16
+api_connect_timeout = 5.
+api_read_timeout = 30.
+api_retries = 3
+
+# polling - pyTelegramBotAPI long polling, async - asyncio runtime (see async_runtime.py),
+# webhook - http server for telegram updates (see webhook.py)
+runtime = os.environ.get('PRB_RUNTIME', 'polling')
+async_workers = 16  # updates handled at the same time in the async runtime
+async_max_pending = 256  # updates waiting in the async runtime, polling pauses beyond it
+polling_timeout = 30
+
+webhook_url = os.environ.get('PRB_WEBHOOK_URL')  # public url of the server, e.g. https://bot.example.com
+webhook_secret = os.environ.get('PRB_WEBHOOK_SECRET')
+webhook_host = '0.0.0.0'
+webhook_port = 8012
+webhook_workers = 16
+webhook_queue_size = 64  # per worker, 503 is returned when the queue is full
+
+# GET /metrics, served by the webhook server in the webhook runtime
+metrics_host = '0.0.0.0'
+metrics_port = 8012
+
+# sampling profiler (see profiling.py), PRB_PROFILE=0.01 profiles 1% of updates
+profile_rate = float(os.environ.get('PRB_PROFILE', 0))
+profile_dir = os.environ.get('PRB_PROFILE_DIR', 'profiles')
+profile_dump_interval = 300  # seconds
+
+# outgoing messages, telegram allows about 1 message per second to a chat and 30 per second overall
+outbox_per_chat_rate = 1.
+outbox_chat_burst = 3
+outbox_global_rate = 25.
+outbox_linger = 0.05  # seconds to wait for the next message to the same chat to merge them
+outbox_workers = 4
+
+# courses served by the bot (see courses.py), without the file the bot serves one course
+courses_file = os.environ.get('PRB_COURSES')
+courses_db = 'peer_review_courses'  # which course every student has joined
+course_members_cache_size = 100000
 
 # Data-related
 shelve_name = 'user_states.shelve'
 dbhost = 'mongo'
+# the client is created on first use, in each process (see dbutils.LazyDatabase)
+mongo_max_pool_size = 100
+mongo_min_pool_size = 0
+mongo_server_selection_timeout_ms = 5000
+# multi-document transactions need mongo running as a replica set
+use_transactions = os.environ.get('PRB_MONGO_TRANSACTIONS') == '1'
+
+# dialog states: shelve, sqlite or mongo
+dialog_state_backend = os.environ.get('PRB_DIALOG_STATE_BACKEND', 'shelve')
+dialog_state_sqlite = 'user_states.sqlite'
+dialog_state_ttl = 24 * 60 * 60  # seconds, abandoned dialogs are forgotten after that
+dialog_state_cache_size = 4096
+
+# submitted files downloaded by admins (see filecache.py)
+file_cache_dir = os.environ.get('PRB_FILE_CACHE', 'file_cache')
+file_cache_max_bytes = 2 * 1024 ** 3
+file_cache_workers = 8  # concurrent downloads
+file_cache_port = 8013
 
 # Logic-related:
 n_graders = 2
+assignment_engine = 'fair'  # order in which solutions get graders, see assignment.py
+stale_grader_days = 3  # solutions not scored in time are given to other students, see jobs.py
+stale_check_interval = 60 * 60  # seconds
+maintenance_interval = 60 * 60  # seconds between removals of expired dialog states and audit catch-ups, see jobs.py
+max_grades_file_bytes = 1024 ** 2  # CSV of scores sent with /grade in the caption
 logto = 132238726
 max_late = 3
 default_late_days = 12
+n_tasks = 7  # tasks of a workshop unless the schedule says otherwise
+# where the schedule of deadlines is read from (see schedule.py): None builds it from deadlines below,
+# 'mongo' reads the schedule collection of the course database, anything else is a JSON file
+schedule = os.environ.get('PRB_SCHEDULE')
+schedule_check_interval = 30  # seconds between checks whether the schedule has changed
+# events younger than this are applied by the next audit catch-up, see events.py;
+# event keys are UTC times of the writer's clock, clocks of the bot machines must agree within the lag (NTP)
+audit_lag_seconds = 5
 
 # Messages etc.
 registration_message = "Please, enter your nickname (the one you use for this class' quizzes)"
@@ -33,15 +106,26 @@ not_scored_yet_message = 'Not scored yet, {n} more student(s) should score it'
 score_not_available_message = 'Score others work first ({n} more)'
 
 list_of_people_to_grade_message = 'Check solutions of the following people: {graded}'
+grading_released_message = ('You have not graded the task {workshop}.{task} of @{tg_username} in {days} days, '
+                            'it was given to another student')
+grading_assigned_message = ('You have a new solution to grade: task {workshop}.{task} of @{tg_username}. '
+                            'Type /get_task @{tg_username} {workshop}.{task}')
 grade_format_message = ('To grade task use the following format: `/grade @username 1.1 10` where 1.1 '
-                        'is workshop\_number.task\_number and 10 is your grade on the scale \[0, 10]')
+                        'is workshop\_number.task\_number and 10 is your grade on the scale \[0, 10]. '
+                        'Several tasks can be graded at once, one per line, or with a CSV file '
+                        'with /grade in the caption')
 get_task_format_message = 'To get the task use the following syntax: `/get_task @username 1.1` where 1.1 is task number'
 deadline_message = 'This task cannot be sent anymore. Deadline was more than {max_late} days ago.'
+batch_graded_message = 'Recorded {n_recorded} of {n} scores'
 
 task_accepted = 'Solution of the task {workshop}.{task} is uploaded'
 success_message = 'Success!'
 
 wrong_format_error = 'Wrong format.'
+workshop_not_started_error = 'This workshop has not started yet'
+no_such_task_error = 'Are you sure this task exists? Contact admins'
+grades_file_error = 'Send scores as a UTF-8 CSV file under 1 MB with rows: username, task, score'
+choose_course_error = 'Join your course with /start <course id>. Courses: {courses}'
 registered_error = ('You have already registered and have a username. '
                     'Type /help for the list of commands')
 order_error = 'You cannot send this task, because you have not sent the prevous one. Tasks should be sent in order'
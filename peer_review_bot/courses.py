@@ -0,0 +1,159 @@
+"""Courses served by one bot process
+
+Every course has its own database on the shared mongo client, its own dialog
+state store and its own values of the course settings of config. Courses are
+read from the JSON file named by PRB_COURSES:
+
+{"ml2019": {"db_name": "peer_review_ml2019", "deadlines": {"1": "2019-03-08"}, "n_graders": 3}, ...}
+
+Without the file there is one course, 'default', which uses peer_review_db and
+config. Students join a course with /start <course_id> (a t.me/<bot>?start=<course_id>
+link); the course of an update is kept in a thread local while it is handled.
+"""
+import json
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from dataclasses import dataclass
+from collections import OrderedDict
+
+from peer_review_bot import config
+
+DEFAULT = 'default'
+# settings of config which a course may override
+SETTINGS = ('deadlines', 'n_graders', 'max_late', 'default_late_days', 'n_tasks', 'schedule')
+
+
+class UnknownCourse(RuntimeError):
+    pass
+
+
+@dataclass
+class Course:
+    course_id: str
+    db_name: str
+    deadlines: dict
+    n_graders: int
+    max_late: int
+    default_late_days: int
+    n_tasks: int
+    schedule: str
+
+    def file_name(self, name):
+        """Name of a per-course file, the default course keeps the old names"""
+        return name if self.course_id == DEFAULT else f'{self.course_id}.{name}'
+
+
+def default_course():
+    return Course(DEFAULT, 'peer_review_db', **{name: getattr(config, name) for name in SETTINGS})
+
+
+def load(path):
+    """returns: OrderedDict(course_id: Course)"""
+    with open(path) as f:
+        spec = json.load(f)
+    res = OrderedDict()
+    for course_id, values in spec.items():
+        settings = {name: values.get(name, getattr(config, name)) for name in SETTINGS}
+        if 'deadlines' in values:
+            settings['deadlines'] = {int(workshop): datetime.fromisoformat(deadline)
+                                     for workshop, deadline in values['deadlines'].items()}
+        res[course_id] = Course(course_id, values.get('db_name', f'peer_review_{course_id}'), **settings)
+    return res
+
+
+_courses = None
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def all_courses():
+    global _courses
+    if _courses is None:
+        if not config.courses_file:
+            # built on every call, so that changes of config are seen
+            return [default_course()]
+        with _lock:
+            if _courses is None:
+                _courses = load(config.courses_file)
+    return list(_courses.values())
+
+
+def set_courses(courses):
+    """Replace the courses, e.g. in tests. None reloads them on the next use"""
+    global _courses
+    with _lock:
+        _courses = None if courses is None else OrderedDict((c.course_id, c) for c in courses)
+    _members.clear()
+
+
+def get(course_id):
+    for course in all_courses():
+        if course.course_id == course_id:
+            return course
+    raise UnknownCourse(f'Unknown course {course_id}')
+
+
+def current():
+    """Course of the update being handled; the only course if there is one
+
+    raises: UnknownCourse if there are several courses and none is selected
+    """
+    course = getattr(_local, 'course', None)
+    if course is not None:
+        return course
+    courses = all_courses()
+    if len(courses) == 1:
+        return courses[0]
+    raise UnknownCourse('No course is selected')
+
+
+@contextmanager
+def use(course_id):
+    """Select the course inside the block, None keeps the block without a course"""
+    previous = getattr(_local, 'course', None)
+    _local.course = None if course_id is None else get(course_id)
+    try:
+        yield _local.course
+    finally:
+        _local.course = previous
+
+
+# tg_id -> course_id, the most recently seen students
+_members = OrderedDict()
+_members_lock = threading.Lock()
+
+
+def _member_collection():
+    from peer_review_bot.dbutils import TasksDB
+    return TasksDB.client()[config.courses_db].member
+
+
+def course_of(tg_id):
+    """returns: id of the course the student has joined, None if unknown"""
+    courses = all_courses()
+    if len(courses) == 1:
+        return courses[0].course_id
+    with _members_lock:
+        if tg_id in _members:
+            _members.move_to_end(tg_id)
+            return _members[tg_id]
+    member = _member_collection().find_one({'_id': tg_id})
+    course_id = member['course_id'] if member else None
+    if course_id is not None:
+        _remember(tg_id, course_id)
+    return course_id
+
+
+def join(tg_id, course_id):
+    get(course_id)
+    _member_collection().update_one({'_id': tg_id}, {'$set': {'course_id': course_id}}, upsert=True)
+    _remember(tg_id, course_id)
+
+
+def _remember(tg_id, course_id):
+    with _members_lock:
+        _members[tg_id] = course_id
+        _members.move_to_end(tg_id)
+        while len(_members) > config.course_members_cache_size:
+            _members.popitem(last=False)
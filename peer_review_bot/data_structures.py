@@ -1,4 +1,5 @@
-from dataclasses import dataclass
+from datetime import datetime
+from dataclasses import dataclass, field
 
 
 @dataclass
@@ -26,7 +27,7 @@ class User:
     first_name: str = None
     last_name: str = None
     late_days: int = None
-    scored_tasks: list = None
+    scored_tasks: list = field(default_factory=list)
 
     @classmethod
     def from_telegram(cls, user):
@@ -52,8 +53,15 @@ class Task:
     workshop_number: int
     task_number: int
     file_info: Document
-    scores: list = tuple()
-    graders: list = tuple()
+    scores: list = field(default_factory=list)
+    graders: list = field(default_factory=list)
+    assignments: list = field(default_factory=list)  # {'grader': user _id, 'assigned_at': datetime} per grader
+    scored_by: list = field(default_factory=list)
+    released_graders: list = field(default_factory=list)  # did not score in time, see release_stale_graders
+    n_pending_graders: int = 0  # len(graders)
+    n_assigned_graders: int = 0  # len(graders) + len(scores)
+    late_days: int = 0
+    submitted_at: datetime = field(default_factory=datetime.now)
 
 
 @dataclass
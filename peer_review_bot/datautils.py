@@ -1,14 +1,217 @@
+import time
+import json
 import shelve
-from peer_review_bot.config import shelve_name
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from dataclasses import asdict
+from collections import OrderedDict
+
+from peer_review_bot import config, courses
 from peer_review_bot.data_structures import DialogState
 
 
+class ShelveBackend:
+    """Dialog states in a shelve file, opened once for the process lifetime"""
+    def __init__(self, path):
+        self._storage = shelve.open(path)
+
+    def get(self, key):
+        value = self._storage.get(key)
+        if isinstance(value, DialogState):
+            # written before states had expiration time
+            return value, None
+        return value
+
+    def set(self, key, state, expires_at):
+        self._storage[key] = (state, expires_at)
+        self._storage.sync()
+
+    def delete(self, key):
+        self._storage.pop(key, None)
+
+    def purge_expired(self, now):
+        expired = [k for k, v in self._storage.items()
+                   if isinstance(v, tuple) and v[1] is not None and v[1] <= now]
+        for key in expired:
+            del self._storage[key]
+        return len(expired)
+
+    def close(self):
+        self._storage.close()
+
+
+class SQLiteBackend:
+    """Dialog states in a SQLite table, WAL mode allows concurrent readers"""
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS dialog_state '
+                           '(key TEXT PRIMARY KEY, state TEXT NOT NULL, expires_at REAL)')
+
+    def get(self, key):
+        row = self._conn.execute('SELECT state, expires_at FROM dialog_state WHERE key = ?',
+                                 (key,)).fetchone()
+        if row is None:
+            return None
+        return DialogState(**json.loads(row[0])), row[1]
+
+    def set(self, key, state, expires_at):
+        self._conn.execute('INSERT OR REPLACE INTO dialog_state VALUES (?, ?, ?)',
+                           (key, json.dumps(asdict(state)), expires_at))
+
+    def delete(self, key):
+        self._conn.execute('DELETE FROM dialog_state WHERE key = ?', (key,))
+
+    def purge_expired(self, now):
+        cur = self._conn.execute('DELETE FROM dialog_state WHERE expires_at <= ?', (now,))
+        return cur.rowcount
+
+    def close(self):
+        self._conn.close()
+
+
+class MongoBackend:
+    """Dialog states in the dialog_state collection.
+
+    Mongo removes expired documents itself with a TTL index on expires_at
+    """
+    def __init__(self, collection):
+        self._collection = collection
+        self._collection.create_index('expires_at', expireAfterSeconds=0)
+
+    def get(self, key):
+        doc = self._collection.find_one({'_id': key})
+        if doc is None:
+            return None
+        expires_at = doc.get('expires_at')
+        if expires_at is not None:
+            # pymongo returns naive datetimes in UTC
+            expires_at = expires_at.replace(tzinfo=timezone.utc).timestamp()
+        return DialogState(**doc['state']), expires_at
+
+    def set(self, key, state, expires_at):
+        if expires_at is not None:
+            expires_at = datetime.fromtimestamp(expires_at, timezone.utc)
+        self._collection.replace_one({'_id': key},
+                                     {'state': asdict(state), 'expires_at': expires_at},
+                                     upsert=True)
+
+    def delete(self, key):
+        self._collection.delete_one({'_id': key})
+
+    def purge_expired(self, now):
+        return 0
+
+    def close(self):
+        pass
+
+
+class DialogStateStore:
+    """Write-through LRU cache in front of a persistent backend.
+
+    - backend: object with get/set/delete/purge_expired/close
+    - ttl: seconds after which a state is forgotten, None to keep forever
+    - cache_size: max number of states kept in memory
+    """
+    def __init__(self, backend, ttl=None, cache_size=1024):
+        self.backend = backend
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user):
+        key = str(user)
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+            else:
+                entry = self.backend.get(key)
+                if entry is None:
+                    return DialogState(None)
+                self._remember(key, entry)
+
+            state, expires_at = entry
+            if expires_at is not None and expires_at <= now:
+                self._cache.pop(key, None)
+                self.backend.delete(key)
+                return DialogState(None)
+            return state
+
+    def set(self, user, state):
+        key = str(user)
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self.backend.set(key, state, expires_at)
+            self._remember(key, (state, expires_at))
+        return True
+
+    def purge_expired(self):
+        """Remove expired states from the backend, returns number of removed states"""
+        now = time.time()
+        with self._lock:
+            for key in [k for k, (_, exp) in self._cache.items() if exp is not None and exp <= now]:
+                del self._cache[key]
+            return self.backend.purge_expired(now)
+
+    def close(self):
+        with self._lock:
+            self._cache.clear()
+            self.backend.close()
+
+    def _remember(self, key, entry):
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+
+def make_backend(kind, path=None):
+    """Backend of the current course"""
+    if kind == 'shelve':
+        return ShelveBackend(path or courses.current().file_name(config.shelve_name))
+    if kind == 'sqlite':
+        return SQLiteBackend(path or courses.current().file_name(config.dialog_state_sqlite))
+    if kind == 'mongo':
+        from peer_review_bot.dbutils import TasksDB
+        return MongoBackend(TasksDB._db.dialog_state)
+    raise ValueError(f'Unknown dialog state backend: {kind}')
+
+
+_stores = {}  # course_id -> DialogStateStore
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Store of the current course, created on the first use"""
+    course_id = courses.current().course_id
+    store = _stores.get(course_id)
+    if store is None:
+        with _store_lock:
+            store = _stores.get(course_id)
+            if store is None:
+                store = _stores[course_id] = DialogStateStore(make_backend(config.dialog_state_backend),
+                                                              ttl=config.dialog_state_ttl,
+                                                              cache_size=config.dialog_state_cache_size)
+    return store
+
+
+def set_store(store):
+    """Replace the store of the current course, e.g. with a temporary one in tests. None forgets all stores"""
+    with _store_lock:
+        if store is None:
+            _stores.clear()
+        else:
+            _stores[courses.current().course_id] = store
+
+
 def set_user_state(user, state):
-    with shelve.open(shelve_name) as storage:
-        storage[str(user)] = state
-    return True
+    return get_store().set(user, state)
 
 
 def get_user_state(user):
-    with shelve.open(shelve_name) as storage:
-        return storage.get(str(user), DialogState(None))
+    return get_store().get(user)
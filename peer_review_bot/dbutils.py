@@ -1,35 +1,208 @@
-from random import sample
+import os
+import threading
+from datetime import datetime
+from contextlib import contextmanager
 from dataclasses import asdict
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, ReplaceOne, ReturnDocument, monitoring
+from pymongo.errors import OperationFailure
 
-from peer_review_bot import config
+from peer_review_bot import config, metrics, assignment, courses, events
 from peer_review_bot.data_structures import Task
 
+_local = threading.local()
+
+
+class RequestScope:
+    """State shared by TasksDB calls made while handling one telegram update
+
+    - users: identity map (field, value) -> user document
+    - n_round_trips: number of commands sent to mongo
+    - mongo_seconds: time spent waiting for these commands
+    - n_cache_hits: number of get_user_info calls resolved without mongo
+    """
+    user_keys = ('tg_id', 'tg_username', 'username')
+
+    def __init__(self):
+        self.users = {}
+        self.n_round_trips = 0
+        self.mongo_seconds = 0.
+        self.n_cache_hits = 0
+
+    def remember_user(self, info):
+        for key in self.user_keys:
+            if info.get(key) is not None:
+                self.users[(key, info[key])] = info
+
+
+def current_scope():
+    return getattr(_local, 'scope', None)
+
+
+class RoundTripCounter(monitoring.CommandListener):
+    """Counts and times mongo commands of the current request scope
+
+    Events of a command are published in the thread which sent it.
+    """
+    def started(self, event):
+        scope = current_scope()
+        if scope is not None:
+            scope.n_round_trips += 1
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+    @staticmethod
+    def _finished(event):
+        seconds = event.duration_micros / 1e6
+        metrics.mongo_command_latency.observe(seconds, event.command_name)
+        scope = current_scope()
+        if scope is not None:
+            scope.mongo_seconds += seconds
+
+
+class LazyDatabase(type):
+    """Creates the mongo client on first use of TasksDB._db
+
+    Importing dbutils does not touch the network, and a client inherited from
+    the parent process is replaced after fork, as pymongo requires.
+    All courses share the client, TasksDB._db is the database of the current course.
+    Assigning TasksDB._db (tests, benchmarks) replaces the database, None restores the default.
+    """
+    _lock = threading.Lock()
+    _client = None
+    _client_pid = None
+    _db_override = None
+
+    @property
+    def _db(cls):
+        if cls._db_override is not None:
+            return cls._db_override
+        return cls.client()[courses.current().db_name]
+
+    @_db.setter
+    def _db(cls, db):
+        cls._db_override = db
+
+    def client(cls):
+        pid = os.getpid()
+        if cls._client is None or cls._client_pid != pid:
+            with cls._lock:
+                if cls._client is None or cls._client_pid != pid:
+                    cls._client = MongoClient(config.dbhost,
+                                              maxPoolSize=config.mongo_max_pool_size,
+                                              minPoolSize=config.mongo_min_pool_size,
+                                              serverSelectionTimeoutMS=config.mongo_server_selection_timeout_ms,
+                                              connect=False,
+                                              event_listeners=[RoundTripCounter()])
+                    cls._client_pid = pid
+        return cls._client
+
+    def set_client(cls, client):
+        """Use another client, e.g. mongomock in tests. None creates the default one on the next use"""
+        with cls._lock:
+            cls._client = client
+            cls._client_pid = os.getpid()
+
+
+class TasksDB(metaclass=LazyDatabase):
+    assignment = assignment.get_engine(config.assignment_engine)
+
+    # collection: [(keys, options), ...]
+    indexes = {
+        'user': [
+            ([('tg_id', 1)], {'unique': True}),
+            ([('tg_username', 1)], {}),
+            ([('username', 1)], {}),
+            ([(f'{events.PENDING}._id', 1)], {'sparse': True}),  # events.sweep
+        ],
+        'task': [
+            ([('user_id', 1), ('workshop_number', 1), ('task_number', 1)], {}),
+            ([('graders', 1)], {}),
+            ([('assignments.assigned_at', 1)], {}),
+            ([('workshop_number', 1), ('task_number', 1), ('n_pending_graders', 1)], {}),
+            ([('workshop_number', 1), ('task_number', 1), ('n_assigned_graders', 1), ('submitted_at', 1)], {}),
+            ([(f'{events.PENDING}._id', 1)], {'sparse': True}),  # events.sweep
+        ],
+        'submission_index': [
+            ([('workshop_number', 1), ('task_number', 1)], {}),
+        ],
+    }
 
-class TasksDB:
-    _client = MongoClient(config.dbhost)
-    _db = _client.peer_review_db
+    @classmethod
+    def ensure_indexes(cls):
+        """Create declared indexes which do not exist yet
+
+        returns: dict(collection: {'created': [names], 'extra': [names], 'failed': {name: error}})
+        """
+        report = {}
+        for collection_name, indexes in cls.indexes.items():
+            collection = cls._db[collection_name]
+            existing = set(collection.index_information()) - {'_id_'}
+            declared = set()
+            created, failed = [], {}
+            for keys, options in indexes:
+                name = options.get('name') or '_'.join(f'{k}_{d}' for k, d in keys)
+                declared.add(name)
+                if name in existing:
+                    continue
+                try:
+                    collection.create_index(keys, **{**options, 'name': name})
+                    created.append(name)
+                except OperationFailure as e:
+                    # e.g. duplicates in the existing data for a unique index
+                    failed[name] = str(e)
+            report[collection_name] = {'created': created,
+                                       'extra': sorted(existing - declared),
+                                       'failed': failed}
+        return report
 
     @classmethod
     def register_new_user(cls, user):
         res = cls._db.user.insert_one(asdict(user))
         return res
 
+    @classmethod
+    @contextmanager
+    def request_scope(cls):
+        """Resolve every user once inside the block, nested blocks share the outer scope"""
+        scope = current_scope()
+        if scope is not None:
+            yield scope
+            return
+
+        _local.scope = scope = RequestScope()
+        try:
+            yield scope
+        finally:
+            _local.scope = None
+
     @classmethod
     def get_user_info(cls, user):
         if user.tg_id is not None:
-            info = cls._db.user.find_one({'tg_id': user.tg_id})
+            key = ('tg_id', user.tg_id)
         elif user.tg_username is not None:
-            info = cls._db.user.find_one({'tg_username': user.tg_username})
+            key = ('tg_username', user.tg_username)
         elif user.username is not None:
-            info = cls._db.user.find_one({'username': user.username})
+            key = ('username', user.username)
         else:
             raise ValueError('User without id or tg_id')
 
+        scope = current_scope()
+        if scope is not None and key in scope.users:
+            scope.n_cache_hits += 1
+            info = scope.users[key]
+        else:
+            info = cls._db.user.find_one({key[0]: key[1]})
+
         if info is None:
             raise RuntimeError(f'No such user in db. User: {user}')
-        
+
         cls.maybe_update_user_info(user, info)
+        if scope is not None:
+            scope.remember_user(info)
 
         return info
 
@@ -42,28 +215,33 @@ class TasksDB:
             {'tg_id': user.tg_id},
             {'$set': {'tg_username': user.tg_username}}
         )
+        info['tg_username'] = user.tg_username
 
     @classmethod
     def use_late_days(cls, user, n_late):
         user = cls.get_user_info(user)
-        late_days = user.get('late_days', config.default_late_days) or config.default_late_days
+        default_late_days = courses.current().default_late_days
+        late_days = user.get('late_days', default_late_days) or default_late_days
         assert late_days is not None
         assert n_late is not None
         if late_days < n_late:
             raise ValueError(f'Not enough late days. {late_days} available')
 
         cls._db.user.update_one({'_id': user.get('_id')},
-                                {'$set': {'late_days': late_days - n_late}})
+                                {'$set': {'late_days': late_days - n_late},
+                                 '$push': events.pending(events.event(events.LATE_DAYS_USED, n_late=n_late))})
+        user['late_days'] = late_days - n_late
         return late_days - n_late
 
     @classmethod
-    def add_task(cls, user, workshop_number, task_number, document, force=False):
+    def add_task(cls, user, workshop_number, task_number, document, force=False, late_days=0):
         """Add task solution document to db
         - user: User object
         - workshop_number: int
         - task_number: int
         - document: Document object
         - force: bool, load even if exists
+        - late_days: int, late days spent on this task
         """
         user_info = cls.get_user_info(user)
         user_id = user_info.get('_id')
@@ -80,95 +258,441 @@ class TasksDB:
         task = Task(user_id=user_id,
                     workshop_number=workshop_number,
                     task_number=task_number,
-                    file_info=document)
+                    file_info=document,
+                    late_days=late_days)
 
-        res = cls._db.task.insert_one(asdict(task))
+        submitted = events.event(events.TASK_SUBMITTED, workshop_number=workshop_number,
+                                 task_number=task_number, late_days=late_days)
+        res = cls._db.task.insert_one({**asdict(task), events.PENDING: [submitted]})
         return res
 
     @classmethod
     def add_graders(cls, user, workshop_number, task_number):
-        # TODO: make more data-safe, without a lot of graders
+        """Make the user a grader of other solutions and find graders for the user's solution.
+
+        Counters n_pending_graders (len(graders)) and n_assigned_graders
+        (len(graders) + len(scores)) are checked in the same atomic update
+        that pushes a grader, so a task never gets more than n_graders graders of the course.
+        Solutions are taken in the order of cls.assignment (see assignment.py).
+
+        returns: list of tg_usernames the user should grade
+        """
         user_info = cls.get_user_info(user)
         user_id = user_info.get('_id')
         if user_id is None:
             raise RuntimeError(f'#add_graders No user {repr(user)}')
 
-        # get upto 3 people who have less than 3 graders
-        to_grade = cls._db.task.find({'user_id': {'$ne': user_id},
-                                      'workshop_number': workshop_number,
-                                      'task_number': task_number,
-                                      '$where': f'this.graders.length < {config.n_graders}'})
-        to_grade = list(to_grade)
-        to_grade = sample(to_grade, min(config.n_graders, len(to_grade)))
+        same_task = {'workshop_number': workshop_number, 'task_number': task_number}
+        n_graders = courses.current().n_graders
 
+        # take upto n_graders solutions of other people who have less than n_graders assigned graders
+        # (scores included), never one the user has already scored or was released from
         gradable = []
-        for task in to_grade:
-            gradable.append(task.get('user_id'))
-            cls._db.task.update_one({'_id': task.get('_id')},
-                                    {'$push': {'graders': user_id}})
-
-        # assign the scoring to 3 people, who have less than 3 graders
-        to_be_graded_by = cls._db.task.find({'user_id': {'$ne': user_id},
-                                             'workshop_number': workshop_number,
-                                             'task_number': task_number,
-                                             '$where': f'this.graders.length + this.scores.length < {config.n_graders}'})
-
-        # sample upto 3 people to grade
-        to_be_graded_by = list(to_be_graded_by)
-        to_be_graded_by = sample(to_be_graded_by, min(config.n_graders, len(to_be_graded_by)))
-
+        for _ in range(n_graders):
+            task = cls._db.task.find_one_and_update(
+                {**same_task,
+                 'n_assigned_graders': {'$lt': n_graders},
+                 'user_id': {'$ne': user_id},
+                 'graders': {'$ne': user_id},
+                 'scored_by': {'$ne': user_id},
+                 'released_graders': {'$ne': user_id}},
+                {'$push': {'graders': user_id,
+                           'assignments': {'grader': user_id, 'assigned_at': datetime.now()},
+                           **events.pending(events.event(events.GRADERS_ASSIGNED, graders=[user_id],
+                                                         workshop_number=workshop_number,
+                                                         task_number=task_number))},
+                 '$inc': {'n_pending_graders': 1, 'n_assigned_graders': 1}},
+                projection={'user_id': 1},
+                sort=cls.assignment.gradable_sort,
+            )
+            if task is None:
+                break
+            gradable.append(task['user_id'])
+
+        # assign the scoring to people, whose solutions have less than n_graders graders
+        to_be_graded_by = cls._db.task.find(
+            {**same_task,
+             'n_assigned_graders': {'$lt': n_graders},
+             'user_id': {'$ne': user_id}},
+            projection={'user_id': 1},
+            sort=cls.assignment.graders_sort,
+            limit=n_graders,
+        )
         graders = [task['user_id'] for task in to_be_graded_by]
-        cls._db.task.update_one({'user_id': user_id, 'workshop_number': workshop_number, 'task_number': task_number},
-                                {'$push': {'graders': {'$each': graders}}})
+        cls._push_graders({'user_id': user_id, **same_task}, graders)
 
         # return list of peple the user need to score
         gradable_info = cls._db.user.find({'_id': {'$in': gradable}})
         gradable_tg_names = [u['tg_username'] for u in gradable_info]
         return gradable_tg_names
 
+    @classmethod
+    def balance_graders(cls, workshop_number, task_number):
+        """Give solutions with less than n_graders assigned graders to the least loaded submitters
+
+        Submitters who came early had nobody to grade, and the last ones nobody to grade them.
+        Solutions are served in the order of cls.assignment.graders_sort,
+        nobody gets a solution they have already scored or were released from.
+        returns: list of (grader _id, _id of the solution's author)
+        """
+        same_task = {'workshop_number': workshop_number, 'task_number': task_number}
+        submitters = cls._db.task.distinct('user_id', same_task)
+        loads = dict.fromkeys(submitters, 0)
+        for row in cls._db.task.aggregate([{'$match': same_task},
+                                           {'$unwind': '$graders'},
+                                           {'$group': {'_id': '$graders', 'n': {'$sum': 1}}}]):
+            if row['_id'] in loads:
+                loads[row['_id']] = row['n']
+        queue = assignment.GraderQueue(loads)
+
+        assigned = []
+        n_graders = courses.current().n_graders
+        tasks = cls._db.task.find({**same_task, 'n_assigned_graders': {'$lt': n_graders}},
+                                  {'user_id': 1, 'graders': 1, 'scored_by': 1, 'released_graders': 1,
+                                   'n_assigned_graders': 1},
+                                  sort=cls.assignment.graders_sort)
+        for task in tasks:
+            exclude = {task['user_id'], *task['graders'], *task.get('scored_by', []),
+                       *task.get('released_graders', [])}
+            graders = []
+            for _ in range(n_graders - task['n_assigned_graders']):
+                grader = queue.take(exclude)
+                if grader is None:
+                    break
+                graders.append(grader)
+                exclude.add(grader)
+
+            pushed = cls._push_graders({'_id': task['_id']}, graders)
+            for grader in graders:
+                if grader not in pushed:
+                    queue.release(grader)
+            assigned += [(grader, task['user_id']) for grader in pushed]
+        return assigned
+
+    @classmethod
+    def release_stale_graders(cls, timeout, batch_size=1000):
+        """Remove graders who have not scored a solution within timeout (timedelta) of the assignment
+
+        Only tasks with a stale assignment are read, through the assignments.assigned_at index.
+        The update of a task applies only while all its stale graders are still there,
+        a grader who scores in the meantime keeps the score.
+        returns: list of (grader _id, _id of the solution's author, workshop_number, task_number)
+        """
+        cutoff = datetime.now() - timeout
+        tasks = cls._db.task.find({'assignments.assigned_at': {'$lt': cutoff}},
+                                  {'user_id': 1, 'workshop_number': 1, 'task_number': 1, 'assignments': 1},
+                                  batch_size=batch_size)
+        released = []
+        batch = []
+        candidates = []
+
+        def flush():
+            res = cls._db.task.bulk_write(batch, ordered=False)
+            if res.modified_count == len(batch):
+                released.extend(candidates)
+            else:
+                # some tasks have changed since they were read, keep what is still released
+                for grader, user_id, workshop_number, task_number in candidates:
+                    task = cls._db.task.find_one({'user_id': user_id, 'workshop_number': workshop_number,
+                                                  'task_number': task_number, 'released_graders': grader},
+                                                 {'_id': 1})
+                    if task is not None:
+                        released.append((grader, user_id, workshop_number, task_number))
+            batch.clear()
+            candidates.clear()
+
+        for task in tasks:
+            stale = [a['grader'] for a in task['assignments'] if a['assigned_at'] < cutoff]
+            if not stale:
+                continue
+            batch.append(UpdateOne(
+                {'_id': task['_id'], 'graders': {'$all': stale}},
+                {'$pull': {'graders': {'$in': stale}, 'assignments': {'grader': {'$in': stale}}},
+                 '$addToSet': {'released_graders': {'$each': stale}},
+                 '$push': events.pending(events.event(events.GRADERS_RELEASED, graders=stale,
+                                                      workshop_number=task['workshop_number'],
+                                                      task_number=task['task_number'])),
+                 '$inc': {'n_pending_graders': -len(stale), 'n_assigned_graders': -len(stale)}}))
+            candidates += [(grader, task['user_id'], task['workshop_number'], task['task_number'])
+                           for grader in stale]
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+        return released
+
+    @classmethod
+    def reassign_stale_graders(cls, timeout, batch_size=1000):
+        """Release graders who did not score within timeout and balance the affected tasks
+
+        returns: (released, assigned), lists of
+                 (grader _id, _id of the solution's author, workshop_number, task_number)
+        """
+        released = cls.release_stale_graders(timeout, batch_size)
+        assigned = []
+        for workshop_number, task_number in sorted({(w, t) for _, _, w, t in released}):
+            assigned += [(grader, user_id, workshop_number, task_number)
+                         for grader, user_id in cls.balance_graders(workshop_number, task_number)]
+        return released, assigned
+
+    @classmethod
+    def _push_graders(cls, task_filter, graders, max_retries=5):
+        """Add graders to the task without exceeding n_graders of the course.
+
+        Uses n_assigned_graders as a version: the update is applied only if
+        nobody has changed the task since it was read.
+        """
+        for _ in range(max_retries):
+            task = cls._db.task.find_one(task_filter, {'workshop_number': 1, 'task_number': 1,
+                                                       'graders': 1, 'n_assigned_graders': 1})
+            if task is None:
+                return []
+
+            n_free = courses.current().n_graders - task['n_assigned_graders']
+            new_graders = [g for g in graders if g not in task['graders']][:max(n_free, 0)]
+            if not new_graders:
+                return []
+
+            now = datetime.now()
+            res = cls._db.task.update_one(
+                {'_id': task['_id'], 'n_assigned_graders': task['n_assigned_graders']},
+                {'$push': {'graders': {'$each': new_graders},
+                           'assignments': {'$each': [{'grader': g, 'assigned_at': now} for g in new_graders]},
+                           **events.pending(events.event(events.GRADERS_ASSIGNED, graders=new_graders,
+                                                         workshop_number=task['workshop_number'],
+                                                         task_number=task['task_number']))},
+                 '$inc': {'n_pending_graders': len(new_graders), 'n_assigned_graders': len(new_graders)}}
+            )
+            if res.modified_count:
+                return new_graders
+        return []
+
+    @classmethod
+    def migrate_user_fields(cls):
+        """Users registered before scored_tasks defaulted to a list have null there, $push fails on null
+
+        returns: number of updated users
+        """
+        res = cls._db.user.update_many({'scored_tasks': None}, {'$set': {'scored_tasks': []}})
+        return res.modified_count
+
+    @classmethod
+    def migrate_grader_counters(cls, batch_size=1000):
+        """Set n_pending_graders, n_assigned_graders and assignments for tasks created before these fields existed
+
+        Tasks without submitted_at get the creation time of their _id,
+        graders of old tasks count as assigned at submission.
+        returns: number of updated tasks
+        """
+        cls.ensure_indexes()
+        tasks = cls._db.task.find({'$or': [{'n_assigned_graders': {'$exists': False}},
+                                           {'submitted_at': {'$exists': False}},
+                                           {'assignments': {'$exists': False}}]},
+                                  {'graders': 1, 'scores': 1, 'submitted_at': 1})
+        n_updated = 0
+        batch = []
+        for task in tasks:
+            graders = task.get('graders') or []
+            n_pending = len(graders)
+            n_assigned = n_pending + len(task.get('scores') or [])
+            submitted_at = task.get('submitted_at') or task['_id'].generation_time.astimezone().replace(tzinfo=None)
+            batch.append(UpdateOne({'_id': task['_id']},
+                                   {'$set': {'n_pending_graders': n_pending, 'n_assigned_graders': n_assigned,
+                                             'submitted_at': submitted_at,
+                                             'assignments': [{'grader': g, 'assigned_at': submitted_at}
+                                                             for g in graders]}}))
+            if len(batch) >= batch_size:
+                n_updated += cls._db.task.bulk_write(batch, ordered=False).modified_count
+                batch = []
+        if batch:
+            n_updated += cls._db.task.bulk_write(batch, ordered=False).modified_count
+        return n_updated
+
     @classmethod
     def add_score(cls, grader, graded, workshop_number, task_number, score):
-        # TODO: refactor, guarantee some field
+        """Record the score and remove the grader from the task in one conditional update
+
+        The task is matched only while the grader is in task.graders, so
+        a grader can not score the same task twice even with concurrent requests.
+        returns: task document after the update
+        """
         grader_info = cls.get_user_info(grader)
         graded_info = cls.get_user_info(graded)
-        if graded is None:
-            raise ValueError('Wrong telegram username. User not found.')
+        grader_id = grader_info.get('_id')
+
+        def write(session):
+            task = cls._db.task.find_one_and_update(
+                {'user_id': graded_info.get('_id'),
+                 'workshop_number': workshop_number,
+                 'task_number': task_number,
+                 'graders': grader_id},
+                {'$push': {'scores': score,
+                           **events.pending(events.event(events.SCORE_ADDED, grader=grader_id, score=score,
+                                                         workshop_number=workshop_number, task_number=task_number))},
+                 '$pull': {'graders': grader_id, 'assignments': {'grader': grader_id}},
+                 '$addToSet': {'scored_by': grader_id},
+                 '$inc': {'n_pending_graders': -1}},
+                return_document=ReturnDocument.AFTER,
+                session=session,
+            )
+            if task is None:
+                raise RuntimeError('Error. You should not grade this task')
+
+            cls._db.score_summary.update_one({'_id': graded_info.get('_id')},
+                                             cls._summary_update(workshop_number, task_number, score),
+                                             upsert=True, session=session)
+            cls._db.user.update_one({'_id': grader_id},
+                                    {'$push': {
+                                        'scored_tasks': {
+                                            'workshop_number': workshop_number,
+                                            'task_number': task_number,
+                                            'score': score,
+                                            'user': graded_info.get('_id')}}},
+                                    session=session)
+            return task
+
+        return cls._run_in_transaction(write)
 
-        task = cls._db.task.find_one({'user_id': graded_info.get('_id'),
-                                      'workshop_number': workshop_number,
-                                      'task_number': task_number})
+    @classmethod
+    def add_scores(cls, grader, lines):
+        """Record many scores of one grader, see _add_scores
 
-        if grader_info.get('_id') not in task['graders']:
-            raise RuntimeError('Error. You should not grade this task')
+        - lines: list of dict(tg_username, workshop, task, score)
+        returns: list of error messages, None for a recorded score, in the order of lines
+        """
+        grader_id = cls.get_user_info(grader).get('_id')
+        return cls._add_scores([dict(line, grader_id=grader_id) for line in lines])
 
-        res = cls._db.task.update_one({'_id': task.get('_id')},
-                                      {'$push': {'scores': score}})
-        cls._db.task.update_one({'_id': task.get('_id')},
-                                {'$pull': {'graders': grader_info.get('_id')}})
-        cls._db.user.update_one({'_id': grader_info.get('_id')},
-                                {'$push': {
-                                    'scored_tasks': {
-                                        'workshop_number': workshop_number,
-                                        'task_number': task_number,
-                                        'score': score,
-                                        'user': graded_info.get('_id')}}})
-        return res
+    @classmethod
+    def import_scores(cls, rows):
+        """Record scores collected by TAs, see _add_scores
+
+        - rows: list of dict(grader, tg_username, workshop, task, score), grader is a tg_username
+        returns: list of error messages, None for a recorded score, in the order of rows
+        """
+        return cls._add_scores(rows)
+
+    @classmethod
+    def _add_scores(cls, lines):
+        """Validate the lines with one query for the users and one for the tasks, write with bulk_write
+
+        The task updates have the same conditions as in add_score, so a grader
+        can not score a task twice. Lines whose update does not match (the grader
+        was released meanwhile) are reported as errors and do not reach score_summary.
+        - lines: list of dict(tg_username, workshop, task, score) with grader_id or grader (tg_username)
+        """
+        errors = [None] * len(lines)
+        names = {line['tg_username'] for line in lines} | {line['grader'] for line in lines if 'grader' in line}
+        user_ids = {u['tg_username']: u['_id']
+                    for u in cls._db.user.find({'tg_username': {'$in': list(names)}}, {'tg_username': 1})}
+
+        resolved = []
+        for i, line in enumerate(lines):
+            grader_id = line['grader_id'] if 'grader_id' in line else user_ids.get(line['grader'])
+            graded_id = user_ids.get(line['tg_username'])
+            if grader_id is None:
+                errors[i] = f'No user @{line["grader"]}'
+            elif graded_id is None:
+                errors[i] = f'No user @{line["tg_username"]}'
+            else:
+                resolved.append((i, grader_id, graded_id))
+
+        tasks = {(t['user_id'], t['workshop_number'], t['task_number']): t for t in cls._db.task.find(
+            {'graders': {'$in': list({grader_id for _, grader_id, _ in resolved})},
+             'user_id': {'$in': list({graded_id for _, _, graded_id in resolved})}},
+            {'user_id': 1, 'workshop_number': 1, 'task_number': 1, 'graders': 1})}
+
+        scored = []  # (line index, grader_id, task)
+        seen = set()
+        for i, grader_id, graded_id in resolved:
+            task = tasks.get((graded_id, lines[i]['workshop'], lines[i]['task']))
+            if task is None or grader_id not in task['graders']:
+                errors[i] = 'Error. You should not grade this task'
+            elif (grader_id, task['_id']) in seen:
+                errors[i] = 'The same task is scored twice'
+            else:
+                seen.add((grader_id, task['_id']))
+                scored.append((i, grader_id, task))
+        if not scored:
+            return errors
+
+        def write(session):
+            result = cls._db.task.bulk_write([UpdateOne(
+                {'_id': task['_id'], 'graders': grader_id},
+                {'$push': {'scores': lines[i]['score'],
+                           **events.pending(events.event(events.SCORE_ADDED, grader=grader_id, score=lines[i]['score'],
+                                                         workshop_number=task['workshop_number'],
+                                                         task_number=task['task_number']))},
+                 '$pull': {'graders': grader_id, 'assignments': {'grader': grader_id}},
+                 '$addToSet': {'scored_by': grader_id},
+                 '$inc': {'n_pending_graders': -1}}) for i, grader_id, task in scored], ordered=False, session=session)
+            recorded = scored
+            if result.matched_count < len(scored):
+                # rare: the grader has been released, find out which updates matched
+                scored_by = {t['_id']: t.get('scored_by', []) for t in cls._db.task.find(
+                    {'_id': {'$in': [task['_id'] for _, _, task in scored]}}, {'scored_by': 1}, session=session)}
+                recorded = [(i, grader_id, task) for i, grader_id, task in scored
+                            if grader_id in scored_by.get(task['_id'], [])]
+                for i, grader_id, task in scored:
+                    if grader_id not in scored_by.get(task['_id'], []):
+                        errors[i] = 'Error. You should not grade this task'
+
+            summaries = {}
+            scored_tasks = {}
+            for i, grader_id, task in recorded:
+                workshop_number, task_number, score = task['workshop_number'], task['task_number'], lines[i]['score']
+                update = cls._summary_update(workshop_number, task_number, score)
+                summary = summaries.setdefault(task['user_id'], {'$inc': {}, '$set': {}})
+                for key, value in update['$inc'].items():
+                    summary['$inc'][key] = summary['$inc'].get(key, 0) + value
+                summary['$set'].update(update['$set'])
+                scored_tasks.setdefault(grader_id, []).append({
+                    'workshop_number': workshop_number,
+                    'task_number': task_number,
+                    'score': score,
+                    'user': task['user_id']})
+            if summaries:
+                cls._db.score_summary.bulk_write([UpdateOne({'_id': user_id}, update, upsert=True)
+                                                  for user_id, update in summaries.items()],
+                                                 ordered=False, session=session)
+                cls._db.user.bulk_write([UpdateOne({'_id': grader_id}, {'$push': {'scored_tasks': {'$each': items}}})
+                                         for grader_id, items in scored_tasks.items()],
+                                        ordered=False, session=session)
+
+        cls._run_in_transaction(write)
+        return errors
+
+    @classmethod
+    def _run_in_transaction(cls, write):
+        """Call write(session) in a multi-document transaction if config.use_transactions
+
+        Transactions need a replica set. Without them write(None) is called and
+        the writes are ordered so that an interruption never allows double grading.
+        """
+        if not config.use_transactions:
+            return write(None)
+        with cls._db.client.start_session() as session:
+            return session.with_transaction(write)
 
     @classmethod
     def get_scores(cls, user):
+        """Scores of the user's tasks from the score_summary document, one keyed lookup
+
+        returns: list(dict)
+
+        [{'workshop_number': int, 'task_number': int, 'score': float or str},]
+        """
         user_info = cls.get_user_info(user)
-        tasks = cls._db.task.find({'user_id': user_info.get('_id')})
+        summary = cls._db.score_summary.find_one({'_id': user_info.get('_id')}, {'tasks': 1})
+        if summary is None:
+            return []
 
         res = []
-        for task in tasks:
-            scores = task['scores']
-            if not scores:
-                continue
-
-            n_scores = len(scores)
-            score = round(sum(scores) / n_scores, 1)
+        for task in summary.get('tasks', {}).values():
+            n_scores = task['n']
+            score = round(task['sum'] / n_scores, 1)
             if n_scores < 2:
-                score = config.not_scored_yet_message.format(n=config.n_graders - n_scores)
+                score = config.not_scored_yet_message.format(n=courses.current().n_graders - n_scores)
 
             res.append({
                 'workshop_number': task['workshop_number'],
@@ -177,6 +701,86 @@ class TasksDB:
             })
         return res
 
+    @staticmethod
+    def _summary_update(workshop_number, task_number, score):
+        """Update of score_summary for one more score of the task"""
+        key = f'{workshop_number}_{task_number}'
+        return {'$inc': {f'tasks.{key}.sum': score,
+                         f'tasks.{key}.n': 1,
+                         f'workshops.{workshop_number}.sum': score,
+                         f'workshops.{workshop_number}.n': 1},
+                '$set': {f'tasks.{key}.workshop_number': workshop_number,
+                         f'tasks.{key}.task_number': task_number}}
+
+    @classmethod
+    def _summaries_from_tasks(cls):
+        """Recompute score summaries from the task collection, streaming users one by one
+
+        yields: score_summary documents
+        """
+        tasks = cls._db.task.find({'scores.0': {'$exists': 1}},
+                                  {'user_id': 1, 'workshop_number': 1, 'task_number': 1, 'scores': 1},
+                                  sort=[('user_id', 1)])
+        summary = None
+        for task in tasks:
+            if summary is None or summary['_id'] != task['user_id']:
+                if summary is not None:
+                    yield summary
+                summary = {'_id': task['user_id'], 'tasks': {}, 'workshops': {}}
+
+            w, t, scores = task['workshop_number'], task['task_number'], task['scores']
+            task_summary = summary['tasks'].setdefault(
+                f'{w}_{t}', {'workshop_number': w, 'task_number': t, 'sum': 0, 'n': 0})
+            workshop_summary = summary['workshops'].setdefault(str(w), {'sum': 0, 'n': 0})
+            for summary_ in (task_summary, workshop_summary):
+                summary_['sum'] += sum(scores)
+                summary_['n'] += len(scores)
+        if summary is not None:
+            yield summary
+
+    @classmethod
+    def rebuild_score_summaries(cls, batch_size=1000):
+        """Replace all score summaries with ones recomputed from tasks
+
+        returns: number of summaries
+        """
+        n_summaries = 0
+        user_ids = []
+        batch = []
+        for summary in cls._summaries_from_tasks():
+            batch.append(ReplaceOne({'_id': summary['_id']}, summary, upsert=True))
+            user_ids.append(summary['_id'])
+            if len(batch) >= batch_size:
+                cls._db.score_summary.bulk_write(batch, ordered=False)
+                n_summaries += len(batch)
+                batch = []
+        if batch:
+            cls._db.score_summary.bulk_write(batch, ordered=False)
+            n_summaries += len(batch)
+        cls._db.score_summary.delete_many({'_id': {'$nin': user_ids}})
+        return n_summaries
+
+    @classmethod
+    def check_score_summaries(cls):
+        """Compare stored summaries with ones recomputed from tasks
+
+        returns: list of user ids with wrong or missing summaries, or summaries without scores
+        """
+        def normalized(summary):
+            return {'tasks': summary.get('tasks', {}), 'workshops': summary.get('workshops', {})}
+
+        inconsistent = []
+        checked = set()
+        for expected in cls._summaries_from_tasks():
+            checked.add(expected['_id'])
+            stored = cls._db.score_summary.find_one({'_id': expected['_id']})
+            if stored is None or normalized(stored) != normalized(expected):
+                inconsistent.append(expected['_id'])
+        for stored in cls._db.score_summary.find({}, {'_id': 1}):
+            if stored['_id'] not in checked:
+                inconsistent.append(stored['_id'])
+        return inconsistent
+
     @classmethod
     def get_gradable(cls, user):
         """
@@ -185,14 +789,15 @@ class TasksDB:
         [{'workshop_number': int, 'task_number': int, 'tg_username': str},]
         """
         user_info = cls.get_user_info(user)
-        tasks = cls._db.task.find({'graders': user_info.get('_id')})
+        tasks = list(cls._db.task.find({'graders': user_info.get('_id')},
+                                       {'user_id': 1, 'workshop_number': 1, 'task_number': 1}))
+        tg_usernames = cls._get_tg_usernames(task['user_id'] for task in tasks)
 
         res = []
         for task in tasks:
-            tg_username = cls._db.user.find_one({'_id': task['user_id']})['tg_username']
             res.append({'workshop_number': task['workshop_number'],
                         'task_number': task['task_number'],
-                        'tg_username': tg_username})
+                        'tg_username': tg_usernames.get(task['user_id'])})
         return res
 
     @classmethod
@@ -204,17 +809,39 @@ class TasksDB:
         """
         user_info = cls.get_user_info(user)
 
-        tasks = cls._db.task.find({'user_id': user_info.get('_id'), 'graders.0': {'$exists': 1}})
+        tasks = list(cls._db.task.find({'user_id': user_info.get('_id'), 'graders.0': {'$exists': 1}},
+                                       {'graders': 1, 'workshop_number': 1, 'task_number': 1}))
+        tg_usernames = cls._get_tg_usernames(grader for task in tasks for grader in task['graders'])
+
         res = []
         for task in tasks:
-            graders = task['graders']
-            for grader in graders:
-                tg_username = cls._db.user.find_one({'_id': grader})['tg_username']
+            for grader in task['graders']:
                 res.append({'workshop_number': task['workshop_number'],
                             'task_number': task['task_number'],
-                            'tg_username': tg_username})
+                            'tg_username': tg_usernames.get(grader)})
         return res
 
+    @classmethod
+    def _get_tg_usernames(cls, user_ids):
+        """One query for all users instead of a query per user
+
+        returns: dict(_id: tg_username)
+        """
+        user_ids = list(set(user_ids))
+        if not user_ids:
+            return {}
+        users = cls._db.user.find({'_id': {'$in': user_ids}}, {'tg_username': 1})
+        return {u['_id']: u.get('tg_username') for u in users}
+
+    @classmethod
+    def _get_users(cls, user_ids):
+        """returns: dict(_id: {'tg_id': int, 'tg_username': str})"""
+        user_ids = list(set(user_ids))
+        if not user_ids:
+            return {}
+        users = cls._db.user.find({'_id': {'$in': user_ids}}, {'tg_id': 1, 'tg_username': 1})
+        return {u['_id']: u for u in users}
+
     @classmethod
     def check_task_order(cls, user, workshop_number, task_number):
         """Check that user has sent the previous task"""
@@ -228,6 +855,13 @@ class TasksDB:
                                      'task_number': task_number - 1})
         return res is not None
 
+    @classmethod
+    def get_task_files(cls, workshop_number, task_number):
+        """returns: list of file_info dicts of all submissions of the task"""
+        tasks = cls._db.task.find({'workshop_number': workshop_number, 'task_number': task_number},
+                                  {'file_info': 1})
+        return [task['file_info'] for task in tasks if task.get('file_info')]
+
     @classmethod
     def get_task(cls, grader, graded, workshop_number, task_number):
         """Get a file for scoring
@@ -0,0 +1,276 @@
+"""Append-only log of grading actions and the audit projection replayed from it
+
+TasksDB puts the event of every mutation of tasks and late days into the
+changed document itself, in the same update (pending_events of the task or
+user), so a mutation is never saved without its event, with or without
+transactions. catch_up first moves pending events to the log, then applies
+the log. Events are never updated. They are kept in monthly collections
+events_YYYY_MM, an old term can be archived by dropping its collections.
+
+Every event has a key: the UTC time with microseconds and the ObjectId,
+it orders events and is the checkpoint of the projection.
+
+The projection keeps for every task its graders and scores (audit_task,
+_id is the task _id) and for every user the late days balance (audit_user).
+catch_up applies events after the checkpoint in batches; every update of a
+projected document is conditional on its last applied key, so a batch
+applied twice after a crash changes nothing. verify compares the projection
+with the task and user documents, history lists the events of one task for
+disputes.
+
+Tasks and users changed before the log existed are not known to the
+projection, snapshot writes their current state as events once.
+"""
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+PREFIX = 'events_'
+CHECKPOINT_ID = 'audit'
+PENDING = 'pending_events'  # events kept in the changed task or user until catch_up moves them to the log
+
+TASK_SUBMITTED = 'task_submitted'
+GRADERS_ASSIGNED = 'graders_assigned'
+GRADERS_RELEASED = 'graders_released'
+SCORE_ADDED = 'score_added'
+LATE_DAYS_USED = 'late_days_used'
+TASK_SNAPSHOT = 'task_snapshot'
+LATE_DAYS_SNAPSHOT = 'late_days_snapshot'
+
+_indexed = set()  # (database name, partition) with indexes created by this process
+
+
+def event(kind, **fields):
+    """New event document, fields: task_id, user_id, workshop_number, task_number, graders, grader, score, n_late
+
+    task_id and user_id of an event kept in a task or user are taken from the document by sweep
+    """
+    at = datetime.utcnow()
+    _id = ObjectId()
+    return {'_id': _id, 'key': f'{at:%Y-%m-%dT%H:%M:%S.%f}|{_id}', 'type': kind, 'at': at, **fields}
+
+
+def pending(*events):
+    """$push of the events into the changed document, merge it into the update of the mutation"""
+    return {PENDING: {'$each': list(events)}}
+
+
+def partition_of(key):
+    """events_YYYY_MM of the month of the key"""
+    return f'{PREFIX}{key[:4]}_{key[5:7]}'
+
+
+def partitions(db, since=None):
+    """Names of event collections in time order, starting with the month of the key since"""
+    names = sorted(name for name in db.list_collection_names() if name.startswith(PREFIX))
+    if since is not None:
+        names = [name for name in names if name >= partition_of(since)]
+    return names
+
+
+def _by_partition(db, events):
+    """returns: dict(collection of the month: events)"""
+    by_partition = {}
+    for e in events:
+        by_partition.setdefault(partition_of(e['key']), []).append(e)
+    for name in by_partition:
+        if (db.name, name) not in _indexed:
+            db[name].create_index('key')
+            db[name].create_index('task_id')
+            _indexed.add((db.name, name))
+    return by_partition
+
+
+def record(db, events):
+    """Append events, one insert per monthly partition"""
+    for name, items in _by_partition(db, events).items():
+        db[name].insert_many(items, ordered=True)
+
+
+def sweep(db, batch_size=1000):
+    """Move pending events of tasks and users to the log
+
+    An event is inserted unless the log has it already, then pulled from its
+    document, so a sweep interrupted at any point can be repeated.
+    returns: number of moved events
+    """
+    n_moved = 0
+    for collection, owner in (('task', 'task_id'), ('user', 'user_id')):
+        docs = db[collection].find({f'{PENDING}._id': {'$exists': True}}, {PENDING: 1, 'user_id': 1},
+                                   batch_size=batch_size)
+        batch = []
+        for doc in docs:
+            ids = {owner: doc['_id'], 'user_id': doc['_id'] if collection == 'user' else doc['user_id']}
+            batch.append((doc['_id'], [{**e, **ids} for e in doc[PENDING]]))
+            if len(batch) >= batch_size:
+                n_moved += _move(db, collection, batch)
+                batch = []
+        if batch:
+            n_moved += _move(db, collection, batch)
+    return n_moved
+
+
+def _move(db, collection, batch):
+    """- batch: list of (document _id, its pending events)"""
+    items = [e for _, doc_events in batch for e in doc_events]
+    for name, partition_events in _by_partition(db, items).items():
+        db[name].bulk_write([UpdateOne({'_id': e['_id']},
+                                       {'$setOnInsert': {k: v for k, v in e.items() if k != '_id'}}, upsert=True)
+                             for e in partition_events], ordered=False)
+    db[collection].bulk_write([UpdateOne({'_id': doc_id},
+                                         {'$pull': {PENDING: {'_id': {'$in': [e['_id'] for e in doc_events]}}}})
+                               for doc_id, doc_events in batch], ordered=False)
+    return len(items)
+
+
+def _projection_ops(e):
+    """returns: (updates of audit_task, updates of audit_user)"""
+    key = e['key']
+    newer = {'$or': [{'last': {'$exists': False}}, {'last': {'$lt': key}}]}
+    kind = e['type']
+    if kind == TASK_SUBMITTED:
+        return [UpdateOne({'_id': e['task_id']},
+                          {'$setOnInsert': {'user_id': e['user_id'], 'workshop_number': e['workshop_number'],
+                                            'task_number': e['task_number'], 'graders': [], 'scores': [],
+                                            'last': key}}, upsert=True)], []
+    if kind == TASK_SNAPSHOT:
+        return [UpdateOne({'_id': e['task_id']},
+                          {'$set': {'user_id': e['user_id'], 'workshop_number': e['workshop_number'],
+                                    'task_number': e['task_number'], 'graders': e['graders'],
+                                    'scores': e['scores'], 'last': key}}, upsert=True)], []
+    if kind == GRADERS_ASSIGNED:
+        return [UpdateOne({'_id': e['task_id'], **newer},
+                          {'$push': {'graders': {'$each': e['graders']}}, '$set': {'last': key}})], []
+    if kind == GRADERS_RELEASED:
+        return [UpdateOne({'_id': e['task_id'], **newer},
+                          {'$pull': {'graders': {'$in': e['graders']}}, '$set': {'last': key}})], []
+    if kind == SCORE_ADDED:
+        return [UpdateOne({'_id': e['task_id'], **newer},
+                          {'$pull': {'graders': e['grader']}, '$push': {'scores': e['score']},
+                           '$set': {'last': key}})], []
+    if kind == LATE_DAYS_USED:
+        return [], [UpdateOne({'_id': e['user_id']}, {'$setOnInsert': {'used': 0}}, upsert=True),
+                    UpdateOne({'_id': e['user_id'], **newer}, {'$inc': {'used': e['n_late']}, '$set': {'last': key}})]
+    if kind == LATE_DAYS_SNAPSHOT:
+        return [], [UpdateOne({'_id': e['user_id']},
+                              {'$set': {'balance': e['late_days'], 'used': 0, 'last': key}}, upsert=True)]
+    raise ValueError(f'Unknown event type {kind}')
+
+
+def apply(db, events):
+    """Apply events (in key order) to the projection"""
+    task_ops, user_ops = [], []
+    for e in events:
+        task_updates, user_updates = _projection_ops(e)
+        task_ops += task_updates
+        user_ops += user_updates
+    # ordered: updates of one document are applied in the order of events
+    if task_ops:
+        db.audit_task.bulk_write(task_ops, ordered=True)
+    if user_ops:
+        db.audit_user.bulk_write(user_ops, ordered=True)
+
+
+def catch_up(db, batch_size=1000, lag=timedelta(seconds=5)):
+    """Move pending events to the log and apply events after the checkpoint
+
+    Events of the last lag are left for the next run: writers in other
+    processes may still be saving mutations whose events have earlier keys.
+    Keys are taken from the clock of the writer, so the lag must also cover
+    the clock skew between the machines running the bot and catch_up.
+    returns: number of applied events
+    """
+    checkpoint = db.projection_checkpoint.find_one({'_id': CHECKPOINT_ID}) or {}
+    last = checkpoint.get('key', '')
+    horizon = f'{datetime.utcnow() - lag:%Y-%m-%dT%H:%M:%S.%f}'
+    sweep(db, batch_size)
+    n_applied = 0
+    for name in partitions(db, since=last or None):
+        while True:
+            batch = list(db[name].find({'key': {'$gt': last, '$lt': horizon}},
+                                       sort=[('key', 1)], limit=batch_size))
+            if not batch:
+                break
+            apply(db, batch)
+            last = batch[-1]['key']
+            db.projection_checkpoint.update_one({'_id': CHECKPOINT_ID}, {'$set': {'key': last}}, upsert=True)
+            n_applied += len(batch)
+    return n_applied
+
+
+def rebuild(db, batch_size=1000, lag=timedelta(seconds=5)):
+    """Replay all events into an empty projection
+
+    returns: number of applied events
+    """
+    db.audit_task.drop()
+    db.audit_user.drop()
+    db.projection_checkpoint.delete_one({'_id': CHECKPOINT_ID})
+    return catch_up(db, batch_size, lag)
+
+
+def snapshot(db, default_late_days, batch_size=1000):
+    """Record the current state of tasks and late days which the projection does not know
+
+    returns: number of recorded events
+    """
+    known_tasks = set(db.audit_task.distinct('_id'))
+    known_users = set(db.audit_user.distinct('_id'))
+    batch = []
+    n_recorded = 0
+    tasks = db.task.find({}, {'user_id': 1, 'workshop_number': 1, 'task_number': 1, 'graders': 1, 'scores': 1})
+    users = db.user.find({}, {'late_days': 1})
+    items = [event(TASK_SNAPSHOT, task_id=t['_id'], user_id=t['user_id'], workshop_number=t['workshop_number'],
+                   task_number=t['task_number'], graders=t.get('graders', []), scores=t.get('scores', []))
+             for t in tasks if t['_id'] not in known_tasks]
+    items += [event(LATE_DAYS_SNAPSHOT, user_id=u['_id'], late_days=u.get('late_days') or default_late_days)
+              for u in users if u['_id'] not in known_users]
+    for e in items:
+        batch.append(e)
+        if len(batch) >= batch_size:
+            record(db, batch)
+            n_recorded += len(batch)
+            batch = []
+    if batch:
+        record(db, batch)
+        n_recorded += len(batch)
+    return n_recorded
+
+
+def verify(db, default_late_days):
+    """Compare the projection with tasks and users
+
+    returns: list of (collection, _id, field, value in the document, value in the projection)
+    """
+    mismatches = []
+    projected = {t['_id']: t for t in db.audit_task.find({}, {'graders': 1, 'scores': 1})}
+    for task in db.task.find({}, {'graders': 1, 'scores': 1}):
+        audit = projected.pop(task['_id'], None)
+        if audit is None:
+            mismatches.append(('task', task['_id'], 'missing', None, None))
+            continue
+        for field in ('graders', 'scores'):
+            if sorted(task.get(field, [])) != sorted(audit.get(field, [])):
+                mismatches.append(('task', task['_id'], field, task.get(field), audit.get(field)))
+    mismatches += [('task', task_id, 'deleted', None, None) for task_id in projected]
+
+    balances = {u['_id']: u for u in db.audit_user.find()}
+    for user in db.user.find({}, {'late_days': 1}):
+        audit = balances.get(user['_id'])
+        late_days = user.get('late_days') or default_late_days
+        expected = (audit.get('balance', default_late_days) - audit.get('used', 0)) if audit else default_late_days
+        if late_days != expected:
+            mismatches.append(('user', user['_id'], 'late_days', late_days, expected))
+    return mismatches
+
+
+def history(db, task_id):
+    """Events of the task in key order, pending ones included"""
+    res = {}
+    for name in partitions(db):
+        res.update((e['_id'], e) for e in db[name].find({'task_id': task_id}))
+    task = db.task.find_one({'_id': task_id}, {PENDING: 1, 'user_id': 1}) or {}
+    for e in task.get(PENDING, []):
+        res.setdefault(e['_id'], {**e, 'task_id': task_id, 'user_id': task['user_id']})
+    return sorted(res.values(), key=lambda e: e['key'])
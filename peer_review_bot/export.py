@@ -0,0 +1,83 @@
+"""Gradebook export: one row per (student, workshop, task)
+
+Rows are streamed from one aggregation over task joined with user, so
+memory does not depend on the number of students.
+"""
+import csv
+
+from peer_review_bot import courses
+from peer_review_bot.dbutils import TasksDB
+
+COLUMNS = ['username', 'tg_username', 'workshop_number', 'task_number',
+           'mean_score', 'n_scores', 'pending_graders', 'late_days_used', 'late_days_left']
+
+
+def gradebook_pipeline(workshop_number=None):
+    match = {} if workshop_number is None else {'workshop_number': workshop_number}
+    return [
+        {'$match': match},
+        # follows the (user_id, workshop_number, task_number) index
+        {'$sort': {'user_id': 1, 'workshop_number': 1, 'task_number': 1}},
+        {'$lookup': {'from': 'user', 'localField': 'user_id', 'foreignField': '_id', 'as': 'user'}},
+        {'$unwind': {'path': '$user', 'preserveNullAndEmptyArrays': True}},
+        {'$project': {
+            '_id': 0,
+            'username': '$user.username',
+            'tg_username': '$user.tg_username',
+            'workshop_number': 1,
+            'task_number': 1,
+            'mean_score': {'$avg': '$scores'},
+            'n_scores': {'$size': {'$ifNull': ['$scores', []]}},
+            'pending_graders': {'$size': {'$ifNull': ['$graders', []]}},
+            'late_days_used': {'$ifNull': ['$late_days', 0]},
+            'late_days_left': {'$ifNull': ['$user.late_days', courses.current().default_late_days]},
+        }},
+    ]
+
+
+def iter_gradebook(workshop_number=None, batch_size=1000):
+    """yields: dict per (student, workshop, task) with COLUMNS keys"""
+    rows = TasksDB._db.task.aggregate(gradebook_pipeline(workshop_number),
+                                      allowDiskUse=True, batchSize=batch_size)
+    for row in rows:
+        if row.get('mean_score') is not None:
+            row['mean_score'] = round(row['mean_score'], 2)
+        yield row
+
+
+def write_csv(file, rows):
+    writer = csv.DictWriter(file, COLUMNS, extrasaction='ignore')
+    writer.writeheader()
+    n_rows = 0
+    for row in rows:
+        writer.writerow(row)
+        n_rows += 1
+    return n_rows
+
+
+def write_parquet(path, rows, row_group_size=10000):
+    """Columnar output, written in row groups to keep memory bounded. Needs pyarrow"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError('Parquet export needs pyarrow: pip install pyarrow')
+
+    schema = pa.schema([('username', pa.string()), ('tg_username', pa.string()),
+                        ('workshop_number', pa.int64()), ('task_number', pa.int64()),
+                        ('mean_score', pa.float64()), ('n_scores', pa.int64()),
+                        ('pending_graders', pa.int64()), ('late_days_used', pa.int64()),
+                        ('late_days_left', pa.int64())])
+    n_rows = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        columns = {name: [] for name in COLUMNS}
+        for row in rows:
+            for name in COLUMNS:
+                columns[name].append(row.get(name))
+            n_rows += 1
+            if len(columns['username']) >= row_group_size:
+                writer.write_table(pa.table(columns, schema=schema))
+                columns = {name: [] for name in COLUMNS}
+        if columns['username']:
+            writer.write_table(pa.table(columns, schema=schema))
+    return n_rows
@@ -0,0 +1,248 @@
+"""Local cache of submitted files
+
+Files are stored by the sha256 of their content in <directory>/objects, a
+SQLite index maps telegram file_id to the hash. When the cache grows over
+max_bytes the least recently used files are removed. Prefetcher downloads all
+submissions of a task through the Bot API with bounded parallelism, make_server
+serves cached files over HTTP with socket.sendfile, without copying them
+through python.
+"""
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote
+
+import requests
+
+from peer_review_bot.dbutils import TasksDB
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 16
+_UNSAFE_FILENAME = re.compile(r'[^\x20-\x7e]|["\\]')
+
+
+class FileCache:
+    """
+    - directory: where objects and the index are kept
+    - max_bytes: total size of the cached files, older files are evicted beyond it
+    """
+    def __init__(self, directory, max_bytes=2 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(directory, 'index.sqlite'),
+                                     check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS files (file_id TEXT PRIMARY KEY, sha256 TEXT NOT NULL, '
+                           'size INTEGER NOT NULL, file_name TEXT, accessed_at REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS files_accessed_at ON files (accessed_at)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)')
+
+    def _object_path(self, sha256):
+        return os.path.join(self.directory, 'objects', sha256[:2], sha256)
+
+    def get(self, file_id):
+        """returns: (path, size, file_name) of the cached file or None, marks it as recently used"""
+        with self._lock:
+            row = self._conn.execute('SELECT sha256, size, file_name FROM files WHERE file_id = ?',
+                                     (file_id,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute('UPDATE files SET accessed_at = ? WHERE file_id = ?', (time.time(), file_id))
+        sha256, size, file_name = row
+        return self._object_path(sha256), size, file_name
+
+    def __contains__(self, file_id):
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM files WHERE file_id = ?', (file_id,)).fetchone() is not None
+
+    def put(self, file_id, chunks, file_name=None):
+        """Store the file from an iterable of bytes, identical content is stored once
+
+        returns: sha256 of the content
+        """
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.directory, 'objects'))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            sha256 = digest.hexdigest()
+            path = self._object_path(sha256)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with self._lock:
+                os.replace(tmp_path, path)
+                self._conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                                   (file_id, sha256, size, file_name, time.time()))
+                self._evict()
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return sha256
+
+    def size(self):
+        """Bytes taken by cached objects, each content is counted once"""
+        with self._lock:
+            return self._size()
+
+    def _size(self):
+        row = self._conn.execute('SELECT SUM(size) FROM (SELECT DISTINCT sha256, size FROM files)').fetchone()
+        return row[0] or 0
+
+    def _evict(self):
+        """Remove the least recently used contents, with all file_ids pointing to them"""
+        total = self._size()
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute('SELECT sha256, size FROM files GROUP BY sha256, size '
+                                  'ORDER BY MAX(accessed_at)').fetchall()
+        for sha256, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute('DELETE FROM files WHERE sha256 = ?', (sha256,))
+            try:
+                os.remove(self._object_path(sha256))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def close(self):
+        self._conn.close()
+
+
+class Prefetcher:
+    """Downloads files through the Bot API: getFile, then the file itself
+
+    - api_url: e.g. https://api.telegram.org, config.api_url
+    - max_workers: number of concurrent downloads
+    """
+    def __init__(self, cache, token, api_url, max_workers=8, timeout=60., proxies=None):
+        self.cache = cache
+        self.token = token
+        self.api_url = api_url
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if proxies:
+            self.session.proxies.update(proxies)
+
+    def download(self, file_id, file_name=None):
+        """Put the file to the cache unless it is there already
+
+        returns: True if the file has been downloaded
+        """
+        if file_id in self.cache:
+            return False
+        resp = self.session.get(f'{self.api_url}/bot{self.token}/getFile', params={'file_id': file_id},
+                                timeout=self.timeout)
+        resp.raise_for_status()
+        file_path = resp.json()['result']['file_path']
+        with self.session.get(f'{self.api_url}/file/bot{self.token}/{file_path}',
+                              stream=True, timeout=self.timeout) as resp:
+            resp.raise_for_status()
+            self.cache.put(file_id, resp.iter_content(CHUNK_SIZE), file_name)
+        return True
+
+    def prefetch(self, files):
+        """Download files concurrently
+
+        - files: iterable of file_info dicts (file_id, file_name)
+        returns: dict(downloaded=int, cached=int, failed={file_id: error})
+        """
+        report = {'downloaded': 0, 'cached': 0, 'failed': {}}
+
+        def download(file_info):
+            try:
+                return file_info['file_id'], self.download(file_info['file_id'], file_info.get('file_name')), None
+            except (requests.RequestException, KeyError, ValueError) as e:
+                return file_info['file_id'], False, e
+
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            for file_id, downloaded, error in executor.map(download, files):
+                if error is not None:
+                    error = self._describe(error)
+                    logger.warning(f'Failed to download {file_id}: {error}')
+                    report['failed'][file_id] = error
+                elif downloaded:
+                    report['downloaded'] += 1
+                else:
+                    report['cached'] += 1
+        return report
+
+    def _describe(self, error):
+        """Error message without the bot token, which is part of every Bot API url"""
+        response = getattr(error, 'response', None)
+        if response is not None:
+            return f'HTTP {response.status_code} {response.reason}'
+        return f'{type(error).__name__}: {error}'.replace(self.token, '<token>')
+
+    def prefetch_task(self, workshop_number, task_number):
+        return self.prefetch(TasksDB.get_task_files(workshop_number, task_number))
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    # set by make_server
+    cache = None
+
+    def do_GET(self):
+        if not self.path.startswith('/files/'):
+            return self._not_found()
+        cached = self.cache.get(unquote(self.path[len('/files/'):]))
+        if cached is None:
+            return self._not_found()
+        path, size, file_name = cached
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return self._not_found()
+        with f:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(size))
+            if file_name:
+                self.send_header('Content-Disposition', content_disposition(file_name))
+            self.end_headers()
+            self.wfile.flush()
+            # the kernel copies the file to the socket
+            self.connection.sendfile(f)
+
+    def _not_found(self):
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def content_disposition(file_name):
+    """Attachment header for a file name sent by a student
+
+    Quotes, backslashes, CR/LF and other non-printable or non-ASCII characters
+    are replaced in the plain filename, the exact name goes percent-encoded
+    in filename* (RFC 5987).
+    """
+    fallback = _UNSAFE_FILENAME.sub('_', file_name)
+    return f'attachment; filename="{fallback}"; filename*=UTF-8\'\'{quote(file_name, safe="")}'
+
+
+def make_server(cache, host='127.0.0.1', port=8013):
+    handler = type('Handler', (FileHandler,), {'cache': cache})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
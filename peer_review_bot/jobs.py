@@ -0,0 +1,118 @@
+"""Background jobs of the bot
+
+StaleGraderJob periodically takes solutions away from graders who have not
+scored them in time, gives them to other students and tells both sides
+through the outbox, which keeps the telegram rate limits.
+MaintenanceJob removes expired dialog states from the backend and moves
+pending events to the audit log (see events.py).
+Every job runs for each course in its own thread.
+"""
+import logging
+import threading
+from datetime import timedelta
+
+from peer_review_bot import config, courses, datautils, events
+from peer_review_bot.dbutils import TasksDB
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicJob:
+    """Calls run_course for every course each interval seconds in a daemon thread
+
+    - interval: seconds between runs
+    """
+    name = 'job'
+
+    def __init__(self, interval=3600.):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self):
+        """returns: element-wise sums of what run_course returns for each course"""
+        total = None
+        for course in courses.all_courses():
+            with courses.use(course.course_id):
+                res = self.run_course()
+            total = res if total is None else tuple(a + b for a, b in zip(total, res))
+        return total
+
+    def run_course(self):
+        """returns: tuple of counters"""
+        raise NotImplementedError
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception(f'Job {self.name} failed')
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class StaleGraderJob(PeriodicJob):
+    """
+    - outbox: sender.Outbox
+    - timeout: timedelta, time to score a solution after the assignment
+    """
+    name = 'stale-graders'
+
+    def __init__(self, outbox, timeout=timedelta(days=3), interval=3600.):
+        super().__init__(interval)
+        self.outbox = outbox
+        self.timeout = timeout
+
+    def run_once(self):
+        """Reassign stale graders of every course
+
+        returns: (number of released assignments, number of new assignments)
+        """
+        return super().run_once() or (0, 0)
+
+    def run_course(self):
+        released, assigned = TasksDB.reassign_stale_graders(self.timeout)
+        users = TasksDB._get_users([grader for grader, *_ in released + assigned] +
+                                   [user_id for _, user_id, *_ in released + assigned])
+
+        def notify(assignments, message):
+            for grader, user_id, workshop, task in assignments:
+                grader_info, author_info = users.get(grader), users.get(user_id)
+                if grader_info is None or author_info is None:
+                    continue
+                self.outbox.send_message(grader_info['tg_id'], message.format(
+                    workshop=workshop, task=task, tg_username=author_info.get('tg_username'),
+                    days=self.timeout.days))
+
+        notify(released, config.grading_released_message)
+        notify(assigned, config.grading_assigned_message)
+        if released:
+            logger.info(f'Released {len(released)} stale graders, assigned {len(assigned)} new ones')
+        return len(released), len(assigned)
+
+
+class MaintenanceJob(PeriodicJob):
+    """Housekeeping which must not depend on an admin's cron"""
+    name = 'maintenance'
+
+    def run_once(self):
+        """returns: (number of removed dialog states, number of events applied to the audit projection)"""
+        return super().run_once() or (0, 0)
+
+    def run_course(self):
+        n_purged = datautils.get_store().purge_expired()
+        if n_purged:
+            logger.info(f'Removed {n_purged} expired dialog states of {courses.current().course_id}')
+        # pending_events of tasks and users stay small without a cron for audit catch-up
+        n_applied = events.catch_up(TasksDB._db, lag=timedelta(seconds=config.audit_lag_seconds))
+        return n_purged, n_applied
@@ -0,0 +1,352 @@
+"""Admin commands
+
+usage: python -m peer_review_bot.manage <command>
+"""
+import sys
+import json
+import argparse
+from datetime import datetime, timedelta
+
+from peer_review_bot import config, courses, export, filecache, similarity, schedule, commands, events
+from peer_review_bot.dbutils import TasksDB
+
+
+def migrate(args):
+    n_updated = TasksDB.migrate_grader_counters()
+    print(f'Grader counters set for {n_updated} tasks')
+    n_updated = TasksDB.migrate_user_fields()
+    print(f'scored_tasks set for {n_updated} users')
+
+
+def indexes(args):
+    report = TasksDB.ensure_indexes()
+    for collection, info in report.items():
+        print(f'{collection}:')
+        print(f'\tcreated: {info["created"]}')
+        print(f'\textra (not declared in TasksDB.indexes): {info["extra"]}')
+        for name, error in info['failed'].items():
+            print(f'\tfailed {name}: {error}')
+
+
+def balance(args):
+    assigned = TasksDB.balance_graders(args.workshop, args.task)
+    print(f'Assigned {len(assigned)} graders')
+
+
+def rebuild_summaries(args):
+    n_summaries = TasksDB.rebuild_score_summaries()
+    print(f'Rebuilt score summaries of {n_summaries} users')
+
+
+def check_summaries(args):
+    inconsistent = TasksDB.check_score_summaries()
+    if not inconsistent:
+        print('Score summaries are consistent with tasks')
+        return
+    print(f'{len(inconsistent)} inconsistent score summaries, run rebuild-summaries. User ids:')
+    for user_id in inconsistent:
+        print(f'\t{user_id}')
+    raise SystemExit(1)
+
+
+def export_gradebook(args):
+    rows = export.iter_gradebook(args.workshop)
+    if args.format == 'parquet':
+        if args.output is None:
+            raise SystemExit('--output is required for parquet')
+        n_rows = export.write_parquet(args.output, rows)
+    elif args.output is None:
+        n_rows = export.write_csv(sys.stdout, rows)
+    else:
+        with open(args.output, 'w', newline='') as f:
+            n_rows = export.write_csv(f, rows)
+    print(f'Exported {n_rows} rows', file=sys.stderr)
+
+
+def prefetch(args):
+    if not config.token:
+        raise SystemExit('Set PRB_TOKEN to download files through the Bot API')
+    proxies = {'https': config.proxy} if config.use_proxy and config.proxy else None
+    cache = filecache.FileCache(config.file_cache_dir, config.file_cache_max_bytes)
+    prefetcher = filecache.Prefetcher(cache, config.token, config.api_url, args.workers, proxies=proxies)
+    report = prefetcher.prefetch_task(args.workshop, args.task)
+    print(f'Downloaded {report["downloaded"]}, already cached {report["cached"]}, failed {len(report["failed"])}')
+    for file_id, error in report['failed'].items():
+        print(f'\t{file_id}: {error}')
+
+
+def serve_files(args):
+    cache = filecache.FileCache(config.file_cache_dir, config.file_cache_max_bytes)
+    server = filecache.make_server(cache, args.host, args.port)
+    print(f'Serving cached files on http://{args.host}:{args.port}/files/<file_id>')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def find_similar(args):
+    cache = filecache.FileCache(config.file_cache_dir, config.file_cache_max_bytes)
+    report = similarity.ingest_task(cache, args.workshop, args.task)
+    print(f'Indexed {report["indexed"]} submissions, {report["already_indexed"]} were indexed before')
+    if report['not_cached']:
+        print(f'{len(report["not_cached"])} submissions are not in the file cache, run prefetch first')
+    for file_id, error in report['unreadable'].items():
+        print(f'\tnot indexed, can not read {file_id}: {error}')
+
+    pairs = similarity.detect_task(args.workshop, args.task, args.threshold)
+    usernames = TasksDB._get_tg_usernames([user_id for pair in pairs for user_id in pair[:2]])
+    for user_id1, user_id2, score in pairs:
+        kind = 'identical' if score == 1. else f'similar {score:.2f}'
+        print(f'\t@{usernames.get(user_id1)} @{usernames.get(user_id2)}: {kind}')
+    print(f'{len(pairs)} pairs, saved to task.similarity')
+
+
+def show_schedule(args):
+    course_schedule = schedule.current()
+    slots = sorted(course_schedule.slots.items())
+    for (workshop, task), slot in slots:
+        print(f'{workshop}.{task}\tdeadline {slot.deadline:%Y-%m-%d %H:%M}\tmax_late {slot.max_late}')
+    for (tg_id, workshop), days in sorted(course_schedule.extensions.items()):
+        print(f'extension: tg_id {tg_id}, workshop {workshop}, {days} days')
+
+
+def check_mongo_schedule():
+    if courses.current().schedule != schedule.MONGO:
+        raise SystemExit(f'The schedule is read from {courses.current().schedule or "config.deadlines"}, '
+                         f'set the schedule of the course to {schedule.MONGO!r} to edit it here')
+
+
+def import_schedule(args):
+    check_mongo_schedule()
+    with open(args.file) as f:
+        spec = json.load(f)
+    # fails on a wrong file before it is saved
+    course = courses.current()
+    n_slots = len(schedule.Schedule.from_spec(spec, course.n_tasks, course.max_late).slots)
+    schedule.save(spec)
+    print(f'Saved the schedule of {n_slots} tasks, the bot picks it up in {config.schedule_check_interval} s')
+
+
+def extend_deadline(args):
+    check_mongo_schedule()
+    user = TasksDB._db.user.find_one({'tg_username': args.tg_username.strip('@')}, {'tg_id': 1})
+    if user is None:
+        raise SystemExit(f'No user @{args.tg_username}')
+    schedule.extend(user['tg_id'], args.workshop, args.days)
+    print(f'Deadlines of workshop {args.workshop} moved by {args.days} days for @{args.tg_username}')
+
+
+def import_scores(args):
+    """CSV rows: grader, student, task, score, e.g. @ta,@student,1.4,10"""
+    with open(args.file, newline='', encoding='utf-8-sig') as f:
+        lines = dict(commands.csv_rows(f.read()))  # line number in the file -> line
+    grade = commands.COMMANDS['grade']
+    errors = []
+    rows = []  # (line number, row)
+    for n, line in lines.items():
+        grader, _, rest = line.partition(' ')
+        try:
+            rows.append((n, dict(grade.parse_line(rest), grader=grader.lstrip('@'))))
+        except commands.ParseError as e:
+            errors.append((n, line, e.reason))
+    for start in range(0, len(rows), args.batch_size):
+        batch = rows[start:start + args.batch_size]
+        for (n, row), error in zip(batch, TasksDB.import_scores([row for _, row in batch])):
+            if error is not None:
+                errors.append((n, lines[n], error))
+    print(f'Recorded {len(lines) - len(errors)} of {len(lines)} scores')
+    for n, line, error in sorted(errors):
+        print(f'\tline {n} ({line}): {error}')
+    if errors:
+        raise SystemExit(1)
+
+
+def audit(args):
+    db = TasksDB._db
+    lag = timedelta(seconds=config.audit_lag_seconds)
+    if args.action == 'catch-up':
+        n_applied = events.catch_up(db, args.batch_size, lag)
+        print(f'Applied {n_applied} events to the audit projection')
+    elif args.action == 'rebuild':
+        n_applied = events.rebuild(db, args.batch_size, lag)
+        print(f'Rebuilt the audit projection from {n_applied} events')
+    elif args.action == 'snapshot':
+        n_recorded = events.snapshot(db, courses.current().default_late_days, args.batch_size)
+        print(f'Recorded {n_recorded} snapshot events, run audit catch-up to apply them')
+    elif args.action == 'verify':
+        mismatches = events.verify(db, courses.current().default_late_days)
+        if not mismatches:
+            print('The audit projection is consistent with tasks and users')
+            return
+        print(f'{len(mismatches)} mismatches (collection, _id, field, document, projection):')
+        for mismatch in mismatches:
+            print('\t' + ' '.join(map(str, mismatch)))
+        raise SystemExit(1)
+
+
+def audit_history(args):
+    user = TasksDB._db.user.find_one({'tg_username': args.tg_username.strip('@')}, {'_id': 1})
+    if user is None:
+        raise SystemExit(f'No user @{args.tg_username}')
+    task = TasksDB._db.task.find_one({'user_id': user['_id'], 'workshop_number': args.workshop,
+                                      'task_number': args.task}, {'_id': 1})
+    if task is None:
+        raise SystemExit(f'@{args.tg_username} has not sent task {args.workshop}.{args.task}')
+    for e in events.history(TasksDB._db, task['_id']):
+        details = {k: v for k, v in e.items() if k in ('graders', 'grader', 'score', 'late_days')}
+        print(f'{e["at"]:%Y-%m-%d %H:%M:%S} UTC\t{e["type"]}\t{details}')
+
+
+def queries():
+    """Queries made by TasksDB and events.sweep with values taken from the database
+
+    returns: list of (description, collection, filter)
+    """
+    user = TasksDB._db.user.find_one() or {}
+    task = TasksDB._db.task.find_one() or {}
+    user_id = task.get('user_id', user.get('_id'))
+    n_graders = courses.current().n_graders
+    same_task = {'workshop_number': task.get('workshop_number', 1),
+                 'task_number': task.get('task_number', 1)}
+    return [
+        ('get_user_info by tg_id', 'user', {'tg_id': user.get('tg_id')}),
+        ('get_user_info by tg_username', 'user', {'tg_username': user.get('tg_username')}),
+        ('get_user_info by username', 'user', {'username': user.get('username')}),
+        ('add_task, get_task, add_score', 'task', {'user_id': user_id, **same_task}),
+        ('add_graders: tasks to grade', 'task', {**same_task,
+                                                  'n_assigned_graders': {'$lt': n_graders},
+                                                  'user_id': {'$ne': user_id},
+                                                  'graders': {'$ne': user_id},
+                                                  'scored_by': {'$ne': user_id},
+                                                  'released_graders': {'$ne': user_id}}),
+        ('add_graders: graders', 'task', {**same_task,
+                                          'n_assigned_graders': {'$lt': n_graders},
+                                          'user_id': {'$ne': user_id}}),
+        ('add_graders: usernames', 'user', {'_id': {'$in': [user_id]}}),
+        ('balance_graders: submitters and loads', 'task', same_task),
+        ('balance_graders: tasks without enough graders', 'task', {**same_task,
+                                                                   'n_assigned_graders': {'$lt': n_graders}}),
+        ('release_stale_graders', 'task', {'assignments.assigned_at': {
+            '$lt': datetime.now() - timedelta(days=config.stale_grader_days)}}),
+        ('add_scores: users', 'user', {'tg_username': {'$in': [user.get('tg_username')]}}),
+        ('add_scores: tasks', 'task', {'graders': {'$in': [user_id]}, 'user_id': {'$in': [user_id]}}),
+        ('get_scores', 'score_summary', {'_id': user_id}),
+        ('get_gradable', 'task', {'graders': user_id}),
+        ('get_graders', 'task', {'user_id': user_id, 'graders.0': {'$exists': 1}}),
+        ('get_task_files', 'task', same_task),
+        ('events.sweep: tasks', 'task', {f'{events.PENDING}._id': {'$exists': True}}),
+        ('events.sweep: users', 'user', {f'{events.PENDING}._id': {'$exists': True}}),
+    ]
+
+
+def format_plan(plan):
+    """Stages of a winning plan from the outer one, e.g. FETCH <- IXSCAN tg_id_1"""
+    stages = []
+    while plan:
+        stage = plan.get('stage', '?')
+        if 'indexName' in plan:
+            stage += ' ' + plan['indexName']
+        stages.append(stage)
+        plan = plan.get('inputStage') or (plan.get('inputStages') or [None])[0]
+    return ' <- '.join(stages)
+
+
+def explain(args):
+    for description, collection, filter_ in queries():
+        plan = TasksDB._db[collection].find(filter_).explain()
+        winning_plan = plan['queryPlanner']['winningPlan']
+        print(f'{description}: {format_plan(winning_plan.get("queryPlan", winning_plan))}')
+        if args.verbose:
+            print(f'\tfilter: {filter_}')
+            print(f'\t{winning_plan}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m peer_review_bot.manage')
+    parser.add_argument('-c', '--course', help='course id, required if PRB_COURSES lists several courses')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('migrate', help='add missing fields to old documents').set_defaults(func=migrate)
+    subparsers.add_parser('indexes', help='create missing indexes, show extra ones').set_defaults(func=indexes)
+
+    balance_parser = subparsers.add_parser('balance', help='give solutions without enough graders '
+                                                           'to the least loaded students')
+    balance_parser.add_argument('workshop', type=int)
+    balance_parser.add_argument('task', type=int)
+    balance_parser.set_defaults(func=balance)
+
+    subparsers.add_parser('rebuild-summaries', help='recompute score summaries from tasks'
+                          ).set_defaults(func=rebuild_summaries)
+    subparsers.add_parser('check-summaries', help='compare score summaries with tasks'
+                          ).set_defaults(func=check_summaries)
+
+    export_parser = subparsers.add_parser('export', help='export all grades')
+    export_parser.add_argument('-f', '--format', choices=['csv', 'parquet'], default='csv')
+    export_parser.add_argument('-o', '--output', help='file name, csv is written to stdout by default')
+    export_parser.add_argument('-w', '--workshop', type=int, help='only this workshop')
+    export_parser.set_defaults(func=export_gradebook)
+
+    prefetch_parser = subparsers.add_parser('prefetch', help='download all submissions of a task to the file cache')
+    prefetch_parser.add_argument('workshop', type=int)
+    prefetch_parser.add_argument('task', type=int)
+    prefetch_parser.add_argument('--workers', type=int, default=config.file_cache_workers)
+    prefetch_parser.set_defaults(func=prefetch)
+
+    serve_parser = subparsers.add_parser('serve-files', help='serve the file cache over http')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=config.file_cache_port)
+    serve_parser.set_defaults(func=serve_files)
+
+    similar_parser = subparsers.add_parser('similarity', help='find identical and similar submissions '
+                                                              'of a task in the file cache')
+    similar_parser.add_argument('workshop', type=int)
+    similar_parser.add_argument('task', type=int)
+    similar_parser.add_argument('--threshold', type=float, default=0.8, help='estimated Jaccard similarity')
+    similar_parser.set_defaults(func=find_similar)
+
+    import_scores_parser = subparsers.add_parser('import-scores', help='record scores from a CSV file with '
+                                                                       'rows: grader, student, task, score')
+    import_scores_parser.add_argument('file')
+    import_scores_parser.add_argument('--batch-size', type=int, default=500)
+    import_scores_parser.set_defaults(func=import_scores)
+
+    schedule_parser = subparsers.add_parser('schedule', help='show the schedule of deadlines')
+    schedule_parser.set_defaults(func=show_schedule)
+    import_parser = subparsers.add_parser('import-schedule', help='save a JSON schedule to mongo '
+                                                                  '(see schedule.py for the format)')
+    import_parser.add_argument('file')
+    import_parser.set_defaults(func=import_schedule)
+    extend_parser = subparsers.add_parser('extend', help='move the deadlines of a workshop for a student')
+    extend_parser.add_argument('tg_username')
+    extend_parser.add_argument('workshop', type=int)
+    extend_parser.add_argument('days', type=int)
+    extend_parser.set_defaults(func=extend_deadline)
+
+    audit_parser = subparsers.add_parser('audit', help='apply logged events to the audit projection, '
+                                                       'rebuild it, snapshot old data or compare it with tasks')
+    audit_parser.add_argument('action', choices=['catch-up', 'rebuild', 'snapshot', 'verify'])
+    audit_parser.add_argument('--batch-size', type=int, default=1000)
+    audit_parser.set_defaults(func=audit)
+    history_parser = subparsers.add_parser('history', help='logged events of a submitted task')
+    history_parser.add_argument('tg_username')
+    history_parser.add_argument('workshop', type=int)
+    history_parser.add_argument('task', type=int)
+    history_parser.set_defaults(func=audit_history)
+
+    explain_parser = subparsers.add_parser('explain', help='show query plans of TasksDB queries')
+    explain_parser.add_argument('-v', '--verbose', action='store_true')
+    explain_parser.set_defaults(func=explain)
+
+    args = parser.parse_args(argv)
+    try:
+        with courses.use(args.course):
+            args.func(args)
+    except courses.UnknownCourse as e:
+        raise SystemExit(f'{e}, choose one with --course: {[c.course_id for c in courses.all_courses()]}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""Handler latency, errors and mongo usage in the Prometheus text format
+
+Handlers are wrapped by telegram_ui.request_scoped, which records into the
+module level metrics below. render() returns the text served on GET /metrics
+by the webhook server, or by make_server() in the polling and async runtimes.
+"""
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds, from a cached command to a slow grading storm
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    type_ = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Histogram:
+    type_ = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [bucket counts..., +Inf count, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(label_values)
+            if values is None:
+                values = self._values[label_values] = [0] * (len(self.buckets) + 3)
+            values[i] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def count(self, *label_values):
+        values = self._values.get(label_values)
+        return values[-1] if values else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((k, list(v)) for k, v in self._values.items())
+        for label_values, counts in values:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield (f'{self.name}_bucket', _format_labels(self.labels + ('le',), label_values + (le,)),
+                       cumulative)
+            labels = _format_labels(self.labels, label_values)
+            yield f'{self.name}_sum', labels, counts[-2]
+            yield f'{self.name}_count', labels, counts[-1]
+
+
+class Gauge:
+    """Value read at scrape time
+
+    - read: function() -> number, or dict(tuple of label values: number) if labels are given
+    """
+    type_ = 'gauge'
+
+    def __init__(self, name, help, read, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._read = read
+
+    def samples(self):
+        values = self._read()
+        if not self.labels:
+            values = {(): values}
+        for label_values, value in sorted(values.items()):
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+registry = []
+
+
+def register(metric):
+    registry.append(metric)
+    return metric
+
+
+def render(metrics=None):
+    lines = []
+    for metric in registry if metrics is None else metrics:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.type_}')
+        for name, labels, value in metric.samples():
+            lines.append(f'{name}{labels} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+handler_latency = register(Histogram(
+    'prb_handler_seconds', 'Time spent in a message handler', ['handler']))
+handler_errors = register(Counter(
+    'prb_handler_errors_total', 'Exceptions raised by a message handler', ['handler', 'exception']))
+mongo_commands = register(Histogram(
+    'prb_handler_mongo_commands', 'Mongo commands sent while handling one update', ['handler'],
+    buckets=COUNT_BUCKETS))
+mongo_seconds = register(Counter(
+    'prb_handler_mongo_seconds_total', 'Time spent waiting for mongo commands', ['handler']))
+mongo_command_latency = register(Histogram(
+    'prb_mongo_command_seconds', 'Mongo command latency', ['command']))
+api_latency = register(Histogram(
+    'prb_api_request_seconds', 'Bot API request latency, retries included', ['method']))
+user_cache_hits = register(Counter(
+    'prb_handler_user_cache_hits_total', 'Users resolved from the request scope without mongo', ['handler']))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(host='0.0.0.0', port=8012):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    return server
+
+
+def serve_in_background(host='0.0.0.0', port=8012):
+    server = make_server(host, port)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
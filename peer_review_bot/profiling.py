@@ -0,0 +1,181 @@
+"""Sampling profiler for production, enabled by PRB_PROFILE=<share of updates>
+
+A sampled update registers its thread, one background thread reads the
+stacks of registered threads every sample_interval seconds. Updates which are
+not sampled pay only a random() call, so 1% sampling is safe to leave on.
+Every dump_interval seconds the profiler writes to profile_dir:
+
+- collapsed-<time>.txt: "frame;frame;frame count" lines for flamegraph.pl or speedscope
+- slow-<time>.json: the slowest updates (command without arguments) and time per TasksDB method
+"""
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import logging
+import threading
+import functools
+from collections import Counter
+from contextlib import contextmanager
+
+from peer_review_bot import commands
+
+logger = logging.getLogger(__name__)
+
+
+def redact(text):
+    """Keep only the name of a known command, arguments and free text may contain personal data"""
+    if not text:
+        return '<document>'
+    command, _ = commands.split(text)
+    if command is None:
+        return '<text>'
+    return f'/{command}' if command in commands.COMMANDS else '<unknown command>'
+
+
+def collapse(frame):
+    """Stack of the frame, root first, in the collapsed stack format"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Profiler:
+    """
+    - rate: share of updates to profile, 0 disables the profiler
+    - sample_interval: seconds between stack samples of a profiled thread
+    - dump_interval: seconds between dumps to profile_dir
+    - top_n: number of the slowest updates to keep
+    """
+    def __init__(self, rate=0., profile_dir='profiles', sample_interval=0.005, dump_interval=300., top_n=20):
+        self.rate = rate
+        self.profile_dir = profile_dir
+        self.sample_interval = sample_interval
+        self.dump_interval = dump_interval
+        self.top_n = top_n
+
+        self._active = {}  # thread ident -> handler name
+        self._stacks = Counter()
+        self._methods = {}  # TasksDB method -> [calls, seconds]
+        self._slowest = []  # heap of (seconds, update number, handler, redacted command)
+        self._n_updates = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self._thread.start()
+
+    @contextmanager
+    def update(self, handler, text=None):
+        """Profile handling of one update if it is sampled"""
+        if not self.enabled or getattr(self._local, 'sampled', False) or random.random() >= self.rate:
+            yield
+            return
+
+        ident = threading.get_ident()
+        self._local.sampled = True
+        with self._cond:
+            self._active[ident] = handler
+            self._cond.notify()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._local.sampled = False
+            with self._cond:
+                del self._active[ident]
+                self._n_updates += 1
+                item = (elapsed, self._n_updates, handler, redact(text))
+                if len(self._slowest) < self.top_n:
+                    heapq.heappush(self._slowest, item)
+                else:
+                    heapq.heappushpop(self._slowest, item)
+
+    def instrument(self, cls):
+        """Time every classmethod of cls when it is called during a sampled update"""
+        for name, attr in list(vars(cls).items()):
+            if isinstance(attr, classmethod) and not name.startswith('__'):
+                setattr(cls, name, classmethod(self._timed(attr.__func__, f'{cls.__name__}.{name}')))
+        return cls
+
+    def _timed(self, func, name):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not getattr(self._local, 'sampled', False):
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._cond:
+                    stats = self._methods.setdefault(name, [0, 0.])
+                    stats[0] += 1
+                    stats[1] += elapsed
+        return wrapper
+
+    def _sample(self):
+        next_dump = time.monotonic() + self.dump_interval
+        while True:
+            with self._cond:
+                # sleep while nothing is profiled, until the next dump at most
+                while not self._active and time.monotonic() < next_dump:
+                    self._cond.wait(next_dump - time.monotonic())
+                active = dict(self._active)
+            if active:
+                frames = sys._current_frames()
+                samples = [f'{handler};{collapse(frames[ident])}'
+                           for ident, handler in active.items() if ident in frames]
+                with self._cond:
+                    self._stacks.update(samples)
+            if time.monotonic() >= next_dump:
+                try:
+                    self.dump()
+                except OSError:
+                    logger.exception('Failed to dump the profile')
+                next_dump = time.monotonic() + self.dump_interval
+            time.sleep(self.sample_interval)
+
+    def dump(self):
+        """Write collected stacks and the slowest updates and start collecting anew
+
+        returns: (collapsed stacks path, slow updates path) or None if nothing was collected
+        """
+        with self._cond:
+            stacks, self._stacks = self._stacks, Counter()
+            methods, self._methods = self._methods, {}
+            slowest, self._slowest = sorted(self._slowest, reverse=True), []
+            n_updates, self._n_updates = self._n_updates, 0
+        if not n_updates and not stacks:
+            return None
+
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        stacks_path = os.path.join(self.profile_dir, f'collapsed-{stamp}.txt')
+        with open(stacks_path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+        slow_path = os.path.join(self.profile_dir, f'slow-{stamp}.json')
+        with open(slow_path, 'w') as f:
+            json.dump({'n_updates': n_updates,
+                       'slowest': [{'handler': handler, 'command': command, 'ms': round(1000 * seconds, 2)}
+                                   for seconds, _, handler, command in slowest],
+                       'tasksdb': {name: {'calls': calls, 'ms': round(1000 * seconds, 2)}
+                                   for name, (calls, seconds) in sorted(methods.items())}},
+                      f, indent=2)
+        return stacks_path, slow_path
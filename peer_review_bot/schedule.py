@@ -0,0 +1,178 @@
+"""Schedule of a course: deadlines, late windows and tasks of every workshop
+
+The schedule is read from the source named by the course setting schedule:
+None builds it from deadlines, n_tasks and max_late of the course, 'mongo'
+reads the document {'_id': 'schedule'} of the schedule collection of the
+course database and anything else is a JSON file:
+
+{"workshops": {"1": {"deadline": "2019-03-08T00:00:00", "n_tasks": 5, "max_late": 3,
+                     "tasks": {"5": "2019-03-15T00:00:00"}}},
+ "extensions": {"<tg_id>": {"1": 2}}}
+
+n_tasks and max_late default to the course settings, tasks override the
+deadline of single tasks, extensions move the deadlines of a workshop for
+one student by a number of days.
+
+Schedule is an immutable lookup table, checking a task is a dict lookup.
+current() returns the schedule of the current course; at most every
+config.schedule_check_interval seconds it checks the version of the source
+(the file mtime, the version field of the document) and rebuilds the table
+when it has changed, so edits are picked up without a restart.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from collections import namedtuple
+from types import MappingProxyType
+
+from peer_review_bot import config, courses
+from peer_review_bot.dbutils import TasksDB
+
+logger = logging.getLogger(__name__)
+
+MONGO = 'mongo'
+SCHEDULE_ID = 'schedule'
+
+# deadline: datetime, max_late: days after the deadline when the task is still accepted
+Slot = namedtuple('Slot', 'deadline max_late')
+
+
+class Schedule:
+    """
+    - slots: dict((workshop, task): Slot)
+    - extensions: dict((tg_id, workshop): days)
+    """
+    def __init__(self, slots, extensions=None, version=None):
+        self.slots = MappingProxyType(dict(slots))
+        self.extensions = MappingProxyType(dict(extensions or {}))
+        self.workshops = frozenset(workshop for workshop, _ in self.slots)
+        self.version = version
+
+    @classmethod
+    def from_spec(cls, spec, n_tasks, max_late, version=None):
+        """Build from the file or document format, see the module docstring"""
+        slots = {}
+        for workshop, values in (spec.get('workshops') or {}).items():
+            workshop = int(workshop)
+            deadline = _parse_datetime(values['deadline'])
+            workshop_max_late = values.get('max_late', max_late)
+            for task in range(1, values.get('n_tasks', n_tasks) + 1):
+                slots[workshop, task] = Slot(deadline, workshop_max_late)
+            for task, task_deadline in (values.get('tasks') or {}).items():
+                slots[workshop, int(task)] = Slot(_parse_datetime(task_deadline), workshop_max_late)
+        extensions = {(int(tg_id), int(workshop)): int(days)
+                      for tg_id, workshops in (spec.get('extensions') or {}).items()
+                      for workshop, days in workshops.items()}
+        return cls(slots, extensions, version)
+
+    @classmethod
+    def from_course(cls, course):
+        """The schedule of the deadlines setting, every workshop has n_tasks tasks"""
+        slots = {(workshop, task): Slot(deadline, course.max_late)
+                 for workshop, deadline in course.deadlines.items()
+                 for task in range(1, course.n_tasks + 1)}
+        return cls(slots, version=_course_version(course))
+
+    def slot(self, workshop, task):
+        """returns: Slot or None if there is no such task"""
+        return self.slots.get((workshop, task))
+
+    def deadline(self, workshop, task, tg_id=None):
+        """Deadline of the task for the student, with the extension"""
+        slot = self.slots[workshop, task]
+        extension = self.extensions.get((tg_id, workshop))
+        return slot.deadline + timedelta(days=extension) if extension else slot.deadline
+
+    def late_days(self, workshop, task, tg_id=None, now=None):
+        """returns: 0 before the deadline, the number of late days within max_late, None after that"""
+        delta = ((now or datetime.now()) - self.deadline(workshop, task, tg_id)).days
+        if delta <= 0:
+            return 0
+        if delta <= self.slots[workshop, task].max_late:
+            return delta
+        return None
+
+
+def _parse_datetime(value):
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+
+def _course_version(course):
+    return (tuple(sorted(course.deadlines.items())), course.n_tasks, course.max_late)
+
+
+def source_version(course):
+    """Cheap check of the source; the schedule is rebuilt when the version changes"""
+    if course.schedule is None:
+        return _course_version(course)
+    if course.schedule == MONGO:
+        doc = TasksDB._db.schedule.find_one({'_id': SCHEDULE_ID}, {'version': 1})
+        return doc and doc.get('version', 0)
+    stat = os.stat(course.schedule)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def load(course, version=None):
+    """Read the schedule of the course from its source"""
+    if course.schedule is None:
+        return Schedule.from_course(course)
+    if course.schedule == MONGO:
+        spec = TasksDB._db.schedule.find_one({'_id': SCHEDULE_ID}) or {}
+    else:
+        with open(course.schedule) as f:
+            spec = json.load(f)
+    return Schedule.from_spec(spec, course.n_tasks, course.max_late, version)
+
+
+_schedules = {}  # course_id -> (Schedule, monotonic time of the last check)
+_lock = threading.Lock()
+
+
+def current():
+    """Schedule of the current course, reloaded when its source has changed"""
+    course = courses.current()
+    entry = _schedules.get(course.course_id)
+    now = time.monotonic()
+    if entry is not None and now - entry[1] < config.schedule_check_interval:
+        return entry[0]
+    with _lock:
+        entry = _schedules.get(course.course_id)
+        if entry is not None and now - entry[1] < config.schedule_check_interval:
+            return entry[0]
+        try:
+            version = source_version(course)
+            if entry is None or entry[0].version != version:
+                schedule = load(course, version)
+                if entry is not None:
+                    logger.info(f'Schedule of {course.course_id} reloaded, version {version}')
+            else:
+                schedule = entry[0]
+        except Exception:
+            if entry is None:
+                raise
+            logger.exception(f'Failed to reload the schedule of {course.course_id}, keeping the old one')
+            schedule = entry[0]
+        _schedules[course.course_id] = (schedule, now)
+    return schedule
+
+
+def reset():
+    """Forget loaded schedules, they are read again on the next use"""
+    with _lock:
+        _schedules.clear()
+
+
+def save(spec):
+    """Replace the schedule document of the current course, for the 'mongo' source"""
+    spec = {key: value for key, value in spec.items() if key in ('workshops', 'extensions')}
+    TasksDB._db.schedule.update_one({'_id': SCHEDULE_ID}, {'$set': spec, '$inc': {'version': 1}}, upsert=True)
+
+
+def extend(tg_id, workshop, days):
+    """Move the deadlines of the workshop for the student, for the 'mongo' source"""
+    TasksDB._db.schedule.update_one({'_id': SCHEDULE_ID},
+                                    {'$set': {f'extensions.{tg_id}.{workshop}': days}, '$inc': {'version': 1}},
+                                    upsert=True)
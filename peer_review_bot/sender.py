@@ -0,0 +1,238 @@
+"""Outbound messages: sent from background threads within Telegram rate limits
+
+Handlers put messages to the Outbox and return at once. Consecutive text
+messages to one chat with the same parse_mode are merged into one message,
+so a reply of several send_message calls costs one Bot API call.
+A few worker threads send to different chats at the same time, messages
+to one chat are sent one by one in the order of arrival.
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+
+
+class TokenBucket:
+    """rate tokens per second, at most capacity tokens saved up"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Seconds until a token is available"""
+        self._refill(now)
+        return max(0., (1 - self.tokens) / self.rate)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class Outgoing:
+    def __init__(self, kind, chat_id, content, parse_mode=None, ready_at=0.):
+        self.kind = kind  # 'message' or 'document'
+        self.chat_id = chat_id
+        self.content = content
+        self.parse_mode = parse_mode
+        self.ready_at = ready_at
+        self.attempts = 0
+
+    def can_merge(self, text, parse_mode):
+        return (self.kind == 'message' and self.parse_mode == parse_mode
+                and len(self.content) + len(text) + 1 <= MAX_MESSAGE_LENGTH)
+
+
+def retry_after(exception):
+    """Seconds to wait from a 429 error of pyTelegramBotAPI, None for other errors"""
+    if getattr(exception, 'error_code', None) != 429:
+        return None
+    parameters = (getattr(exception, 'result_json', None) or {}).get('parameters') or {}
+    return parameters.get('retry_after', 1)
+
+
+def is_transient(exception):
+    """Network errors and 5xx responses may succeed when retried, other errors will not"""
+    if isinstance(exception, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return (getattr(exception, 'error_code', None) or 0) >= 500
+
+
+class Outbox:
+    """
+    - bot: object with send_message(chat_id, text, parse_mode=) and send_document(chat_id, document)
+    - per_chat_rate, chat_burst: messages per second and burst size for one chat
+    - global_rate: messages per second for the whole bot
+    - linger: seconds to wait for more messages to the same chat before sending
+    - max_retries: attempts for a message after 429, network and 5xx errors
+    - retry_delay: seconds before the first retry after a network or 5xx error, doubled with every attempt
+    - n_workers: number of threads sending messages
+    """
+    def __init__(self, bot, per_chat_rate=1., chat_burst=3, global_rate=30., linger=0.05, max_retries=5,
+                 retry_delay=1., n_workers=4):
+        self._bot = bot
+        self._per_chat_rate = per_chat_rate
+        self._chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._linger = linger
+        self._max_retries = max_retries
+        self._retry_delay = retry_delay
+        self._n_workers = n_workers
+
+        self._pending = OrderedDict()  # chat_id -> deque of Outgoing, in the order of arrival
+        self._in_flight = set()  # chats with a message being sent
+        self._paused_until = 0.
+        self._cond = threading.Condition()
+        self._threads = []
+
+        self.n_sent = 0
+        self.n_merged = 0
+        self.n_failed = 0
+
+    def send_message(self, chat_id, text, parse_mode=None):
+        text = str(text)
+        with self._cond:
+            queue = self._pending.setdefault(chat_id, deque())
+            last = queue[-1] if queue else None
+            if last is not None and last.can_merge(text, parse_mode):
+                last.content += '\n' + text
+                last.ready_at = time.monotonic() + self._linger
+                self.n_merged += 1
+            else:
+                queue.append(Outgoing('message', chat_id, text, parse_mode, time.monotonic() + self._linger))
+            self._wake()
+
+    def send_document(self, chat_id, document):
+        with self._cond:
+            queue = self._pending.setdefault(chat_id, deque())
+            queue.append(Outgoing('document', chat_id, document, ready_at=time.monotonic() + self._linger))
+            self._wake()
+
+    def flush(self, timeout=None):
+        """Wait until everything is sent, returns False on timeout"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            while self._pending or self._in_flight:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _wake(self):
+        if not self._threads:
+            for i in range(self._n_workers):
+                thread = threading.Thread(target=self._run, name=f'outbox-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        self._cond.notify_all()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self._per_chat_rate, self._chat_burst)
+        return bucket
+
+    def _next(self):
+        """
+        Pop the first item allowed to be sent now, otherwise returns seconds to wait,
+        None if every chat with pending messages has one in flight
+        """
+        now = time.monotonic()
+        wait = max(self._paused_until - now, self._global.delay(now))
+        if wait > 0:
+            return wait
+
+        wait = None
+        for chat_id, queue in self._pending.items():
+            if chat_id in self._in_flight:
+                continue
+            item = queue[0]
+            delay = max(item.ready_at - now, self._chat_bucket(chat_id).delay(now))
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+
+            queue.popleft()
+            if queue:
+                # round robin between chats
+                self._pending.move_to_end(chat_id)
+            else:
+                del self._pending[chat_id]
+            self._chat_bucket(chat_id).take(now)
+            self._global.take(now)
+            # buckets of idle chats are not needed anymore
+            if len(self._chat_buckets) > 1000:
+                self._chat_buckets = {c: b for c, b in self._chat_buckets.items()
+                                      if c in self._pending or not b.is_full(now)}
+            return item
+        return wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                item = None
+                while item is None:
+                    if not self._pending:
+                        self._cond.wait()
+                        continue
+                    res = self._next()
+                    if isinstance(res, Outgoing):
+                        item = res
+                    else:
+                        self._cond.wait(res)
+                self._in_flight.add(item.chat_id)
+
+            try:
+                self._send(item)
+            finally:
+                with self._cond:
+                    self._in_flight.discard(item.chat_id)
+                    self._cond.notify_all()
+
+    def _send(self, item):
+        try:
+            if item.kind == 'message':
+                self._bot.send_message(item.chat_id, item.content, parse_mode=item.parse_mode)
+            else:
+                self._bot.send_document(item.chat_id, item.content)
+            with self._cond:
+                self.n_sent += 1
+        except Exception as e:
+            item.attempts += 1
+            wait = retry_after(e)
+            if (wait is None and not is_transient(e)) or item.attempts >= self._max_retries:
+                with self._cond:
+                    self.n_failed += 1
+                logger.error(f'Failed to send {item.kind} to chat {item.chat_id} '
+                             f'after {item.attempts} attempts: {e}')
+                return
+
+            with self._cond:
+                if wait is not None:
+                    logger.warning(f'Rate limited by telegram, retry after {wait}s')
+                    # everything waits: 429 usually means the global limit is hit
+                    self._paused_until = time.monotonic() + wait
+                else:
+                    wait = self._retry_delay * 2 ** (item.attempts - 1)
+                    logger.warning(f'Failed to send {item.kind} to chat {item.chat_id}, retry after {wait}s: {e}')
+                    item.ready_at = time.monotonic() + wait
+                # the chat is still in flight, so its later messages can not overtake the item
+                self._pending.setdefault(item.chat_id, deque()).appendleft(item)
+                self._pending.move_to_end(item.chat_id, last=False)
@@ -0,0 +1,183 @@
+"""Duplicate and near-duplicate submissions of a task
+
+Submissions are read from the file cache (manage prefetch downloads them).
+ingest_task stores for every submission the sha256 of the file and a MinHash
+signature of its text in the submission_index collection, archives are
+unpacked. detect_task groups signatures by LSH bands, so only submissions
+sharing a band are compared and the work is linear in the number of
+submissions. Results are written to task.similarity:
+
+{'duplicates': [user _id], 'similar': [{'user_id': _id, 'score': float}], 'checked_at': datetime}
+"""
+import io
+import os
+import re
+import zlib
+import logging
+import zipfile
+import hashlib
+from datetime import datetime
+from collections import defaultdict
+from itertools import combinations
+
+from pymongo import UpdateOne
+
+from peer_review_bot.dbutils import TasksDB
+
+logger = logging.getLogger(__name__)
+
+N_PERMUTATIONS = 128
+N_BANDS = 32  # rows per band: N_PERMUTATIONS // N_BANDS
+SHINGLE_SIZE = 5
+MAX_MEMBER_SIZE = 1 << 20  # larger files of an archive are data, not code
+
+_PRIME = (1 << 61) - 1
+_MASK = (1 << 64) - 1
+# fixed coefficients, signatures stay comparable between runs
+_PERMUTATIONS = [(int.from_bytes(hashlib.blake2b(f'a{i}'.encode(), digest_size=8).digest(), 'big') % _PRIME | 1,
+                  int.from_bytes(hashlib.blake2b(f'b{i}'.encode(), digest_size=8).digest(), 'big') % _PRIME)
+                 for i in range(N_PERMUTATIONS)]
+_TOKEN = re.compile(r'\w+')
+# corrupt, encrypted (RuntimeError) or unsupported (NotImplementedError) archives
+ARCHIVE_ERRORS = (zipfile.BadZipFile, zipfile.LargeZipFile, RuntimeError, NotImplementedError, EOFError, zlib.error)
+
+
+def extract_text(data):
+    """Text of the file, members of a zip archive are concatenated in the order of names
+
+    raises: one of ARCHIVE_ERRORS if the archive can not be read
+    """
+    if zipfile.is_zipfile(io.BytesIO(data)):
+        parts = []
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            for info in sorted(archive.infolist(), key=lambda i: i.filename):
+                if info.is_dir() or info.file_size > MAX_MEMBER_SIZE or '__MACOSX' in info.filename:
+                    continue
+                parts.append(archive.read(info).decode('utf-8', errors='ignore'))
+        return '\n'.join(parts)
+    return data.decode('utf-8', errors='ignore')
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    """Hashes of consecutive token sequences, renaming files or reformatting does not change them"""
+    tokens = _TOKEN.findall(text.lower())
+    if len(tokens) < size:
+        tokens += [''] * (size - len(tokens))
+    return {int.from_bytes(hashlib.blake2b(' '.join(tokens[i:i + size]).encode(), digest_size=8).digest(), 'big')
+            for i in range(len(tokens) - size + 1)}
+
+
+def minhash(shingle_hashes):
+    """returns: list of N_PERMUTATIONS ints"""
+    if not shingle_hashes:
+        return [_MASK] * N_PERMUTATIONS
+    return [min((a * x + b) % _PRIME for x in shingle_hashes) for a, b in _PERMUTATIONS]
+
+
+def estimate_similarity(signature1, signature2):
+    """Estimated Jaccard similarity of the shingle sets"""
+    return sum(x == y for x, y in zip(signature1, signature2)) / len(signature1)
+
+
+def lsh_candidates(signatures, n_bands=N_BANDS):
+    """Pairs of keys whose signatures are equal in at least one band
+
+    - signatures: dict(key: signature)
+    returns: set of (key1, key2)
+    """
+    rows = len(next(iter(signatures.values()))) // n_bands if signatures else 0
+    candidates = set()
+    for band in range(n_bands):
+        buckets = defaultdict(list)
+        for key, signature in signatures.items():
+            buckets[tuple(signature[band * rows:(band + 1) * rows])].append(key)
+        for keys in buckets.values():
+            if len(keys) > 1:
+                candidates.update(combinations(sorted(keys), 2))
+    return candidates
+
+
+def ingest_task(cache, workshop_number, task_number):
+    """Index submissions of the task which are in the file cache and not indexed yet
+
+    A submission which can not be read is skipped, the others are indexed.
+    returns: dict(indexed=int, already_indexed=int, not_cached=[file_id], unreadable={file_id: error})
+    """
+    same_task = {'workshop_number': workshop_number, 'task_number': task_number}
+    indexed = {(d['_id'], d['file_id']) for d in TasksDB._db.submission_index.find(same_task, {'file_id': 1})}
+    report = {'indexed': 0, 'already_indexed': 0, 'not_cached': [], 'unreadable': {}}
+    batch = []
+    for task in TasksDB._db.task.find(same_task, {'user_id': 1, 'file_info': 1}):
+        file_id = (task.get('file_info') or {}).get('file_id')
+        if (task['_id'], file_id) in indexed:
+            report['already_indexed'] += 1
+            continue
+        cached = cache.get(file_id)
+        if cached is None:
+            report['not_cached'].append(file_id)
+            continue
+        path = cached[0]
+        try:
+            # the file may be evicted from the cache after the lookup
+            with open(path, 'rb') as f:
+                data = f.read()
+            text = extract_text(data)
+        except (OSError, *ARCHIVE_ERRORS) as e:
+            logger.warning(f'Submission {file_id} of task {workshop_number}.{task_number} is not indexed: {e!r}')
+            report['unreadable'][file_id] = repr(e)
+            continue
+        batch.append(UpdateOne({'_id': task['_id']}, {'$set': {
+            **same_task,
+            'user_id': task['user_id'],
+            'file_id': file_id,
+            # the cache is content addressed, the object name is the hash
+            'sha256': os.path.basename(path),
+            'minhash': minhash(shingles(text)),
+        }}, upsert=True))
+        report['indexed'] += 1
+    if batch:
+        TasksDB._db.submission_index.bulk_write(batch, ordered=False)
+    return report
+
+
+def detect_task(workshop_number, task_number, threshold=0.8):
+    """Find identical and similar submissions of the task and save them to task.similarity
+
+    returns: list of (user_id1, user_id2, score), score is 1. for identical files
+    """
+    same_task = {'workshop_number': workshop_number, 'task_number': task_number}
+    entries = list(TasksDB._db.submission_index.find(same_task, {'user_id': 1, 'sha256': 1, 'minhash': 1}))
+    user_of = {e['_id']: e['user_id'] for e in entries}
+
+    by_hash = defaultdict(list)
+    for entry in entries:
+        by_hash[entry['sha256']].append(entry['_id'])
+    duplicates = defaultdict(set)
+    pairs = {}
+    for task_ids in by_hash.values():
+        for id1, id2 in combinations(sorted(task_ids), 2):
+            duplicates[id1].add(id2)
+            duplicates[id2].add(id1)
+            pairs[(id1, id2)] = 1.
+
+    signatures = {e['_id']: e['minhash'] for e in entries}
+    similar = defaultdict(dict)
+    for id1, id2 in lsh_candidates(signatures):
+        if (id1, id2) in pairs:
+            continue
+        score = estimate_similarity(signatures[id1], signatures[id2])
+        if score >= threshold:
+            similar[id1][id2] = similar[id2][id1] = score
+            pairs[(id1, id2)] = score
+
+    checked_at = datetime.now()
+    batch = [UpdateOne({'_id': task_id}, {'$set': {'similarity': {
+        'duplicates': sorted(user_of[i] for i in duplicates[task_id]),
+        'similar': [{'user_id': user_of[i], 'score': round(score, 3)}
+                    for i, score in sorted(similar[task_id].items(), key=lambda item: -item[1])],
+        'checked_at': checked_at,
+    }}}) for task_id in user_of]
+    if batch:
+        TasksDB._db.task.bulk_write(batch, ordered=False)
+    return sorted(((user_of[id1], user_of[id2], score) for (id1, id2), score in pairs.items()),
+                  key=lambda pair: -pair[2])
@@ -1,11 +1,15 @@
 import os
 import sys
+import time
+import asyncio
 import logging
 import traceback
-from datetime import datetime
+import functools
+from datetime import datetime, timedelta
 
 import telebot
-from peer_review_bot import config, utils, datautils
+from peer_review_bot import (config, utils, datautils, async_runtime, webhook, sender, transport, metrics, profiling,
+                             jobs, courses, schedule, commands)
 from peer_review_bot.dbutils import TasksDB
 from peer_review_bot.data_structures import User, Document, DialogState
 
@@ -23,36 +27,119 @@ logger.addHandler(consoleHandler)
 
 
 # -- bot starts here
-bot = telebot.TeleBot(config.token)
+# async and webhook runtimes order updates themselves, handlers should run in their threads
+if not config.token:
+    raise RuntimeError('Set PRB_TOKEN to the token of the bot')
+if config.runtime == 'webhook' and not config.webhook_url:
+    raise RuntimeError('Set PRB_WEBHOOK_URL to the public url of the server to use PRB_RUNTIME=webhook')
+bot = telebot.TeleBot(config.token, threaded=config.runtime == 'polling')
 if config.use_proxy:
     telebot.apihelper.proxy = {'https': config.proxy}
+telebot.apihelper.API_URL = config.api_url + '/bot{0}/{1}'
+telebot.apihelper.FILE_URL = config.api_url + '/file/bot{0}/{1}'
+
+# one keep-alive connection pool for all threads instead of a session per thread
+api_sender = transport.PooledSender(pool_size=config.api_pool_size,
+                                    connect_timeout=config.api_connect_timeout,
+                                    read_timeout=config.api_read_timeout,
+                                    retries=config.api_retries)
+telebot.apihelper.CUSTOM_REQUEST_SENDER = api_sender
+# telebot passes these to the sender unless a call sets its own timeout
+telebot.apihelper.CONNECT_TIMEOUT = config.api_connect_timeout
+telebot.apihelper.READ_TIMEOUT = config.api_read_timeout
+
+# handlers send replies through the outbox, it merges them and keeps the rate limits
+outbox = sender.Outbox(bot,
+                       per_chat_rate=config.outbox_per_chat_rate,
+                       chat_burst=config.outbox_chat_burst,
+                       global_rate=config.outbox_global_rate,
+                       linger=config.outbox_linger,
+                       n_workers=config.outbox_workers)
 
 # we use telegram id as state tracker idenficicator
 # this is a good idea
 
+metrics.register(metrics.Gauge('prb_outbox_messages', 'Messages handled by the outbox', lambda: {
+    ('sent',): outbox.n_sent, ('merged',): outbox.n_merged, ('failed',): outbox.n_failed}, ['result']))
+metrics.register(metrics.Gauge('prb_api_connection_reuse_ratio', 'Share of Bot API requests sent over an open '
+                               'connection', lambda: api_sender.stats()['reuse_ratio']))
 
-@bot.message_handler(commands=['start'])
-def register(message):
-    bot.send_message(message.chat.id, 'Hi!')
+profiler = profiling.Profiler(rate=config.profile_rate, profile_dir=config.profile_dir,
+                              dump_interval=config.profile_dump_interval)
+if profiler.enabled:
+    profiler.instrument(TasksDB)
+
+
+router = commands.Router()
+
+
+def select_course(message):
+    """Course of the sender, /start <course_id> joins the course
+
+    returns: course_id or None if the sender has not joined any course
+    """
+    command, args_text = commands.split(message.text)
+    if command == 'start' and args_text and len(courses.all_courses()) > 1:
+        try:
+            courses.join(message.from_user.id, args_text)
+        except courses.UnknownCourse:
+            pass
+    return courses.course_of(message.from_user.id)
+
+
+def request_scoped(handler):
+    """Handle the update in the sender's course, share user documents between TasksDB calls
+    of one update, record latency, errors and mongo usage"""
+    @functools.wraps(handler)
+    def wrapper(message, *args):
+        name = handler.__name__
+        start = time.perf_counter()
+        course_id = select_course(message)
+        if course_id is None:
+            outbox.send_message(message.chat.id, config.choose_course_error.format(
+                courses=', '.join(c.course_id for c in courses.all_courses())))
+            return
+        with courses.use(course_id), TasksDB.request_scope() as scope, profiler.update(name, message.text):
+            try:
+                return handler(message, *args)
+            except Exception as e:
+                metrics.handler_errors.inc(name, type(e).__name__)
+                raise
+            finally:
+                metrics.handler_latency.observe(time.perf_counter() - start, name)
+                metrics.mongo_commands.observe(scope.n_round_trips, name)
+                metrics.mongo_seconds.inc(name, amount=scope.mongo_seconds)
+                metrics.user_cache_hits.inc(name, amount=scope.n_cache_hits)
+                logger.debug(f'{name}: {scope.n_round_trips} mongo round trips, '
+                             f'{scope.n_cache_hits} cached user lookups')
+    return wrapper
+
+
+@router.route('start')
+@request_scoped
+def register(message, args):
+    outbox.send_message(message.chat.id, 'Hi!')
     # TODO: move db logic to db
     try:
         TasksDB.get_user_info(User.from_telegram(message.from_user))
-        bot.send_message(message.chat.id, config.registered_error)
+        outbox.send_message(message.chat.id, config.registered_error)
     except RuntimeError:
         # TODO: this is bad idea, use if (?)
-        bot.send_message(message.chat.id, config.registration_message)
+        outbox.send_message(message.chat.id, config.registration_message)
         datautils.set_user_state(message.from_user.id, DialogState('registration'))
         return
-    bot.send_message(message.chat.id, config.help_message)
+    outbox.send_message(message.chat.id, config.help_message)
 
 
-@bot.message_handler(commands=['help'])
-def help(message):
-    bot.send_message(message.chat.id, config.help_message)
+@router.route('help')
+@request_scoped
+def help(message, args):
+    outbox.send_message(message.chat.id, config.help_message)
 
 
-@bot.message_handler(commands=['info'])
-def info(message):
+@router.route('info')
+@request_scoped
+def info(message, args):
     """Debug message"""
     user_tgid = message.from_user.id
     state = datautils.get_user_state(user_tgid)
@@ -63,47 +150,42 @@ def info(message):
     except RuntimeError as e:
         logger.error(f'Chat_id: {message.chat.id}, error: {e}')
         logger.error(traceback.format_exc())
-        bot.send_message(message.chat.id, e)
+        outbox.send_message(message.chat.id, e)
         return
     if user_info is not None:
         info.update(user_info)
-    bot.send_message(message.chat.id, repr(info))
+    outbox.send_message(message.chat.id, repr(info))
 
 
-@bot.message_handler(commands=['sudo'], func=lambda x: os.environ.get('PRB_STAGE') == 'test')
-def sudo(message):
-    _, tg_user_id, command_str = message.text.split(' ')
-    message.from_user.id = int(tg_user_id)
-    command = f'{command_str}(message)'
-    exec(command)
+def sudo(message, args):
+    """Handle the command as another user, /sudo <tg_id> get_scores"""
+    message.from_user.id = args['tg_id']
+    message.text = f'/{args["command"]}'
+    dispatch(message)
 
 
-@bot.message_handler(commands=['send_task'])
-def send_task(message):
-    """Set user state to sending_task with workshop, task"""
-    if message.text == '/send_task':
-        bot.send_message(message.chat.id, config.send_task_help_message, parse_mode='markdown')
-        return
-
-    res = utils.check_workshop_task_from(message, bot, logger)
-    if res is None:
-        return
+if os.environ.get('PRB_STAGE') == 'test':
+    router.route('sudo')(sudo)
 
-    workshop, task = res
-    deadline = config.deadlines.get(workshop)
 
-    if deadline is None:
-        bot.send_message(message.chat.id, 'No specified deadline for this workshop. Ask admin.')
+@router.route('send_task')
+@request_scoped
+def send_task(message, args):
+    """Set user state to sending_task with workshop, task"""
+    workshop, task = args['workshop'], args['task']
+    if not utils.check_workshop_task(message, workshop, task, outbox):
         return
 
     has_sent_previous = TasksDB.check_task_order(User.from_telegram(message.from_user), workshop, task)
     if not has_sent_previous:
-        bot.send_message(message.chat.id, config.order_error)
+        outbox.send_message(message.chat.id, config.order_error)
         return
 
-    n_late = utils.late_days(deadline)
+    course_schedule = schedule.current()
+    n_late = course_schedule.late_days(workshop, task, message.from_user.id)
     if n_late is None:
-        bot.send_message(message.chat.id, config.deadline_message.format(max_late=config.max_late))
+        outbox.send_message(message.chat.id, config.deadline_message.format(
+            max_late=course_schedule.slot(workshop, task).max_late))
         return
 
     datautils.set_user_state(message.from_user.id, DialogState('sending_task', workshop, task, n_late))
@@ -111,85 +193,75 @@ def send_task(message):
 
     if n_late > 0:
         answer += '\n' + f'*{n_late} late days* will be used'
-    bot.send_message(message.chat.id, answer, parse_mode='markdown')
+    outbox.send_message(message.chat.id, answer, parse_mode='markdown')
 
 
-@bot.message_handler(commands=['get_gradable'])
-def get_gradable(message):
+@router.route('get_gradable')
+@request_scoped
+def get_gradable(message, args):
     try:
         gradable = TasksDB.get_gradable(
             User.from_telegram(message.from_user)
         )
     except (ValueError, RuntimeError) as e:
-        bot.send_message(message.chat.id, e)
-        bot.send_message(message.chat.id, 'Probably, you are not registered')
+        outbox.send_message(message.chat.id, e)
+        outbox.send_message(message.chat.id, 'Probably, you are not registered')
         return
     if not gradable:
-        bot.send_message(message.chat.id, 'No gradable tasks for now')
+        outbox.send_message(message.chat.id, 'No gradable tasks for now')
         return
 
     repr_gradable = utils.format_gradable(gradable)
-    bot.send_message(message.chat.id, repr_gradable)
+    outbox.send_message(message.chat.id, repr_gradable)
 
 
-@bot.message_handler(commands=['get_graders'])
-def get_graders(message):
+@router.route('get_graders')
+@request_scoped
+def get_graders(message, args):
     try:
         graders = TasksDB.get_graders(
             User.from_telegram(message.from_user)
         )
     except (ValueError, RuntimeError) as e:
-        bot.send_message(message.chat.id, e)
-        bot.send_message(message.chat.id, 'Probably, you are not registered')
+        outbox.send_message(message.chat.id, e)
+        outbox.send_message(message.chat.id, 'Probably, you are not registered')
         return
     if not graders:
-        bot.send_message(message.chat.id, 'No graders for your tasks')
+        outbox.send_message(message.chat.id, 'No graders for your tasks')
         return
 
     repr_graders = utils.format_gradable(graders)
-    bot.send_message(message.chat.id, repr_graders)
+    outbox.send_message(message.chat.id, repr_graders)
 
 
-@bot.message_handler(commands=['get_task'])
-def get_task(message):
+@router.route('get_task')
+@request_scoped
+def get_task(message, args):
     """Get a task to grade
     syntax: /get_task @username 1.4
     """
     user = User.from_telegram(message.from_user)
+    workshop, task = args['workshop'], args['task']
 
-    # 1. parse the message
-    # standard try-except-except for parsing handling
-    try:
-        graded_tg_username, workshop, task = utils.parse_get_task_message(message.text)
-    except (ValueError, UnboundLocalError):
-        logger.warning(f'Chat_id: {message.chat.id}, user: {message.from_user.username}'
-                       f', #wrong_format: {message.text}')
-        bot.send_message(message.chat.id, config.wrong_format_error)
-        bot.send_message(message.chat.id, config.get_task_format_message, parse_mode='markdown')
-        return
-    except Exception:
-        bot.send_message(message.chat.id, config.just_error)
-        return
-
-    # 2. check that user can get this task
-    # 3. get this task
-    graded = User(tg_username=graded_tg_username)
+    # check that user can get this task and get it
+    graded = User(tg_username=args['tg_username'])
     try:
         file_id = TasksDB.get_task(user, graded, workshop, task)
     except RuntimeError as e:
-        bot.send_message(message.chat.id, e)
+        outbox.send_message(message.chat.id, e)
         return
     except Exception as e:
         logger.error(f'Chat_id: {message.chat.id}, user: {message.from_user.username}'
                      f', error: {e}, traceback: {traceback.format_exc()}')
-        bot.send_message(message.chat.id, config.just_error)
+        outbox.send_message(message.chat.id, config.just_error)
         return
 
-    bot.send_document(message.chat.id, file_id)
+    outbox.send_document(message.chat.id, file_id)
 
 
-@bot.message_handler(commands=['get_scores'])
-def get_scores(message):
+@router.route('get_scores')
+@request_scoped
+def get_scores(message, args):
     """Get scores of all tasks for given user"""
     user = User.from_telegram(message.from_user)
     try:
@@ -197,141 +269,219 @@ def get_scores(message):
     except Exception as e:
         logger.error(f'Chat_id: {message.chat.id}, user: {message.from_user.username}'
                      f', error: {e}, , traceback: {traceback.format_exc()}')
-        bot.send_message(message.chat.id, config.just_error)
+        outbox.send_message(message.chat.id, config.just_error)
         return
 
     if not scores:
-        bot.send_message(message.chat.id, 'No scores available for now')
+        outbox.send_message(message.chat.id, 'No scores available for now')
         return
 
     repr_scores = utils.format_scores(scores)
-    bot.send_message(message.chat.id, repr_scores)
+    outbox.send_message(message.chat.id, repr_scores)
 
 
-@bot.message_handler(commands=['late_days'])
-def get_late_days(message):
+@router.route('late_days')
+@request_scoped
+def get_late_days(message, args):
     """Return to user number of late days left"""
     user_info = TasksDB.get_user_info(User.from_telegram(message.from_user))
-    n_days = user_info.get('late_days', config.default_late_days)
+    n_days = user_info.get('late_days', courses.current().default_late_days)
     if n_days is None:
-        n_days = config.default_late_days
-    bot.send_message(message.chat.id, f'You have *{n_days}* late days left.', parse_mode='markdown')
+        n_days = courses.current().default_late_days
+    outbox.send_message(message.chat.id, f'You have *{n_days}* late days left.', parse_mode='markdown')
 
 
-@bot.message_handler(commands=['grade'])
-def grade(message):
-    try:
-        score_dict = utils.parse_grade_message(message.text)
-    except (ValueError, UnboundLocalError):
-        bot.send_message(message.chat.id, config.grade_format_message, parse_mode='markdown')
-        return
-    except Exception as e:
-        logger.error(f'Chat_id: {message.chat.id}, user: {message.from_user.username}'
-                     f', error: {e}')
-        bot.send_message(message.chat.id, e)
+@router.route('grade')
+@request_scoped
+def grade(message, args):
+    if 'lines' in args:
+        grade_lines(message, args['lines'])
         return
 
     # TODO: user should have initialization from db(?)
     # lazy init if the param is unavailable
     user = User.from_telegram(message.from_user)
-    graded = User(tg_username=score_dict['tg_username'])
+    graded = User(tg_username=args['tg_username'])
     try:
         TasksDB.add_score(user,
                           graded,
-                          score_dict['workshop_number'],
-                          score_dict['task_number'],
-                          score_dict['score'])
+                          args['workshop'],
+                          args['task'],
+                          args['score'])
     except (ValueError, RuntimeError) as e:
-        bot.send_message(message.chat.id, repr(e))
+        outbox.send_message(message.chat.id, repr(e))
         return
     except Exception as e:
-        bot.send_message(message.chat.id, config.just_error)
+        outbox.send_message(message.chat.id, config.just_error)
         logger.error(f'Chat_id: {message.chat.id}, user: {message.from_user.username}'
                      f', error: {e}')
-        bot.send_message(config.logto, e)
+        outbox.send_message(config.logto, e)
         return
 
-    bot.send_message(message.chat.id, config.success_message)
+    outbox.send_message(message.chat.id, config.success_message)
 
 
-@bot.message_handler(commands=['cancel'])
-def cancel(message):
-    datautils.set_user_state(message.from_user.id, DialogState(None))
+def grade_lines(message, lines):
+    """Record scores of a batch, reply with the result of every line
 
+    - lines: list of (line, args or commands.ParseError)
+    """
+    valid = [args for _, args in lines if not isinstance(args, commands.ParseError)]
+    try:
+        errors = iter(TasksDB.add_scores(User.from_telegram(message.from_user), valid))
+    except RuntimeError as e:
+        outbox.send_message(message.chat.id, str(e))
+        return
 
-@bot.message_handler(content_types=['text'])
-def answer(message):
-    # TODO: change ifs to lambda filters
-    tg_user = message.from_user
-    state = datautils.get_user_state(tg_user.id)
-
-    if state.action == 'registration':
-        user = User.from_telegram(tg_user)
-        if user.tg_username is None:
-            bot.send_message(
-                message.chat.id,
-                'Please, create a telegram username and call /start again')
-            datautils.set_user_state(user.tg_id, DialogState(None))
-            return
+    n_recorded = 0
+    for line, args in lines:
+        error = args.reason if isinstance(args, commands.ParseError) else next(errors)
+        n_recorded += error is None
+        outbox.send_message(message.chat.id, f'{line}: {error or config.success_message}')
+    outbox.send_message(message.chat.id, config.batch_graded_message.format(n_recorded=n_recorded, n=len(lines)))
 
-        user.username = message.text
 
-        TasksDB.register_new_user(user)
+def grade_file(message):
+    """/grade in the caption of a CSV file: username, task, score per row"""
+    if message.document.file_size and message.document.file_size > config.max_grades_file_bytes:
+        outbox.send_message(message.chat.id, config.grades_file_error)
+        return
+    file_path = bot.get_file(message.document.file_id).file_path
+    try:
+        text = bot.download_file(file_path).decode('utf-8-sig')
+    except UnicodeDecodeError:
+        outbox.send_message(message.chat.id, config.grades_file_error)
+        return
+    grade_lines(message, commands.COMMANDS['grade'].parse_lines(commands.csv_lines(text)))
+
+
+@router.route('cancel')
+@request_scoped
+def cancel(message, args):
+    datautils.set_user_state(message.from_user.id, DialogState(None))
+
+
+@router.route(None, 'registration')
+@request_scoped
+def finish_registration(message, args):
+    user = User.from_telegram(message.from_user)
+    if user.tg_username is None:
+        outbox.send_message(
+            message.chat.id,
+            'Please, create a telegram username and call /start again')
         datautils.set_user_state(user.tg_id, DialogState(None))
-        bot.send_message(message.chat.id, config.registered_message)
         return
 
+    user.username = args['text']
+
+    TasksDB.register_new_user(user)
+    datautils.set_user_state(user.tg_id, DialogState(None))
+    outbox.send_message(message.chat.id, config.registered_message)
+
+
+@router.route(None)
+@request_scoped
+def answer(message, args):
+    """Free text outside of a dialog is ignored"""
+
+
+def user_state(message):
+    """Dialog state of the sender, for routes which depend on it"""
+    course_id = courses.course_of(message.from_user.id)
+    if course_id is None:
+        return None
+    with courses.use(course_id):
+        return datautils.get_user_state(message.from_user.id).action
+
+
+@bot.message_handler(content_types=['text'])
+def dispatch(message):
+    """Route every text message, commands are parsed by the grammar of commands.py"""
+    try:
+        router.dispatch(message, user_state)
+    except commands.ParseError as e:
+        metrics.handler_errors.inc(e.command, type(e).__name__)
+        logger.warning(f'Chat_id: {message.chat.id}, user: {message.from_user.username}'
+                       f', #wrong_format: {e.reason}')
+        outbox.send_message(message.chat.id, f'{config.wrong_format_error} {e.reason}')
+        if e.usage:
+            outbox.send_message(message.chat.id, e.usage, parse_mode='markdown')
+
 
 @bot.message_handler(content_types=['document'])
+@request_scoped
 def recieve_task(message):
+    if commands.split(message.caption)[0] == 'grade':
+        grade_file(message)
+        return
+
     # extract workshop number and task number
     state = datautils.get_user_state(message.from_user.id)
     if state.action == 'sending_task':
         workshop, task = state.workshop, state.task
     else:
-        bot.send_message(message.chat.id, config.wrong_format_error)
-        bot.send_message(message.chat.id, config.send_task_help_message)
+        outbox.send_message(message.chat.id, config.wrong_format_error)
+        outbox.send_message(message.chat.id, config.send_task_help_message)
         return
 
     # write to db
     document = Document.from_telegram(message.document)
     user = User.from_telegram(message.from_user)
     try:
-        res = TasksDB.add_task(user, workshop, task, document)
+        res = TasksDB.add_task(user, workshop, task, document, late_days=state.n_late)
     except RuntimeError as e:
         logger.error(f'Chat_id: {message.chat.id}, user: {message.from_user.username}'
                      f', #runtime_error: {e}')
-        bot.send_message(message.chat.id, str(e))
+        outbox.send_message(message.chat.id, str(e))
         return
 
     if not res.acknowledged:
-        bot.send_message(message.chat.id, config.just_error)
+        outbox.send_message(message.chat.id, config.just_error)
         return
 
     if state.n_late > 0:
         try:
             days_left = TasksDB.use_late_days(user, state.n_late)
         except ValueError as e:
-            bot.send_message(message.chat.id, e)
+            outbox.send_message(message.chat.id, e)
             return
-        bot.send_message(message.chat.id,
-                         f'You have spent *{state.n_late}* late days. *{days_left}* left',
-                         parse_mode='markdown')
+        outbox.send_message(message.chat.id,
+                            f'You have spent *{state.n_late}* late days. *{days_left}* left',
+                            parse_mode='markdown')
 
-    bot.send_message(message.chat.id, config.task_accepted.format(workshop=workshop, task=task))
+    outbox.send_message(message.chat.id, config.task_accepted.format(workshop=workshop, task=task))
     datautils.set_user_state(message.from_user.id, DialogState(None))
 
     # add and find scorers
     graded = TasksDB.add_graders(user, workshop, task)
     if graded:
-        bot.send_message(message.chat.id, config.list_of_people_to_grade_message.format(graded=graded))
+        outbox.send_message(message.chat.id, config.list_of_people_to_grade_message.format(graded=graded))
         return
-    bot.send_message(message.chat.id, 'No users to grade for now. Type /get_gradable later')
+    outbox.send_message(message.chat.id, 'No users to grade for now. Type /get_gradable later')
 
 
 def init_telegram_ui():
+    for course in courses.all_courses():
+        with courses.use(course.course_id):
+            for collection, report in TasksDB.ensure_indexes().items():
+                logger.info(f'Indexes of {collection} of {course.course_id}: {report}')
+                if report['failed']:
+                    logger.error(f'Failed to create indexes of {collection} of {course.course_id}: '
+                                 f'{report["failed"]}')
+    profiler.start()
+    jobs.StaleGraderJob(outbox, timedelta(days=config.stale_grader_days), config.stale_check_interval).start()
+    jobs.MaintenanceJob(config.maintenance_interval).start()
+
     try:
-        bot.polling(none_stop=True)
+        if config.runtime != 'webhook':
+            # the webhook server answers /metrics itself
+            metrics.serve_in_background(config.metrics_host, config.metrics_port)
+        if config.runtime == 'async':
+            run_async()
+        elif config.runtime == 'webhook':
+            run_webhook()
+        else:
+            bot.polling(none_stop=True)
     except Exception as e:
         logger.error(f'Bot has crashed, error: {e}')
         logger.error(traceback.format_exc())
@@ -340,3 +490,32 @@ def init_telegram_ui():
         traceback.print_exc()
         bot.send_message(config.logto, traceback.format_exc())
         raise e
+
+
+def process_update(update):
+    """Handle one update (dict in the Bot API format) in the current thread"""
+    bot.process_new_updates([telebot.types.Update.de_json(update)])
+
+
+def run_async(stop=None):
+    proxy = config.proxy if config.use_proxy else None
+    asyncio.run(async_runtime.run(process_update, config.token, config.api_url, proxy,
+                                  max_workers=config.async_workers,
+                                  max_pending=config.async_max_pending,
+                                  polling_timeout=config.polling_timeout,
+                                  stop=stop))
+
+
+def run_webhook():
+    # the token in the path lets only telegram post updates
+    path = f'/{config.token}'
+    pool = webhook.ShardedWorkerPool(process_update, config.webhook_workers, config.webhook_queue_size)
+    server = webhook.make_server(pool, config.webhook_host, config.webhook_port, path, config.webhook_secret)
+    bot.remove_webhook()
+    bot.set_webhook(url=config.webhook_url + path, secret_token=config.webhook_secret)
+    logger.info(f'Listening for webhooks on {config.webhook_host}:{config.webhook_port}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        pool.shutdown()
@@ -0,0 +1,105 @@
+"""Shared HTTP session for Bot API calls
+
+pyTelegramBotAPI keeps a requests session per thread, so every handler
+thread and the outbox open their own TLS connections through the proxy.
+PooledSender is installed as apihelper.CUSTOM_REQUEST_SENDER and sends all
+calls through one session with a bounded keep-alive connection pool.
+"""
+import time
+import threading
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from peer_review_bot import metrics
+
+
+class LatencyStats:
+    def __init__(self, window=1000):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.recent = deque(maxlen=window)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.recent.append(seconds)
+
+    def summary(self):
+        recent = sorted(self.recent)
+        return {'count': self.count,
+                'mean_ms': 1000 * self.total / self.count if self.count else 0.,
+                'p50_ms': 1000 * recent[len(recent) // 2] if recent else 0.,
+                'p99_ms': 1000 * recent[int(len(recent) * 0.99)] if recent else 0.,
+                'max_ms': 1000 * self.max}
+
+
+class PooledSender:
+    """
+    - pool_size: max number of kept-alive connections per host (or proxy)
+    - connect_timeout, read_timeout: seconds, used when the caller does not pass a timeout
+    - retries: retries of failed connections, and of 502/503/504 answers to idempotent (GET) requests;
+      a POST (sendMessage, sendDocument) which may have reached the server is not retried
+      to avoid duplicate messages
+    """
+    def __init__(self, pool_size=16, connect_timeout=5., read_timeout=30., retries=3, backoff=0.3):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        retry = Retry(total=retries, connect=retries, read=0, status=retries,
+                      status_forcelist=(502, 503, 504), allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+                      backoff_factor=backoff, raise_on_status=False)
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+        self._latency = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        # telebot passes (connect, read), getUpdates with a read timeout longer than the long polling time
+        if timeout is None:
+            timeout = (self.connect_timeout, self.read_timeout)
+
+        start = time.perf_counter()
+        try:
+            return self.session.request(method, url, params=params, files=files,
+                                        timeout=timeout, proxies=proxies)
+        finally:
+            api_method = url.rsplit('/', 1)[-1]
+            seconds = time.perf_counter() - start
+            metrics.api_latency.observe(seconds, api_method)
+            with self._lock:
+                stats = self._latency.get(api_method)
+                if stats is None:
+                    stats = self._latency[api_method] = LatencyStats()
+                stats.add(seconds)
+
+    def _pools(self):
+        managers = [self.adapter.poolmanager, *self.adapter.proxy_manager.values()]
+        for manager in managers:
+            for key in list(manager.pools.keys()):
+                pool = manager.pools.get(key)
+                if pool is not None:
+                    yield pool
+
+    def stats(self):
+        """Connection reuse and latency of Bot API calls
+
+        reuse_ratio is the share of requests sent over an already open connection
+        """
+        n_requests = n_connections = 0
+        for pool in self._pools():
+            n_requests += pool.num_requests
+            n_connections += pool.num_connections
+        with self._lock:
+            latency = {method: stats.summary() for method, stats in self._latency.items()}
+        return {'requests': n_requests,
+                'connections': n_connections,
+                'reuse_ratio': 1 - n_connections / n_requests if n_requests else 0.,
+                'latency': latency}
@@ -1,54 +1,5 @@
-from datetime import datetime
 from collections import defaultdict
-from peer_review_bot import config
-
-
-def parse_task_number(message_text):
-    """3.4 --> 3, 4"""
-    workshop, task = message_text.strip('\n').strip(' ').split('.')
-    workshop, task = int(workshop), int(task)
-    return workshop, task
-
-
-def parse_grade_message(message_text):
-    """/grade_task @username 1.4 10"""
-    _, username, task_str, score = message_text.strip('\n').strip(' ').split(' ')
-    username = username.strip('@')
-    workshop, task = parse_task_number(task_str)
-    score = int(score)
-    if not (0 <= score <= 10):
-        raise ValueError('Score is not an integer between 0 and 10')
-    return {'tg_username': username, 'workshop_number': workshop, 'task_number': task, 'score': score}
-
-
-def parse_send_task(message_text):
-    workshop, task = message_text.strip('\n').strip(' ').split(' ')[1].split('.')
-    workshop, task = int(workshop), int(task)
-    return workshop, task
-
-
-def parse_get_task_message(message_text):
-    """/get_task @username 1.4"""
-    _, username, task_str = message_text.strip('\n').strip(' ').split(' ')
-    username = username.strip('@')
-    workshop, task = parse_task_number(task_str)
-    return username, workshop, task
-
-
-def parse_send_task_message(message_text):
-    """/send_task 1.4 -> workshop, task"""
-    _, task_str = message_text.strip('\n').strip(' ').split(' ')
-    workshop, task = parse_task_number(task_str)
-    return workshop, task
-
-
-def late_days(deadline):
-    delta = (datetime.now() - deadline).days
-    if delta <= 0:
-        return 0
-    if 0 < delta <= config.max_late:
-        return delta
-    return None
+from peer_review_bot import config, schedule
 
 
 def format_gradable(gradable):
@@ -117,46 +68,40 @@ def format_scores(scores):
     return res
 
 
-def check_workshop_task_from(message, bot, logger=None):
-    try:
-        workshop, task = parse_send_task_message(message.text)
-    except (ValueError, UnboundLocalError):
-        if logger:
-            logger.warning(f'Chat_id: {message.chat.id}, user: {message.from_user.username}'
-                           f', #wrong_format: {message.text}')
-        bot.send_message(message.chat.id, config.wrong_format_error)
-        return
-    except Exception as e:
-        if logger:
-            logger.error(f'Chat_id: {message.chat.id}, user: {message.from_user.username}'
-                         f', error: {e}')
-        bot.send_message(message.chat.id, e)
-        return
-
-    if workshop > len(config.deadlines):
+def chat_id_of(update):
+    """Chat of the update (dict in the Bot API format), None if the update has no chat"""
+    for key in ('message', 'edited_message', 'callback_query'):
+        item = update.get(key)
+        if item is None:
+            continue
+        if key == 'callback_query':
+            item = item.get('message') or {}
+        chat = item.get('chat')
+        if chat is not None:
+            return chat['id']
+    return None
+
+
+def check_workshop_task(message, workshop, task, bot):
+    """Check that the task is in the schedule, tell the user if it is not
+
+    returns: bool
+    """
+    course_schedule = schedule.current()
+    if workshop not in course_schedule.workshops:
         bot.send_message(message.chat.id, config.wrong_format_error)
-        bot.send_message(message.chat.id, 'this workshop has not started yet')
-        return
+        bot.send_message(message.chat.id, config.workshop_not_started_error)
+        return False
 
-    # TODO: hardcode
-    if task > 7:
+    if course_schedule.slot(workshop, task) is None:
         bot.send_message(message.chat.id, config.wrong_format_error)
-        bot.send_message(message.chat.id, 'are you sure this task exists? Contact admins')
-        return
+        bot.send_message(message.chat.id, config.no_such_task_error)
+        return False
 
-    return workshop, task
+    return True
 
 
 if __name__ == "__main__":
-    res = parse_task_number(' 3.4 ')
-    assert 3, 4 == res
-
-    res = parse_grade_message('/grade_task @username 1.4 10')
-    assert res['tg_username'] == 'username', res
-    assert res['workshop_number'] == 1, res
-    assert res['task_number'] == 4, res
-    assert res['score'] == 10, res
-
     print('Format scores result:')
     print(format_scores([
         {'workshop_number': 1, 'task_number': 1, 'score': 7.5},
@@ -0,0 +1,119 @@
+"""Webhook runtime: telegram sends updates over HTTP, a pool of threads handles them
+
+Updates are sharded between workers by chat, so updates of one user are
+handled in order by the same worker. Each worker has a bounded queue; when
+it is full the server answers 503 and telegram retries the update later.
+"""
+import json
+import queue
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from peer_review_bot import metrics
+from peer_review_bot.utils import chat_id_of
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedWorkerPool:
+    """Worker threads with one bounded queue each
+
+    - process_update: function(update_dict), called in a worker thread
+    - n_workers: number of threads
+    - queue_size: max number of waiting updates per worker
+    """
+    def __init__(self, process_update, n_workers=16, queue_size=64):
+        self._process_update = process_update
+        self._queues = [queue.Queue(queue_size) for _ in range(n_workers)]
+        self._threads = [threading.Thread(target=self._work, args=(q,), name=f'webhook-worker-{i}', daemon=True)
+                         for i, q in enumerate(self._queues)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, update):
+        """Put the update to the queue of its chat's worker
+
+        raises: queue.Full if the worker is saturated
+        """
+        chat_id = chat_id_of(update)
+        shard = hash(chat_id if chat_id is not None else update.get('update_id')) % len(self._queues)
+        self._queues[shard].put_nowait(update)
+
+    def qsize(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def _work(self, updates):
+        while True:
+            update = updates.get()
+            if update is None:
+                updates.task_done()
+                return
+            try:
+                self._process_update(update)
+            except Exception:
+                logger.exception(f'Update {update.get("update_id")} failed')
+            finally:
+                updates.task_done()
+
+    def join(self):
+        """Wait until all queued updates are handled"""
+        for q in self._queues:
+            q.join()
+
+    def shutdown(self):
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    # set by make_server
+    pool = None
+    path_ = None
+    secret = None
+
+    def do_POST(self):
+        if self.path != self.path_:
+            return self._respond(404)
+        if self.secret and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret:
+            return self._respond(403)
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            update = json.loads(self.rfile.read(length))
+        except ValueError:
+            return self._respond(400)
+        if not isinstance(update, dict):
+            return self._respond(400)
+
+        try:
+            self.pool.submit(update)
+        except queue.Full:
+            logger.warning(f'Workers are saturated, update {update.get("update_id")} rejected')
+            return self._respond(503)
+        self._respond(200)
+
+    def do_GET(self):
+        if self.path == '/healthz':
+            return self._respond(200, f'queued: {self.pool.qsize()}\n'.encode())
+        if self.path == '/metrics':
+            return self._respond(200, metrics.render().encode())
+        self._respond(404)
+
+    def _respond(self, code, body=b''):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def make_server(pool, host='0.0.0.0', port=8012, path='/', secret=None):
+    handler = type('Handler', (WebhookHandler,), {'pool': pool, 'path_': path, 'secret': secret})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
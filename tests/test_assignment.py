@@ -0,0 +1,29 @@
+import unittest
+
+from peer_review_bot import assignment
+
+
+class TestGraderQueue(unittest.TestCase):
+    def test_least_loaded_first(self):
+        queue = assignment.GraderQueue({'a': 2, 'b': 0, 'c': 1})
+        self.assertEqual(queue.take(), 'b')
+        # ties go to the grader who has been waiting longer
+        self.assertEqual(queue.take(), 'c')
+        self.assertEqual(queue.take(exclude={'b'}), 'a')
+        self.assertEqual(queue.loads, {'a': 3, 'b': 1, 'c': 2})
+
+    def test_exclude_and_release(self):
+        queue = assignment.GraderQueue({'a': 0, 'b': 5})
+        self.assertEqual(queue.take(exclude={'a'}), 'b')
+        queue.release('b')
+        self.assertEqual(queue.loads['b'], 5)
+        self.assertIsNone(queue.take(exclude={'a', 'b'}))
+        self.assertEqual(queue.take(), 'a')
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            assignment.get_engine('random')
+
+
+if __name__ == '__main__':
+    unittest.main()
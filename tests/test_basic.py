@@ -1,4 +1,183 @@
+import os
+import json
+import tempfile
+import threading
 import unittest
 
+from peer_review_bot import config
+
+# telegram_ui needs a token which looks valid
+config.token = config.token or '1:test'
+
+try:
+    import mongomock
+    import telebot
+except ImportError:
+    mongomock = None
+
+
+class FakeResponse:
+    status_code = 200
+    reason = 'OK'
+
+    def __init__(self, result):
+        self.text = json.dumps({'ok': True, 'result': result})
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeBotAPI:
+    """apihelper.CUSTOM_REQUEST_SENDER which records calls instead of sending them"""
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        api_method = url.rsplit('/', 1)[-1]
+        params = dict(params or {})
+        with self.lock:
+            self.calls.append((api_method, params))
+            message_id = len(self.calls)
+        return FakeResponse({'message_id': message_id, 'date': 0, 'text': params.get('text', ''),
+                             'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'}})
+
+    def messages(self, chat_id):
+        return [p['text'] for m, p in self.calls if m == 'sendMessage' and int(p['chat_id']) == chat_id]
+
+
+def message_update(update_id, user_id, text=None, document=None, username='student'):
+    message = {'message_id': update_id, 'date': 0,
+               'chat': {'id': user_id, 'type': 'private'},
+               'from': {'id': user_id, 'is_bot': False, 'first_name': 'Test', 'username': username}}
+    if text is not None:
+        message['text'] = text
+        if text.startswith('/'):
+            command = text.split(' ')[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    if document is not None:
+        message['document'] = document
+    return {'update_id': update_id, 'message': message}
+
+
+@unittest.skipIf(mongomock is None, 'mongomock or pyTelegramBotAPI is not installed')
 class TestTelegram(unittest.TestCase):
-    def test_registration()
\ No newline at end of file
+    def setUp(self):
+        from peer_review_bot import telegram_ui, datautils, sender
+        from peer_review_bot.dbutils import TasksDB
+        self.ui = telegram_ui
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+        self.api = FakeBotAPI()
+        self._old = (telebot.apihelper.CUSTOM_REQUEST_SENDER, telegram_ui.bot.threaded, TasksDB._db,
+                     telegram_ui.outbox)
+        telebot.apihelper.CUSTOM_REQUEST_SENDER = self.api
+        telegram_ui.bot.threaded = False
+        # a fresh outbox for every test: rate buckets of chat 100 are not drained by earlier tests
+        telegram_ui.outbox = sender.Outbox(telegram_ui.bot,
+                                           per_chat_rate=config.outbox_per_chat_rate,
+                                           chat_burst=config.outbox_chat_burst,
+                                           global_rate=config.outbox_global_rate,
+                                           linger=config.outbox_linger,
+                                           n_workers=config.outbox_workers)
+        TasksDB._db = mongomock.MongoClient().peer_review_test_db
+        datautils.set_store(datautils.DialogStateStore(
+            datautils.SQLiteBackend(os.path.join(self.tmpdir.name, 'states.sqlite'))))
+
+    def tearDown(self):
+        from peer_review_bot import datautils
+        from peer_review_bot.dbutils import TasksDB
+        flushed = self.ui.outbox.flush(5)
+        telebot.apihelper.CUSTOM_REQUEST_SENDER, self.ui.bot.threaded, TasksDB._db, self.ui.outbox = self._old
+        datautils.get_store().close()
+        datautils.set_store(None)
+        self.tmpdir.cleanup()
+        self.assertTrue(flushed, 'replies were not sent in time')
+
+    def send(self, *updates):
+        for update in updates:
+            self.ui.process_update(update)
+        self.assertTrue(self.ui.outbox.flush(5), 'replies were not sent in time')
+
+    def test_registration(self):
+        from peer_review_bot.dbutils import TasksDB
+
+        self.send(message_update(1, 100, '/start'))
+        self.assertIn(config.registration_message, '\n'.join(self.api.messages(100)))
+
+        self.send(message_update(2, 100, 'nickname'))
+        self.assertIn(config.registered_message, self.api.messages(100)[-1])
+        user = TasksDB._db.user.find_one({'tg_id': 100})
+        self.assertEqual((user['username'], user['tg_username']), ('nickname', 'student'))
+
+        self.send(message_update(3, 100, '/start'))
+        self.assertIn(config.registered_error, self.api.messages(100)[-1])
+
+    def test_send_task_schedule(self):
+        self.send(message_update(1, 100, '/start'), message_update(2, 100, 'nickname'))
+        self.send(message_update(3, 100, '/send_task 9.1'))
+        self.assertIn(config.workshop_not_started_error, self.api.messages(100)[-1])
+        self.send(message_update(4, 100, f'/send_task 1.{config.n_tasks + 1}'))
+        self.assertIn(config.no_such_task_error, self.api.messages(100)[-1])
+
+    def test_wrong_format(self):
+        self.send(message_update(1, 100, '/grade @someone 1.1'))
+        self.assertEqual(self.api.messages(100)[-1], config.grade_format_message)
+        self.assertIn(config.wrong_format_error, self.api.messages(100)[0])
+
+    def test_batch_grade(self):
+        from peer_review_bot.dbutils import TasksDB
+        from peer_review_bot.data_structures import User, Document
+        users = [User(tg_id=100 + i, tg_username=f'student{i}', username=f'student{i}') for i in range(3)]
+        for user in users:
+            TasksDB.register_new_user(user)
+            TasksDB.add_task(user, 1, 1, Document('file', 'solution.zip', 1, 'application/zip'))
+            TasksDB.add_graders(user, 1, 1)
+        lines = [f"@{line['tg_username']} 1.1 9" for line in TasksDB.get_gradable(users[0])]
+
+        self.send(message_update(1, 100, '/grade ' + '\n'.join(lines + ['@student0 1.1 20', '@student0 1.1 9']),
+                                 username='student0'))
+        replies = '\n'.join(self.api.messages(100))
+        for line in lines:
+            self.assertIn(f'{line}: {config.success_message}', replies)
+        self.assertIn('@student0 1.1 20: Score is not', replies)
+        self.assertIn('@student0 1.1 9: Error. You should not grade this task', replies)
+        self.assertIn(config.batch_graded_message.format(n_recorded=len(lines), n=len(lines) + 2), replies)
+
+    def test_handler_metrics(self):
+        from peer_review_bot import metrics
+        n_calls = metrics.handler_latency.count('register')
+        self.send(message_update(1, 100, '/start'))
+        self.assertEqual(metrics.handler_latency.count('register'), n_calls + 1)
+        self.assertIn('prb_handler_seconds_count{handler="register"}', metrics.render())
+
+    def test_courses(self):
+        from peer_review_bot import courses, datautils
+        from peer_review_bot.dbutils import TasksDB
+        values = {name: getattr(config, name) for name in courses.SETTINGS}
+        courses.set_courses([courses.Course('ml', 'peer_review_test_ml', **values),
+                             courses.Course('nlp', 'peer_review_test_nlp', **values)])
+        TasksDB._db = None
+        TasksDB.set_client(mongomock.MongoClient())
+        try:
+            self.send(message_update(1, 100, 'nickname'))
+            self.assertIn('ml, nlp', self.api.messages(100)[-1])
+
+            with courses.use('nlp'):
+                store = datautils.DialogStateStore(
+                    datautils.SQLiteBackend(os.path.join(self.tmpdir.name, 'nlp.states.sqlite')))
+                datautils.set_store(store)
+            self.send(message_update(2, 100, '/start nlp'), message_update(3, 100, 'nickname'))
+            self.assertIn(config.registered_message, self.api.messages(100)[-1])
+            self.assertEqual(courses.course_of(100), 'nlp')
+            client = TasksDB.client()
+            self.assertEqual(client.peer_review_test_nlp.user.count_documents({'tg_id': 100}), 1)
+            self.assertEqual(client.peer_review_test_ml.user.count_documents({'tg_id': 100}), 0)
+            store.close()
+        finally:
+            courses.set_courses(None)
+            TasksDB.set_client(None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import random
+import unittest
+from types import SimpleNamespace
+
+from peer_review_bot import config, commands
+
+
+class TestParse(unittest.TestCase):
+    def test_grade(self):
+        expected = {'tg_username': 'user_1', 'workshop': 1, 'task': 4, 'score': 10}
+        for text in ['/grade @user_1 1.4 10', '/grade user_1 1.4 10', '/grade  @user_1\t1.4 10\n',
+                     '/grade@peer_review_bot @user_1 1.4 10', '  /GRADE @user_1 1.4 10  ']:
+            self.assertEqual(commands.parse(text), ('grade', expected), text)
+
+    def test_errors(self):
+        cases = [('/grade @user 1.4', 'grade'), ('/grade @user 1.4 10 extra', 'grade'),
+                 ('/grade @user 1.4 11', 'grade'), ('/grade @user 1,4 10', 'grade'),
+                 ('/send_task', 'send_task'), ('/send_task 1', 'send_task'), ('/get_task 1.4', 'get_task'),
+                 ('/unknown 1', 'unknown')]
+        for text, command in cases:
+            with self.assertRaises(commands.ParseError, msg=text) as cm:
+                commands.parse(text)
+            self.assertEqual(cm.exception.command, command)
+        with self.assertRaises(commands.ParseError) as cm:
+            commands.parse('/grade @user 1.4 11')
+        self.assertEqual(cm.exception.usage, config.grade_format_message)
+
+    def test_optional_and_free_text(self):
+        self.assertEqual(commands.parse('/start'), ('start', {}))
+        self.assertEqual(commands.parse('/start ml2019'), ('start', {'course_id': 'ml2019'}))
+        self.assertEqual(commands.parse('/help me please'), ('help', {}))
+        self.assertEqual(commands.parse('my name'), (None, {'text': 'my name'}))
+        self.assertEqual(commands.split('/send_task   1.2 \n'), ('send_task', '1.2'))
+        self.assertEqual(commands.split('/send_task1.2'), (None, '/send_task1.2'))
+
+    def test_csv_rows(self):
+        text = 'grader,student,task,score\n@ta,@alice,1.4,10\n\n@ta,"@bob",1.4,9\n'
+        self.assertEqual(commands.csv_rows(text), [(2, '@ta @alice 1.4 10'), (4, '@ta @bob 1.4 9')])
+        self.assertEqual(commands.csv_lines(text), ['@ta @alice 1.4 10', '@ta @bob 1.4 9'])
+        # a quoted cell over several lines: the row is numbered by its first line
+        self.assertEqual(commands.csv_rows('ta,"a\nb",1.1,5\nta,c,1.1,5'), [(1, 'ta a\nb 1.1 5'), (3, 'ta c 1.1 5')])
+
+    def test_round_trip(self):
+        """Any valid command with any whitespace between tokens is parsed back"""
+        rng = random.Random(0)
+        for _ in range(1000):
+            username = ''.join(rng.choice('abcXYZ019_') for _ in range(rng.randint(1, 32)))
+            workshop, task, score = rng.randint(0, 9999), rng.randint(0, 9999), rng.randint(0, 10)
+            spaces = [''.join(rng.choice(' \t\n') for _ in range(rng.randint(1, 3))) for _ in range(4)]
+            at = rng.choice(['@', ''])
+            text = f'/grade{spaces[0]}{at}{username}{spaces[1]}{workshop}.{task}{spaces[2]}{score}{spaces[3]}'
+            self.assertEqual(commands.parse(text).args,
+                             {'tg_username': username, 'workshop': workshop, 'task': task, 'score': score})
+
+    def test_never_crashes(self):
+        """Random text made of command-like pieces is parsed or rejected with ParseError"""
+        rng = random.Random(1)
+        pieces = ['/', '/grade', '/send_task', '/start', '/get_task', '@', '.', '1', '42', '1.4', '10', '99999',
+                  ' ', '\t', '\n', 'user_1', 'é', '😀', '\x00', '@bot', '-']
+        for _ in range(5000):
+            text = ''.join(rng.choice(pieces) for _ in range(rng.randint(0, 12)))
+            try:
+                commands.parse(text)
+            except commands.ParseError:
+                pass
+
+
+class TestRouter(unittest.TestCase):
+    def setUp(self):
+        self.router = commands.Router()
+        self.calls = []
+        for command, state in [('grade', commands.ANY), (None, commands.ANY), (None, 'registration')]:
+            self.router.route(command, state)(
+                lambda message, args, route=(command, state): self.calls.append((route, args)))
+
+    def message(self, text):
+        return SimpleNamespace(text=text)
+
+    def test_dispatch(self):
+        states = []
+
+        def get_state(message):
+            states.append(message.text)
+            return 'registration'
+
+        self.router.dispatch(self.message('/grade @user 1.1 5'), get_state)
+        self.router.dispatch(self.message('nickname'), get_state)
+        self.router.dispatch(self.message('/send_task 1.1'), get_state)  # no route
+        self.assertEqual(self.calls, [
+            (('grade', commands.ANY), {'tg_username': 'user', 'workshop': 1, 'task': 1, 'score': 5}),
+            ((None, 'registration'), {'text': 'nickname'})])
+        # the state is looked up only for free text, which has a state specific route
+        self.assertEqual(states, ['nickname'])
+
+    def test_fallback_to_any_state(self):
+        self.router.dispatch(self.message('nickname'), lambda message: 'sending_task')
+        self.assertEqual(self.calls, [((None, commands.ANY), {'text': 'nickname'})])
+
+    def test_parse_error(self):
+        with self.assertRaises(commands.ParseError):
+            self.router.dispatch(self.message('/grade @user 1.1'))
+        self.assertEqual(self.calls, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import json
+import tempfile
+import unittest
+from datetime import datetime
+
+from peer_review_bot import config, courses
+from peer_review_bot.dbutils import TasksDB
+from peer_review_bot.data_structures import User
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+def make_course(course_id, **settings):
+    values = {name: getattr(config, name) for name in courses.SETTINGS}
+    values.update(settings)
+    return courses.Course(course_id, f'peer_review_test_{course_id}', **values)
+
+
+class TestLoad(unittest.TestCase):
+    def test_load(self):
+        spec = {'ml': {'deadlines': {'1': '2019-03-08T23:59:00'}, 'n_graders': 5},
+                'nlp': {'db_name': 'nlp_db'}}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'courses.json')
+            with open(path, 'w') as f:
+                json.dump(spec, f)
+            loaded = courses.load(path)
+        self.assertEqual(list(loaded), ['ml', 'nlp'])
+        ml, nlp = loaded.values()
+        self.assertEqual((ml.db_name, ml.n_graders), ('peer_review_ml', 5))
+        self.assertEqual(ml.deadlines, {1: datetime(2019, 3, 8, 23, 59)})
+        self.assertEqual((nlp.db_name, nlp.n_graders, nlp.deadlines), ('nlp_db', config.n_graders, config.deadlines))
+        self.assertEqual(ml.file_name('user_states.sqlite'), 'ml.user_states.sqlite')
+
+    def test_default_course(self):
+        self.assertIsNone(config.courses_file)
+        course = courses.current()
+        self.assertEqual((course.course_id, course.db_name), (courses.DEFAULT, 'peer_review_db'))
+        self.assertEqual(course.file_name('user_states.sqlite'), 'user_states.sqlite')
+
+
+@unittest.skipIf(mongomock is None, 'mongomock is not installed')
+class TestCourses(unittest.TestCase):
+    def setUp(self):
+        self._old_db = TasksDB._db_override
+        TasksDB._db = None
+        TasksDB.set_client(mongomock.MongoClient())
+        courses.set_courses([make_course('ml', n_graders=1), make_course('nlp')])
+
+    def tearDown(self):
+        courses.set_courses(None)
+        TasksDB.set_client(None)
+        TasksDB._db = self._old_db
+
+    def test_no_course_selected(self):
+        with self.assertRaises(courses.UnknownCourse):
+            courses.current()
+        with self.assertRaises(courses.UnknownCourse):
+            courses.use('unknown').__enter__()
+
+    def test_isolation(self):
+        user = User(tg_id=1, tg_username='student', username='student')
+        with courses.use('ml'):
+            TasksDB.register_new_user(user)
+            self.assertEqual(TasksDB._db.name, 'peer_review_test_ml')
+            self.assertEqual(courses.current().n_graders, 1)
+        with courses.use('nlp'):
+            self.assertEqual(TasksDB._db.user.count_documents({'tg_id': 1}), 0)
+            self.assertEqual(courses.current().n_graders, config.n_graders)
+        with courses.use('ml'):
+            self.assertEqual(TasksDB.get_user_info(user)['username'], 'student')
+
+    def test_join(self):
+        self.assertIsNone(courses.course_of(1))
+        courses.join(1, 'nlp')
+        self.assertEqual(courses.course_of(1), 'nlp')
+        with self.assertRaises(courses.UnknownCourse):
+            courses.join(1, 'unknown')
+
+        # the membership is kept in mongo, not only in the cache
+        courses._members.clear()
+        self.assertEqual(courses.course_of(1), 'nlp')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import time
+import tempfile
+import unittest
+
+from peer_review_bot import datautils
+from peer_review_bot.data_structures import DialogState
+
+
+class CountingBackend(datautils.SQLiteBackend):
+    def __init__(self, path):
+        super().__init__(path)
+        self.n_gets = 0
+
+    def get(self, key):
+        self.n_gets += 1
+        return super().get(key)
+
+
+class TestDialogStateStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def check_backend(self, backend):
+        store = datautils.DialogStateStore(backend, ttl=60)
+        self.assertEqual(store.get(1), DialogState(None))
+
+        state = DialogState('sending_task', 1, 2, 0)
+        store.set(1, state)
+        self.assertEqual(store.get(1), state)
+
+        # a fresh store reads the state from the backend
+        store = datautils.DialogStateStore(backend, ttl=60)
+        self.assertEqual(store.get('1'), state)
+        store.close()
+
+    def test_shelve(self):
+        self.check_backend(datautils.ShelveBackend(self.path('states.shelve')))
+
+    def test_sqlite(self):
+        self.check_backend(datautils.SQLiteBackend(self.path('states.sqlite')))
+
+    def test_mongo(self):
+        try:
+            import mongomock
+        except ImportError:
+            self.skipTest('mongomock is not installed')
+        self.check_backend(datautils.MongoBackend(mongomock.MongoClient().db.dialog_state))
+
+    def test_cache_hits_do_not_touch_backend(self):
+        backend = CountingBackend(self.path('states.sqlite'))
+        store = datautils.DialogStateStore(backend)
+        store.set(1, DialogState('registration'))
+        for _ in range(10):
+            self.assertEqual(store.get(1).action, 'registration')
+        self.assertEqual(backend.n_gets, 0)
+
+    def test_lru_eviction(self):
+        backend = CountingBackend(self.path('states.sqlite'))
+        store = datautils.DialogStateStore(backend, cache_size=2)
+        for user in range(3):
+            store.set(user, DialogState('registration'))
+        self.assertEqual(store.get(0).action, 'registration')
+        self.assertEqual(backend.n_gets, 1)
+
+    def test_ttl(self):
+        store = datautils.DialogStateStore(datautils.SQLiteBackend(self.path('states.sqlite')), ttl=0.05)
+        store.set(1, DialogState('sending_task', 1, 1, 0))
+        store.set(2, DialogState('sending_task', 1, 2, 0))
+        time.sleep(0.1)
+        self.assertEqual(store.get(1), DialogState(None))
+        self.assertEqual(store.purge_expired(), 1)
+
+    def test_old_shelve_format(self):
+        import shelve
+        with shelve.open(self.path('states.shelve')) as storage:
+            storage['1'] = DialogState('registration')
+        store = datautils.DialogStateStore(datautils.ShelveBackend(self.path('states.shelve')), ttl=60)
+        self.assertEqual(store.get(1).action, 'registration')
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,476 @@
+import os
+import sys
+import unittest
+import subprocess
+import threading
+from unittest import mock
+from datetime import timedelta
+
+from peer_review_bot import config, assignment
+from peer_review_bot.dbutils import TasksDB
+from peer_review_bot.data_structures import User, Document
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+def make_db():
+    """Real mongod if PRB_TEST_DBHOST is set, mongomock otherwise"""
+    dbhost = os.environ.get('PRB_TEST_DBHOST')
+    if dbhost:
+        from pymongo import MongoClient
+        client = MongoClient(dbhost)
+        client.drop_database('peer_review_test_db')
+        return client.peer_review_test_db
+    if mongomock is None:
+        raise unittest.SkipTest('mongomock is not installed and PRB_TEST_DBHOST is not set')
+    return mongomock.MongoClient().peer_review_test_db
+
+
+def register(n_users):
+    users = []
+    for i in range(n_users):
+        user = User(tg_id=i, tg_username=f'user{i}', username=f'user{i}')
+        TasksDB.register_new_user(user)
+        users.append(user)
+    return users
+
+
+def document():
+    return Document('file_id', 'solution.zip', 100, 'application/zip')
+
+
+def age_assignments(days):
+    """Move all assignments days back, mongomock does not support the $[] operator"""
+    for task in TasksDB._db.task.find():
+        assignments = [{**a, 'assigned_at': a['assigned_at'] - timedelta(days=days)} for a in task['assignments']]
+        TasksDB._db.task.update_one({'_id': task['_id']}, {'$set': {'assignments': assignments}})
+
+
+class DBTestCase(unittest.TestCase):
+    def setUp(self):
+        self._old_db = TasksDB._db
+        TasksDB._db = make_db()
+
+    def tearDown(self):
+        TasksDB._db = self._old_db
+
+
+class TestAddGraders(DBTestCase):
+    def check_counters(self):
+        for task in TasksDB._db.task.find():
+            self.assertEqual(task['n_pending_graders'], len(task['graders']))
+            self.assertEqual(task['n_assigned_graders'], len(task['graders']) + len(task['scores']))
+            self.assertLessEqual(task['n_assigned_graders'], config.n_graders)
+            self.assertNotIn(task['user_id'], task['graders'])
+            self.assertEqual(len(set(task['graders'])), len(task['graders']))
+            self.assertEqual([a['grader'] for a in task['assignments']], task['graders'])
+
+    def test_sequential(self):
+        users = register(6)
+        for user in users:
+            TasksDB.add_task(user, 1, 1, document())
+            TasksDB.add_graders(user, 1, 1)
+        self.check_counters()
+
+        # everyone except the last submitters has a full set of graders
+        n_graders = [task['n_pending_graders'] for task in TasksDB._db.task.find()]
+        self.assertEqual(n_graders[:-config.n_graders], [config.n_graders] * (len(users) - config.n_graders))
+
+    def test_concurrent(self):
+        users = register(40)
+        for user in users:
+            TasksDB.add_task(user, 1, 1, document())
+
+        barrier = threading.Barrier(len(users))
+
+        def submit(user):
+            barrier.wait()
+            TasksDB.add_graders(user, 1, 1)
+
+        threads = [threading.Thread(target=submit, args=(u,)) for u in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.check_counters()
+
+    def test_add_score_updates_counters(self):
+        users = register(3)
+        for user in users:
+            TasksDB.add_task(user, 1, 1, document())
+            TasksDB.add_graders(user, 1, 1)
+
+        grader = users[0]
+        gradable = TasksDB.get_gradable(grader)
+        graded = User(tg_username=gradable[0]['tg_username'])
+        TasksDB.add_score(grader, graded, 1, 1, 7)
+        self.check_counters()
+
+    def test_scored_tasks_are_not_reassigned(self):
+        users = register(2 * config.n_graders + 2)
+        for user in users[:config.n_graders + 1]:
+            TasksDB.add_task(user, 1, 1, document())
+            TasksDB.add_graders(user, 1, 1)
+        # every grader scores before the next students submit
+        for user in users[:config.n_graders + 1]:
+            for line in TasksDB.get_gradable(user):
+                TasksDB.add_score(user, User(tg_username=line['tg_username']), 1, 1, 7)
+        for user in users[config.n_graders + 1:]:
+            TasksDB.add_task(user, 1, 1, document())
+            TasksDB.add_graders(user, 1, 1)
+        self.check_counters()
+        for task in TasksDB._db.task.find():
+            self.assertFalse(set(task['graders']) & set(task.get('scored_by', [])))
+
+    def test_migration(self):
+        ids = TasksDB._db.task.insert_many([
+            {'user_id': 1, 'workshop_number': 1, 'task_number': 1, 'graders': [2], 'scores': [5]},
+            {'user_id': 2, 'workshop_number': 1, 'task_number': 1, 'graders': [], 'scores': []},
+        ]).inserted_ids
+        self.assertEqual(TasksDB.migrate_grader_counters(batch_size=1), 2)
+        self.check_counters()
+        self.assertEqual(TasksDB._db.task.find_one({'_id': ids[0]})['n_assigned_graders'], 2)
+
+
+class TestFairAssignment(DBTestCase):
+    def setUp(self):
+        super().setUp()
+        self._old_engine = TasksDB.assignment
+        TasksDB.assignment = assignment.get_engine('fair')
+
+    def tearDown(self):
+        TasksDB.assignment = self._old_engine
+        super().tearDown()
+
+    def test_graded_solutions_wait(self):
+        users = register(5)
+        for user in users[:4]:
+            TasksDB.add_task(user, 1, 1, document())
+            TasksDB.add_graders(user, 1, 1)
+        # users[1] is fully graded, users[2] and users[3] have one grader each
+        TasksDB.add_score(users[0], users[1], 1, 1, 5)
+        TasksDB.add_score(users[2], users[1], 1, 1, 5)
+
+        # the solution with fewer assigned graders goes first, scored ones wait despite free pending slots
+        TasksDB.add_task(users[4], 1, 1, document())
+        gradable = TasksDB.add_graders(users[4], 1, 1)
+        self.assertEqual(set(gradable), {users[2].tg_username, users[3].tg_username})
+
+    def loads(self):
+        tasks = list(TasksDB._db.task.find())
+        return {t['user_id']: sum(t['user_id'] in other['graders'] for other in tasks) for t in tasks}
+
+    def test_balance(self):
+        users = register(6)
+        for user in users:
+            TasksDB.add_task(user, 1, 1, document())
+            TasksDB.add_graders(user, 1, 1)
+        before = self.loads()
+        self.assertGreater(len(TasksDB.balance_graders(1, 1)), 0)
+        self.assertEqual(TasksDB.balance_graders(1, 1), [])
+
+        tasks = list(TasksDB._db.task.find())
+        self.assertEqual([t['n_assigned_graders'] for t in tasks], [config.n_graders] * len(users))
+        TestAddGraders.check_counters(self)
+        # only the least loaded students got more work
+        after = self.loads()
+        busier = {user_id for user_id in after if after[user_id] > before[user_id]}
+        self.assertEqual({before[user_id] for user_id in busier}, {min(before.values())})
+
+
+class TestStaleGraders(DBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = register(5)
+        for user in self.users:
+            TasksDB.add_task(user, 1, 1, document())
+            TasksDB.add_graders(user, 1, 1)
+
+    def test_fresh_assignments_stay(self):
+        self.assertEqual(TasksDB.release_stale_graders(timedelta(days=3)), [])
+
+    def test_release_and_reassign(self):
+        before = {t['user_id']: t['graders'] for t in TasksDB._db.task.find()}
+        age_assignments(4)
+        # one grader scores in time
+        gradable = TasksDB.get_gradable(self.users[0])[0]
+        TasksDB.add_score(self.users[0], User(tg_username=gradable['tg_username']), 1, 1, 5)
+
+        released, assigned = TasksDB.reassign_stale_graders(timedelta(days=3), batch_size=2)
+        self.assertEqual(len(released), sum(map(len, before.values())) - 1)
+        self.assertTrue(assigned)
+        TestAddGraders.check_counters(self)
+        for grader, user_id, _, _ in assigned:
+            self.assertNotIn((grader, user_id, 1, 1), released)
+            task = TasksDB._db.task.find_one({'user_id': user_id})
+            self.assertNotIn(grader, task['scored_by'])
+
+        self.assertEqual(TasksDB.release_stale_graders(timedelta(days=3)), [])
+        task = TasksDB._db.task.find_one({'user_id': TasksDB.get_user_info(
+            User(tg_username=gradable['tg_username']))['_id']})
+        self.assertEqual(task['scores'], [5])
+
+    def test_migrated_tasks(self):
+        TasksDB._db.task.update_many({}, {'$unset': {'assignments': 1, 'submitted_at': 1}})
+        TasksDB.migrate_grader_counters()
+        TestAddGraders.check_counters(self)
+        # old tasks count as assigned when they were created
+        self.assertEqual(TasksDB.release_stale_graders(timedelta(days=3)), [])
+        self.assertTrue(TasksDB.release_stale_graders(timedelta(seconds=-1)))
+
+
+class TestAddScore(DBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = register(3)
+        for user in self.users:
+            TasksDB.add_task(user, 1, 1, document())
+            TasksDB.add_graders(user, 1, 1)
+        self.grader = self.users[0]
+        self.graded = User(tg_username=TasksDB.get_gradable(self.grader)[0]['tg_username'])
+
+    def test_score_once(self):
+        task = TasksDB.add_score(self.grader, self.graded, 1, 1, 8)
+        self.assertEqual(task['scores'], [8])
+        with self.assertRaises(RuntimeError):
+            TasksDB.add_score(self.grader, self.graded, 1, 1, 9)
+
+        grader_info = TasksDB.get_user_info(self.grader)
+        self.assertEqual(len(grader_info['scored_tasks']), 1)
+
+    def test_concurrent_double_grading(self):
+        results = []
+
+        def grade():
+            try:
+                TasksDB.add_score(self.grader, self.graded, 1, 1, 8)
+                results.append('ok')
+            except RuntimeError:
+                results.append('rejected')
+
+        threads = [threading.Thread(target=grade) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results.count('ok'), 1)
+        task = TasksDB._db.task.find_one({'user_id': TasksDB.get_user_info(self.graded)['_id']})
+        self.assertEqual(task['scores'], [8])
+        self.assertEqual(task['n_pending_graders'], len(task['graders']))
+
+    def test_old_users_without_scored_tasks(self):
+        TasksDB._db.user.update_many({}, {'$set': {'scored_tasks': None}})
+        self.assertEqual(TasksDB.migrate_user_fields(), len(self.users))
+        TasksDB.add_score(self.grader, self.graded, 1, 1, 8)
+        self.assertEqual(len(TasksDB.get_user_info(self.grader)['scored_tasks']), 1)
+
+
+class TestScoreSummary(DBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = register(4)
+        for task in (1, 2):
+            for user in self.users:
+                TasksDB.add_task(user, 1, task, document())
+                TasksDB.add_graders(user, 1, task)
+        # everyone scores everything assigned
+        for grader in self.users:
+            for line in TasksDB.get_gradable(grader):
+                TasksDB.add_score(grader, User(tg_username=line['tg_username']),
+                                  line['workshop_number'], line['task_number'], 7 + grader.tg_id)
+
+    def scores_from_tasks(self, user):
+        user_id = TasksDB.get_user_info(user)['_id']
+        res = {}
+        for task in TasksDB._db.task.find({'user_id': user_id, 'scores.0': {'$exists': 1}}):
+            res[task['task_number']] = task['scores']
+        return res
+
+    def test_get_scores(self):
+        for user in self.users:
+            expected = self.scores_from_tasks(user)
+            scores = {line['task_number']: line['score'] for line in TasksDB.get_scores(user)}
+            self.assertEqual(set(scores), set(expected))
+            for task, task_scores in expected.items():
+                if len(task_scores) >= 2:
+                    self.assertEqual(scores[task], round(sum(task_scores) / len(task_scores), 1))
+                else:
+                    self.assertEqual(scores[task], config.not_scored_yet_message.format(n=1))
+        self.assertEqual(TasksDB.check_score_summaries(), [])
+
+    def test_rebuild_and_check(self):
+        expected = {s['_id']: s for s in TasksDB._db.score_summary.find()}
+        TasksDB._db.score_summary.update_one({}, {'$inc': {'tasks.1_1.sum': 1}})
+        TasksDB._db.score_summary.insert_one({'_id': 'stale', 'tasks': {}})
+        self.assertEqual(len(TasksDB.check_score_summaries()), 2)
+
+        self.assertEqual(TasksDB.rebuild_score_summaries(batch_size=1), len(expected))
+        self.assertEqual(TasksDB.check_score_summaries(), [])
+        self.assertEqual({s['_id']: s for s in TasksDB._db.score_summary.find()}, expected)
+
+
+class TestAddScores(DBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = register(5)
+        for task in (1, 2):
+            for user in self.users:
+                TasksDB.add_task(user, 1, task, document())
+                TasksDB.add_graders(user, 1, task)
+        self.grader = self.users[0]
+
+    def lines(self, grader, score=8):
+        return [{'tg_username': line['tg_username'], 'workshop': line['workshop_number'],
+                 'task': line['task_number'], 'score': score} for line in TasksDB.get_gradable(grader)]
+
+    def test_batch(self):
+        lines = self.lines(self.grader)
+        not_assigned = {'tg_username': self.grader.tg_username, 'workshop': 1, 'task': 1, 'score': 5}
+        unknown = {'tg_username': 'nobody', 'workshop': 1, 'task': 1, 'score': 5}
+        errors = TasksDB.add_scores(self.grader, lines + [not_assigned, unknown, lines[0]])
+
+        self.assertEqual(errors[:len(lines)], [None] * len(lines))
+        self.assertIn('should not grade', errors[len(lines)])
+        self.assertEqual(errors[len(lines) + 1], 'No user @nobody')
+        self.assertIsNotNone(errors[len(lines) + 2])
+        self.assertEqual(TasksDB.get_gradable(self.grader), [])
+        self.assertEqual(len(TasksDB.get_user_info(self.grader)['scored_tasks']), len(lines))
+        self.assertEqual(TasksDB.check_score_summaries(), [])
+        # a second batch with the same lines is rejected as a whole
+        self.assertTrue(all(TasksDB.add_scores(self.grader, lines)))
+
+    def test_same_as_add_score(self):
+        for grader in self.users:
+            TasksDB.add_scores(grader, self.lines(grader, 7 + grader.tg_id))
+        batch = {s['_id']: s for s in TasksDB._db.score_summary.find()}
+        self.assertEqual(TasksDB.check_score_summaries(), [])
+        self.assertEqual(TasksDB.rebuild_score_summaries(), len(batch))
+        self.assertEqual({s['_id']: s for s in TasksDB._db.score_summary.find()}, batch)
+
+    def test_released_meanwhile(self):
+        lines = self.lines(self.grader)
+        grader_id = TasksDB.get_user_info(self.grader)['_id']
+        run_in_transaction = TasksDB._run_in_transaction
+
+        def release_then_write(write):
+            # the stale grader job runs between the validation and the writes
+            TasksDB._db.task.update_one({'graders': grader_id}, {'$pull': {'graders': grader_id}})
+            return run_in_transaction(write)
+
+        with mock.patch.object(TasksDB, '_run_in_transaction', release_then_write):
+            errors = TasksDB.add_scores(self.grader, lines)
+        self.assertEqual(sum(error is not None for error in errors), 1)
+        self.assertEqual(TasksDB.check_score_summaries(), [])
+
+    def test_import(self):
+        rows = [dict(line, grader=grader.tg_username) for grader in self.users[:2] for line in self.lines(grader)]
+        rows.append(dict(rows[0], grader='nobody'))
+        errors = TasksDB.import_scores(rows)
+        self.assertEqual(errors[:-1], [None] * (len(rows) - 1))
+        self.assertEqual(errors[-1], 'No user @nobody')
+        self.assertEqual(TasksDB.check_score_summaries(), [])
+
+
+class TestGradable(DBTestCase):
+    def test_gradable_and_graders(self):
+        users = register(3)
+        for user in users:
+            TasksDB.add_task(user, 1, 1, document())
+            TasksDB.add_graders(user, 1, 1)
+
+        for user in users:
+            gradable = TasksDB.get_gradable(user)
+            graders = TasksDB.get_graders(user)
+            for line in gradable + graders:
+                self.assertEqual(set(line), {'workshop_number', 'task_number', 'tg_username'})
+                self.assertNotEqual(line['tg_username'], user.tg_username)
+
+        # every assignment is seen from both sides
+        n_graders = sum(len(TasksDB.get_graders(user)) for user in users)
+        n_gradable = sum(len(TasksDB.get_gradable(user)) for user in users)
+        self.assertEqual(n_graders, n_gradable)
+        self.assertGreater(n_graders, 0)
+
+
+class TestRequestScope(DBTestCase):
+    def test_user_resolved_once(self):
+        user, = register(1)
+        with TasksDB.request_scope() as scope:
+            TasksDB.add_task(user, 1, 1, document())
+            TasksDB.use_late_days(user, 2)
+            TasksDB.add_graders(user, 1, 1)
+            with TasksDB.request_scope() as nested:
+                self.assertIs(nested, scope)
+                info = TasksDB.get_user_info(User(tg_username=user.tg_username))
+        self.assertEqual(scope.n_cache_hits, 3)
+        self.assertEqual(info['late_days'], config.default_late_days - 2)
+        self.assertEqual(TasksDB.get_user_info(user)['late_days'], config.default_late_days - 2)
+
+    def test_renamed_user_is_updated_once(self):
+        user, = register(1)
+        renamed = User(tg_id=user.tg_id, tg_username='renamed')
+        with TasksDB.request_scope():
+            self.assertEqual(TasksDB.get_user_info(renamed)['tg_username'], 'renamed')
+            self.assertEqual(TasksDB.get_user_info(User(tg_username='renamed'))['tg_id'], user.tg_id)
+        self.assertEqual(TasksDB._db.user.find_one({'tg_id': user.tg_id})['tg_username'], 'renamed')
+
+    def test_round_trip_counter(self):
+        from peer_review_bot.dbutils import RoundTripCounter
+        counter = RoundTripCounter()
+        counter.started(None)
+        with TasksDB.request_scope() as scope:
+            counter.started(None)
+            counter.started(None)
+        self.assertEqual(scope.n_round_trips, 2)
+
+
+class TestLazyClient(unittest.TestCase):
+    def test_import_does_not_connect(self):
+        env = {k: v for k, v in os.environ.items() if k != 'PRB_TOKEN'}
+        code = ('from peer_review_bot import utils\n'
+                'from peer_review_bot.dbutils import TasksDB\n'
+                'assert TasksDB._client is None')
+        subprocess.run([sys.executable, '-c', code], env=env, check=True)
+
+    def test_client_per_process(self):
+        old_db = TasksDB._db_override
+        TasksDB._db = None
+        try:
+            self.assertEqual(TasksDB._db.name, 'peer_review_db')
+            client = TasksDB.client()
+            self.assertIs(TasksDB.client(), client)
+            self.assertEqual(client.options.pool_options.max_pool_size, config.mongo_max_pool_size)
+
+            # as if the process was forked
+            TasksDB._client_pid = -1
+            self.assertIsNot(TasksDB.client(), client)
+            self.assertEqual(TasksDB._client_pid, os.getpid())
+        finally:
+            TasksDB._db = old_db
+
+
+class TestIndexes(DBTestCase):
+    def test_ensure_indexes(self):
+        TasksDB._db.task.create_index('unused')
+        report = TasksDB.ensure_indexes()
+        self.assertEqual(len(report['user']['created']), len(TasksDB.indexes['user']))
+        self.assertEqual(report['task']['extra'], ['unused_1'])
+
+        report = TasksDB.ensure_indexes()
+        self.assertEqual(report['user']['created'], [])
+        self.assertEqual(report['task']['created'], [])
+
+    def test_unique_tg_id(self):
+        TasksDB.ensure_indexes()
+        register(1)
+        with self.assertRaises(Exception):
+            register(1)
+
+
+if __name__ == '__main__':
+    unittest.main()
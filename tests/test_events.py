@@ -0,0 +1,118 @@
+import unittest
+from datetime import timedelta
+
+from peer_review_bot import config, events
+from peer_review_bot.dbutils import TasksDB
+from peer_review_bot.data_structures import User
+
+from test_dbutils import DBTestCase, register, document, age_assignments
+
+NO_LAG = timedelta(0)
+
+
+class TestEvents(DBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db = TasksDB._db
+        self.users = register(4)
+        for user in self.users:
+            TasksDB.add_task(user, 1, 1, document())
+            TasksDB.add_graders(user, 1, 1)
+
+    def grade_one(self, grader, score=5):
+        gradable = TasksDB.get_gradable(grader)[0]
+        TasksDB.add_score(grader, User(tg_username=gradable['tg_username']), 1, 1, score)
+
+    def all_events(self):
+        return [e for name in events.partitions(self.db) for e in self.db[name].find(sort=[('key', 1)])]
+
+    def test_projection_matches_tasks(self):
+        self.grade_one(self.users[0])
+        gradable = TasksDB.get_gradable(self.users[1])
+        self.assertEqual(TasksDB.add_scores(self.users[1], [
+            {'tg_username': line['tg_username'], 'workshop': 1, 'task': 1, 'score': 7} for line in gradable]),
+            [None] * len(gradable))
+        TasksDB.use_late_days(self.users[3], 2)
+        age_assignments(4)
+        self.assertTrue(TasksDB.release_stale_graders(timedelta(days=3)))
+        self.assertTrue(TasksDB.balance_graders(1, 1))
+
+        self.assertEqual(events.catch_up(self.db, lag=NO_LAG), len(self.all_events()))
+        self.assertEqual(events.verify(self.db, config.default_late_days), [])
+        user = self.db.audit_user.find_one({'_id': TasksDB.get_user_info(self.users[3])['_id']})
+        self.assertEqual(user['used'], 2)
+
+    def test_incremental_and_idempotent(self):
+        n_events = events.catch_up(self.db, batch_size=3, lag=NO_LAG)
+        self.assertEqual(n_events, len(self.all_events()))
+        self.assertEqual(self.db.task.count_documents({f'{events.PENDING}.0': {'$exists': True}}), 0)
+        self.assertEqual(events.catch_up(self.db, lag=NO_LAG), 0)
+        self.grade_one(self.users[0])
+        self.assertEqual(events.catch_up(self.db, lag=NO_LAG), 1)
+
+        # a batch applied again after a crash before the checkpoint was saved
+        projected = list(self.db.audit_task.find(sort=[('_id', 1)]))
+        events.apply(self.db, self.all_events())
+        self.assertEqual(list(self.db.audit_task.find(sort=[('_id', 1)])), projected)
+        self.assertEqual(events.verify(self.db, config.default_late_days), [])
+
+    def test_mutation_carries_its_event(self):
+        self.grade_one(self.users[0], score=9)
+        task = self.db.task.find_one({'scores': 9})
+        # nothing but the task update has been written when the score is recorded
+        self.assertEqual(self.all_events(), [])
+        self.assertEqual([e['type'] for e in task[events.PENDING]][-1], events.SCORE_ADDED)
+
+        # a sweep interrupted after the events reached the log, before they were pulled from the tasks
+        pending = {t['_id']: t[events.PENDING] for t in self.db.task.find()}
+        n_moved = events.sweep(self.db)
+        for task_id, items in pending.items():
+            self.db.task.update_one({'_id': task_id}, {'$set': {events.PENDING: items}})
+        self.assertEqual(events.sweep(self.db), n_moved)
+        self.assertEqual(len(self.all_events()), n_moved)
+        events.catch_up(self.db, lag=NO_LAG)
+        self.assertEqual(events.verify(self.db, config.default_late_days), [])
+
+    def test_lag(self):
+        self.assertEqual(events.catch_up(self.db, lag=timedelta(hours=1)), 0)
+        self.assertEqual(events.catch_up(self.db, lag=NO_LAG), len(self.all_events()))
+
+    def test_rebuild(self):
+        self.grade_one(self.users[0])
+        events.catch_up(self.db, lag=NO_LAG)
+        projected = list(self.db.audit_task.find(sort=[('_id', 1)]))
+        self.db.audit_task.update_many({}, {'$set': {'scores': [0]}})
+        self.assertTrue(events.verify(self.db, config.default_late_days))
+        self.assertEqual(events.rebuild(self.db, lag=NO_LAG), len(self.all_events()))
+        self.assertEqual(list(self.db.audit_task.find(sort=[('_id', 1)])), projected)
+
+    def test_snapshot_of_old_data(self):
+        self.grade_one(self.users[0])
+        TasksDB.use_late_days(self.users[1], 3)
+        # data of a course which ran before the log existed
+        for collection in ('task', 'user'):
+            self.db[collection].update_many({}, {'$unset': {events.PENDING: 1}})
+        self.assertTrue(events.verify(self.db, config.default_late_days))
+
+        self.assertEqual(events.snapshot(self.db, config.default_late_days), len(self.users) * 2)
+        events.catch_up(self.db, lag=NO_LAG)
+        self.assertEqual(events.verify(self.db, config.default_late_days), [])
+        self.assertEqual(events.snapshot(self.db, config.default_late_days), 0)
+
+        self.grade_one(self.users[2])
+        events.catch_up(self.db, lag=NO_LAG)
+        self.assertEqual(events.verify(self.db, config.default_late_days), [])
+
+    def test_history(self):
+        self.grade_one(self.users[0], score=9)
+        task = self.db.task.find_one({'scores': 9})
+        kinds = [e['type'] for e in events.history(self.db, task['_id'])]
+        self.assertEqual(kinds[0], events.TASK_SUBMITTED)
+        self.assertIn(events.GRADERS_ASSIGNED, kinds)
+        self.assertEqual(kinds[-1], events.SCORE_ADDED)
+        keys = [e['key'] for e in events.history(self.db, task['_id'])]
+        self.assertEqual(keys, sorted(keys))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import io
+import csv
+import unittest
+
+from peer_review_bot import config, export
+from peer_review_bot.dbutils import TasksDB
+from peer_review_bot.data_structures import User
+from test_dbutils import DBTestCase, register, document
+
+
+class TestExport(DBTestCase):
+    def test_csv(self):
+        users = register(3)
+        for user in users:
+            TasksDB.add_task(user, 1, 1, document(), late_days=user.tg_id)
+            TasksDB.add_graders(user, 1, 1)
+        grader = users[0]
+        graded = User(tg_username=TasksDB.get_gradable(grader)[0]['tg_username'])
+        TasksDB.add_score(grader, graded, 1, 1, 9)
+
+        out = io.StringIO()
+        self.assertEqual(export.write_csv(out, export.iter_gradebook()), 3)
+        rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+        self.assertEqual(list(rows[0]), export.COLUMNS)
+
+        by_user = {row['tg_username']: row for row in rows}
+        self.assertEqual(float(by_user[graded.tg_username]['mean_score']), 9)
+        self.assertEqual(by_user[graded.tg_username]['n_scores'], '1')
+        self.assertEqual(by_user['user2']['late_days_used'], '2')
+        self.assertEqual(by_user['user2']['late_days_left'], str(config.default_late_days))
+        for row in rows:
+            task = TasksDB._db.task.find_one({'user_id': TasksDB.get_user_info(User(tg_username=row['tg_username']))['_id']})
+            self.assertEqual(int(row['pending_graders']), len(task['graders']))
+
+    def test_workshop_filter(self):
+        user, = register(1)
+        TasksDB.add_task(user, 1, 1, document())
+        TasksDB.add_task(user, 2, 1, document())
+        rows = list(export.iter_gradebook(workshop_number=2))
+        self.assertEqual([(r['workshop_number'], r['mean_score']) for r in rows], [(2, None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import os
+import json
+import tempfile
+import threading
+import unittest
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from peer_review_bot import filecache
+from peer_review_bot.dbutils import TasksDB
+from peer_review_bot.data_structures import Document
+from test_dbutils import DBTestCase, register
+
+
+class StubBotAPI(BaseHTTPRequestHandler):
+    """getFile and file downloads of the Bot API, files = {file_id: bytes}"""
+    files = {}
+    downloads = []
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/bottoken/getFile':
+            file_id = parse_qs(url.query)['file_id'][0]
+            if file_id not in self.files:
+                return self._respond(400, json.dumps({'ok': False, 'description': 'file not found'}).encode())
+            body = json.dumps({'ok': True, 'result': {'file_id': file_id, 'file_path': f'documents/{file_id}'}})
+            return self._respond(200, body.encode())
+        if url.path.startswith('/file/bottoken/documents/'):
+            file_id = url.path.rsplit('/', 1)[1]
+            self.downloads.append(file_id)
+            return self._respond(200, self.files[file_id])
+        self._respond(404, b'')
+
+    def _respond(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+class TestFileCache(DBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = filecache.FileCache(self.tmpdir.name, max_bytes=250)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def test_content_addressed_lru(self):
+        self.cache.put('a', [b'x' * 100], 'a.zip')
+        self.cache.put('same_as_a', [b'x' * 50, b'x' * 50])
+        self.assertEqual(self.cache.size(), 100)
+        self.cache.put('b', [b'y' * 100])
+        self.cache.get('a')
+        self.cache.put('c', [b'z' * 100])
+
+        # b is the least recently used, identical content of a is kept once
+        self.assertNotIn('b', self.cache)
+        self.assertEqual(self.cache.get('same_as_a')[0], self.cache.get('a')[0])
+        self.assertLessEqual(self.cache.size(), 250)
+        path, size, file_name = self.cache.get('a')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'x' * 100)
+        self.assertEqual((size, file_name), (100, 'a.zip'))
+        objects = [f for _, _, files in os.walk(os.path.join(self.tmpdir.name, 'objects')) for f in files]
+        self.assertEqual(len(objects), 2)
+
+    def test_content_disposition(self):
+        header = filecache.content_disposition('a"b\r\nSet-Cookie: x=1;\\решение.py')
+        self.assertNotIn('\r', header)
+        self.assertNotIn('\n', header)
+        self.assertTrue(header.startswith('attachment; filename="a_b__Set-Cookie: x=1;________.py"; '))
+        self.assertIn("filename*=UTF-8''a%22b%0D%0ASet-Cookie%3A%20x%3D1%3B%5C%D1%80", header)
+
+    def test_errors_hide_the_token(self):
+        prefetcher = filecache.Prefetcher(self.cache, 'secret-token', 'http://127.0.0.1:1', timeout=1.)
+        report = prefetcher.prefetch([{'file_id': 'file0'}])
+        self.assertEqual(list(report['failed']), ['file0'])
+        self.assertNotIn('secret-token', report['failed']['file0'])
+        self.assertIn('<token>', report['failed']['file0'])
+
+    def test_prefetch_and_serve(self):
+        users = register(4)
+        contents = {}
+        for user in users:
+            file_id = f'file{user.tg_id}'
+            contents[file_id] = f'solution of {user.tg_id}'.encode()
+            TasksDB.add_task(user, 1, 1, Document(file_id, f'{file_id}.py', len(contents[file_id]), 'text/x-python'))
+        TasksDB._db.task.update_one({'file_info.file_id': 'file3'}, {'$set': {'file_info.file_id': 'missing'}})
+
+        handler = type('Handler', (StubBotAPI,), {'files': contents, 'downloads': []})
+        api = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        prefetcher = filecache.Prefetcher(self.cache, 'token', serve(api), max_workers=2)
+        self.cache.max_bytes = 1000
+        try:
+            report = prefetcher.prefetch_task(1, 1)
+            self.assertEqual((report['downloaded'], report['cached']), (3, 0))
+            self.assertEqual(list(report['failed']), ['missing'])
+            self.assertTrue(report['failed']['missing'].startswith('HTTP 4'))
+            self.assertNotIn('token', report['failed']['missing'])
+            report = prefetcher.prefetch_task(1, 1)
+            self.assertEqual((report['downloaded'], report['cached']), (0, 3))
+            self.assertEqual(sorted(handler.downloads), ['file0', 'file1', 'file2'])
+        finally:
+            api.shutdown()
+            api.server_close()
+
+        server = filecache.make_server(self.cache, port=0)
+        url = serve(server)
+        try:
+            with urllib.request.urlopen(f'{url}/files/file1') as resp:
+                self.assertEqual(resp.read(), contents['file1'])
+                self.assertIn('file1.py', resp.headers['Content-Disposition'])
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(f'{url}/files/missing')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
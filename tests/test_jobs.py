@@ -0,0 +1,89 @@
+import time
+import tempfile
+import unittest
+from datetime import timedelta
+from unittest import mock
+
+from peer_review_bot import config, jobs, datautils, events
+from peer_review_bot.dbutils import TasksDB
+from peer_review_bot.data_structures import DialogState
+from test_dbutils import DBTestCase, register, document, age_assignments
+
+
+class FakeOutbox:
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, chat_id, text, parse_mode=None):
+        self.messages.append((chat_id, text))
+
+
+class TestStaleGraderJob(DBTestCase):
+    def test_run_once(self):
+        users = register(5)
+        for user in users:
+            TasksDB.add_task(user, 1, 1, document())
+            TasksDB.add_graders(user, 1, 1)
+        age_assignments(4)
+
+        outbox = FakeOutbox()
+        job = jobs.StaleGraderJob(outbox, timedelta(days=3))
+        n_released, n_assigned = job.run_once()
+        self.assertGreater(n_released, 0)
+        self.assertGreater(n_assigned, 0)
+
+        released_text = config.grading_released_message.split('{')[0]
+        assigned_text = config.grading_assigned_message.split('{')[0]
+        self.assertEqual(sum(text.startswith(released_text) for _, text in outbox.messages), n_released)
+        self.assertEqual(sum(text.startswith(assigned_text) for _, text in outbox.messages), n_assigned)
+        self.assertTrue({chat_id for chat_id, _ in outbox.messages} <= {u.tg_id for u in users})
+
+        self.assertEqual(job.run_once(), (0, 0))
+
+
+class TestMaintenanceJob(DBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.backend = datautils.SQLiteBackend(f'{self.tmpdir.name}/states.sqlite')
+        datautils.set_store(datautils.DialogStateStore(self.backend, ttl=0.2))
+
+    def tearDown(self):
+        datautils.get_store().close()
+        datautils.set_store(None)
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def test_expired_states_are_removed(self):
+        store = datautils.get_store()
+        store.set(1, DialogState('registration'))
+        time.sleep(0.3)
+        store.set(2, DialogState('sending_task', 1, 1, 0))
+        self.assertEqual(jobs.MaintenanceJob().run_once(), (1, 0))
+        rows = self.backend._conn.execute('SELECT key FROM dialog_state').fetchall()
+        self.assertEqual([str(key) for key, in rows], ['2'])
+
+    def test_audit_catch_up(self):
+        for user in register(3):
+            TasksDB.add_task(user, 1, 1, document())
+        with mock.patch.object(config, 'audit_lag_seconds', 0):
+            self.assertEqual(jobs.MaintenanceJob().run_once(), (0, 3))
+        self.assertEqual(TasksDB._db.task.count_documents({f'{events.PENDING}.0': {'$exists': True}}), 0)
+        self.assertEqual(TasksDB._db.audit_task.count_documents({}), 3)
+
+    def test_scheduled(self):
+        job = jobs.MaintenanceJob(interval=0.01)
+        datautils.get_store().set(1, DialogState('registration'))
+        time.sleep(0.3)
+        job.start()
+        try:
+            deadline = time.monotonic() + 5
+            while self.backend._conn.execute('SELECT COUNT(*) FROM dialog_state').fetchone()[0]:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+        finally:
+            job.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+import threading
+import urllib.request
+
+from peer_review_bot import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter(self):
+        counter = metrics.Counter('errors_total', 'Errors', ['handler', 'exception'])
+        counter.inc('grade', 'KeyError')
+        counter.inc('grade', 'KeyError', amount=2)
+        self.assertEqual(counter.value('grade', 'KeyError'), 3)
+        self.assertEqual(metrics.render([counter]),
+                         '# HELP errors_total Errors\n# TYPE errors_total counter\n'
+                         'errors_total{handler="grade",exception="KeyError"} 3\n')
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('latency', 'Latency', ['handler'], buckets=(0.1, 1.))
+        for value in (0.05, 0.1, 0.5, 3.):
+            histogram.observe(value, 'grade')
+        lines = metrics.render([histogram]).splitlines()
+        self.assertEqual(lines[2:], ['latency_bucket{handler="grade",le="0.1"} 2',
+                                     'latency_bucket{handler="grade",le="1.0"} 3',
+                                     'latency_bucket{handler="grade",le="+Inf"} 4',
+                                     'latency_sum{handler="grade"} 3.65',
+                                     'latency_count{handler="grade"} 4'])
+
+    def test_gauge(self):
+        gauge = metrics.Gauge('queued', 'Queued', lambda: 5)
+        self.assertIn('queued 5\n', metrics.render([gauge]))
+
+    def test_server(self):
+        server = metrics.make_server('127.0.0.1', 0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            url = f'http://127.0.0.1:{server.server_address[1]}/metrics'
+            with urllib.request.urlopen(url) as resp:
+                self.assertIn('# TYPE prb_mongo_command_seconds histogram', resp.read().decode())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import json
+import time
+import tempfile
+import unittest
+
+from peer_review_bot import profiling
+
+
+class Methods:
+    @classmethod
+    def slow(cls):
+        time.sleep(0.02)
+        return 'done'
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_redact(self):
+        self.assertEqual(profiling.redact('/grade @someone 1.1 10'), '/grade')
+        self.assertEqual(profiling.redact('/get_scores@bot'), '/get_scores')
+        self.assertEqual(profiling.redact('my nickname'), '<text>')
+        self.assertEqual(profiling.redact(None), '<document>')
+        # batch /grade: one line per score, any whitespace after the command
+        self.assertEqual(profiling.redact('/grade\n@alice 1.1 10\n@bob 1.1 9'), '/grade')
+        self.assertEqual(profiling.redact('/grade\talice 1.1 10'), '/grade')
+        self.assertEqual(profiling.redact('/alice_secret_name'), '<unknown command>')
+        self.assertEqual(profiling.redact('/send_task1.2'), '<text>')
+
+    def test_disabled(self):
+        profiler = profiling.Profiler(rate=0, profile_dir=self.tmpdir.name)
+        with profiler.update('grade', '/grade @someone 1.1 10'):
+            pass
+        self.assertIsNone(profiler.dump())
+
+    def test_sampled_updates(self):
+        profiler = profiling.Profiler(rate=1, profile_dir=self.tmpdir.name, sample_interval=0.001, top_n=2)
+        cls = profiler.instrument(type('DB', (Methods,), {'fast': classmethod(lambda cls: 1)}))
+        profiler.start()
+        for text in ('/grade @someone 1.1 10', '/get_task @someone 1.1', 'nickname'):
+            with profiler.update('handler', text):
+                self.assertEqual(cls.fast(), 1)
+                cls.slow()
+
+        stacks_path, slow_path = profiler.dump()
+        with open(stacks_path) as f:
+            stacks = f.read().splitlines()
+        self.assertTrue(stacks)
+        self.assertTrue(any('test_profiling.py:slow' in line for line in stacks))
+        for line in stacks:
+            stack, count = line.rsplit(' ', 1)
+            self.assertTrue(stack.startswith('handler;'))
+            self.assertGreater(int(count), 0)
+
+        with open(slow_path) as f:
+            report = json.load(f)
+        self.assertEqual(report['n_updates'], 3)
+        self.assertEqual(len(report['slowest']), 2)
+        self.assertNotIn('someone', json.dumps(report))
+        self.assertEqual(report['tasksdb']['DB.fast']['calls'], 3)
+        # slow is defined on the base class and is not instrumented
+        self.assertNotIn('DB.slow', report['tasksdb'])
+
+        self.assertIsNone(profiler.dump())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import json
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from peer_review_bot import config, courses, schedule
+from peer_review_bot.dbutils import TasksDB
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+SPEC = {'workshops': {'1': {'deadline': '2019-03-08T00:00:00', 'n_tasks': 3, 'max_late': 2,
+                            'tasks': {'3': '2019-03-10T00:00:00'}},
+                      '2': {'deadline': '2019-03-20T00:00:00'}},
+        'extensions': {'100': {'1': 5}}}
+
+
+def make_course(source, **settings):
+    values = {name: getattr(config, name) for name in courses.SETTINGS}
+    values.update(settings, schedule=source)
+    return courses.Course('test', 'peer_review_test_schedule', **values)
+
+
+class TestSchedule(unittest.TestCase):
+    def test_from_spec(self):
+        s = schedule.Schedule.from_spec(SPEC, n_tasks=7, max_late=3)
+        self.assertEqual(s.workshops, {1, 2})
+        self.assertEqual(s.slot(1, 1), schedule.Slot(datetime(2019, 3, 8), 2))
+        self.assertEqual(s.slot(1, 3), schedule.Slot(datetime(2019, 3, 10), 2))
+        self.assertIsNone(s.slot(1, 4))
+        self.assertEqual(s.slot(2, 7), schedule.Slot(datetime(2019, 3, 20), 3))
+        self.assertIsNone(s.slot(3, 1))
+        with self.assertRaises(TypeError):
+            s.slots[1, 1] = None
+
+    def test_late_days(self):
+        s = schedule.Schedule.from_spec(SPEC, n_tasks=7, max_late=3)
+        deadline = datetime(2019, 3, 8)
+        self.assertEqual(s.late_days(1, 1, now=deadline - timedelta(hours=1)), 0)
+        self.assertEqual(s.late_days(1, 1, now=deadline + timedelta(days=1, hours=1)), 1)
+        self.assertEqual(s.late_days(1, 1, now=deadline + timedelta(days=2, hours=1)), 2)
+        self.assertIsNone(s.late_days(1, 1, now=deadline + timedelta(days=3, hours=1)))
+        # the extension of the student moves the deadline by 5 days
+        self.assertEqual(s.late_days(1, 1, tg_id=100, now=deadline + timedelta(days=3, hours=1)), 0)
+        self.assertEqual(s.late_days(1, 1, tg_id=100, now=deadline + timedelta(days=6, hours=1)), 1)
+        self.assertIsNone(s.late_days(2, 1, tg_id=100, now=datetime(2019, 3, 24, 1)))
+
+    def test_from_course(self):
+        course = make_course(None, deadlines={1: datetime(2019, 3, 8)}, n_tasks=2)
+        s = schedule.Schedule.from_course(course)
+        self.assertEqual(set(s.slots), {(1, 1), (1, 2)})
+        self.assertEqual(s.slot(1, 2).max_late, config.max_late)
+
+
+class TestReload(unittest.TestCase):
+    def setUp(self):
+        self._old_interval = config.schedule_check_interval
+        config.schedule_check_interval = 0
+        schedule.reset()
+
+    def tearDown(self):
+        config.schedule_check_interval = self._old_interval
+        courses.set_courses(None)
+        schedule.reset()
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'schedule.json')
+            with open(path, 'w') as f:
+                json.dump(SPEC, f)
+            courses.set_courses([make_course(path)])
+            first = schedule.current()
+            self.assertIs(schedule.current(), first)
+            self.assertEqual(first.workshops, {1, 2})
+
+            with open(path, 'w') as f:
+                json.dump({'workshops': {'3': {'deadline': '2019-04-01T00:00:00'}}}, f)
+            stat = os.stat(path)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            self.assertEqual(schedule.current().workshops, {3})
+
+            # a broken file keeps the last good schedule
+            with open(path, 'w') as f:
+                f.write('{')
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10 ** 9))
+            with self.assertLogs('peer_review_bot.schedule', 'ERROR'):
+                self.assertEqual(schedule.current().workshops, {3})
+
+    def test_interval(self):
+        config.schedule_check_interval = 3600
+        courses.set_courses([make_course(None, deadlines={1: datetime(2019, 3, 8)})])
+        first = schedule.current()
+        courses.set_courses([make_course(None, deadlines={2: datetime(2019, 3, 8)})])
+        self.assertIs(schedule.current(), first)
+
+    @unittest.skipIf(mongomock is None, 'mongomock is not installed')
+    def test_mongo(self):
+        old_db = TasksDB._db_override
+        TasksDB._db = mongomock.MongoClient().peer_review_test_db
+        try:
+            courses.set_courses([make_course(schedule.MONGO)])
+            self.assertEqual(schedule.current().slots, {})
+
+            schedule.save(SPEC)
+            self.assertEqual(schedule.current().workshops, {1, 2})
+            self.assertNotIn((200, 2), schedule.current().extensions)
+
+            schedule.extend(200, 2, 3)
+            self.assertEqual(schedule.current().extensions[200, 2], 3)
+            self.assertEqual(schedule.current().extensions[100, 1], 5)
+        finally:
+            TasksDB._db = old_db
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+import time
+import threading
+import unittest
+
+import requests
+
+from peer_review_bot import sender
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__('Too Many Requests')
+        self.error_code = 429
+        self.result_json = {'error_code': 429, 'parameters': {'retry_after': retry_after}}
+
+
+class StubBot:
+    """Records sent messages, fails with 429 the first n_rate_limited calls"""
+    def __init__(self, n_rate_limited=0, retry_after=0.1):
+        self.sent = []
+        self.n_rate_limited = n_rate_limited
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text, parse_mode=None):
+        with self.lock:
+            if self.n_rate_limited:
+                self.n_rate_limited -= 1
+                raise RateLimited(self.retry_after)
+            self.sent.append((time.monotonic(), chat_id, text, parse_mode))
+
+    def send_document(self, chat_id, document):
+        with self.lock:
+            self.sent.append((time.monotonic(), chat_id, document, 'document'))
+
+
+class SlowBot(StubBot):
+    """Takes delay seconds to send a message, fails with a network error the first n_errors calls"""
+    def __init__(self, delay=0.1, n_errors=0):
+        super().__init__()
+        self.delay = delay
+        self.n_errors = n_errors
+
+    def send_message(self, chat_id, text, parse_mode=None):
+        with self.lock:
+            if self.n_errors:
+                self.n_errors -= 1
+                raise requests.ConnectionError('Connection reset by peer')
+        time.sleep(self.delay)
+        super().send_message(chat_id, text, parse_mode)
+
+    def send_document(self, chat_id, document):
+        time.sleep(self.delay)
+        super().send_document(chat_id, document)
+
+
+class Forbidden(Exception):
+    def __init__(self):
+        super().__init__('Forbidden: bot was blocked by the user')
+        self.error_code = 403
+
+
+class TestOutbox(unittest.TestCase):
+    def test_merge_consecutive_messages(self):
+        bot = StubBot()
+        outbox = sender.Outbox(bot)
+        outbox.send_message(1, 'Hi!')
+        outbox.send_message(1, 'help')
+        outbox.send_message(1, '*bold*', parse_mode='markdown')
+        outbox.send_message(2, 'other chat')
+        outbox.send_document(1, 'file_id')
+        self.assertTrue(outbox.flush(5))
+
+        sent = [(chat_id, text, mode) for _, chat_id, text, mode in bot.sent]
+        self.assertEqual([s for s in sent if s[0] == 1], [(1, 'Hi!\nhelp', None),
+                                                         (1, '*bold*', 'markdown'),
+                                                         (1, 'file_id', 'document')])
+        self.assertIn((2, 'other chat', None), sent)
+        self.assertEqual(outbox.n_merged, 1)
+
+    def test_long_messages_are_not_merged(self):
+        bot = StubBot()
+        outbox = sender.Outbox(bot)
+        outbox.send_message(1, 'a' * 3000)
+        outbox.send_message(1, 'b' * 3000)
+        outbox.flush(5)
+        self.assertEqual(len(bot.sent), 2)
+
+    def test_per_chat_rate(self):
+        bot = StubBot()
+        outbox = sender.Outbox(bot, per_chat_rate=20, chat_burst=1, linger=0)
+        for i in range(5):
+            outbox.send_document(1, i)
+        outbox.flush(5)
+        times = [t for t, *_ in bot.sent]
+        self.assertEqual([doc for _, _, doc, _ in bot.sent], list(range(5)))
+        # 4 intervals of 1/20 s
+        self.assertGreaterEqual(times[-1] - times[0], 0.19)
+
+    def test_retry_after_429(self):
+        bot = StubBot(n_rate_limited=2, retry_after=0.05)
+        outbox = sender.Outbox(bot)
+        start = time.monotonic()
+        outbox.send_message(1, 'first')
+        self.assertTrue(outbox.flush(5))
+        self.assertEqual([text for _, _, text, _ in bot.sent], ['first'])
+        self.assertGreaterEqual(bot.sent[0][0] - start, 0.1)
+
+    def test_gives_up_after_max_retries(self):
+        bot = StubBot(n_rate_limited=10, retry_after=0.01)
+        outbox = sender.Outbox(bot, max_retries=2)
+        outbox.send_message(1, 'lost')
+        outbox.flush(5)
+        self.assertEqual(bot.sent, [])
+        self.assertEqual(outbox.n_failed, 1)
+
+    def test_chats_are_sent_in_parallel(self):
+        bot = SlowBot(delay=0.2)
+        outbox = sender.Outbox(bot, linger=0, n_workers=4)
+        start = time.monotonic()
+        for chat_id in range(4):
+            outbox.send_message(chat_id, 'hi')
+        self.assertTrue(outbox.flush(5))
+        self.assertEqual(len(bot.sent), 4)
+        self.assertLess(time.monotonic() - start, 0.6)
+
+    def test_chat_order(self):
+        bot = SlowBot(delay=0.02)
+        outbox = sender.Outbox(bot, per_chat_rate=1000, chat_burst=1000, global_rate=1000,
+                               linger=0, n_workers=4)
+        for i in range(10):
+            outbox.send_document(1, i)
+        self.assertTrue(outbox.flush(5))
+        self.assertEqual([document for _, _, document, _ in bot.sent], list(range(10)))
+
+    def test_retry_network_errors(self):
+        bot = SlowBot(delay=0, n_errors=2)
+        outbox = sender.Outbox(bot, retry_delay=0.01)
+        outbox.send_message(1, 'first')
+        outbox.send_message(1, 'second', parse_mode='markdown')
+        self.assertTrue(outbox.flush(5))
+        self.assertEqual([text for _, _, text, _ in bot.sent], ['first', 'second'])
+        self.assertEqual(outbox.n_failed, 0)
+
+    def test_permanent_errors_are_not_retried(self):
+        bot = StubBot()
+        calls = []
+
+        def send_message(chat_id, text, parse_mode=None):
+            calls.append(text)
+            raise Forbidden()
+        bot.send_message = send_message
+        outbox = sender.Outbox(bot)
+        with self.assertLogs(sender.logger, 'ERROR'):
+            outbox.send_message(1, 'blocked')
+            self.assertTrue(outbox.flush(5))
+        self.assertEqual(calls, ['blocked'])
+        self.assertEqual(outbox.n_failed, 1)
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_delay(self):
+        bucket = sender.TokenBucket(rate=2, capacity=2)
+        now = bucket.updated
+        bucket.take(now)
+        bucket.take(now)
+        self.assertAlmostEqual(bucket.delay(now), 0.5)
+        self.assertEqual(bucket.delay(now + 0.5), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
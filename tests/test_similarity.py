@@ -0,0 +1,114 @@
+import io
+import os
+import random
+import zipfile
+import tempfile
+import unittest
+
+from peer_review_bot import filecache, similarity
+from peer_review_bot.dbutils import TasksDB
+from peer_review_bot.data_structures import Document
+from test_dbutils import DBTestCase, register
+
+
+def zip_bytes(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, text in files.items():
+            archive.writestr(name, text)
+    return buffer.getvalue()
+
+
+def solution(seed, n_lines=200):
+    rng = random.Random(seed)
+    return '\n'.join(f'x{i} = {rng.randint(0, 10 ** 6)} * y{rng.randint(0, 100)}' for i in range(n_lines))
+
+
+class TestSignatures(unittest.TestCase):
+    def test_similarity_estimate(self):
+        text = solution(0)
+        edited = text.replace('x10 =', 'renamed =')
+        signature = similarity.minhash(similarity.shingles(text))
+        self.assertEqual(similarity.estimate_similarity(signature, signature), 1.)
+        self.assertGreater(similarity.estimate_similarity(
+            signature, similarity.minhash(similarity.shingles(edited))), 0.9)
+        self.assertLess(similarity.estimate_similarity(
+            signature, similarity.minhash(similarity.shingles(solution(1)))), 0.1)
+
+    def test_zip_is_unpacked(self):
+        data = zip_bytes({'b.py': 'second part', 'a.py': 'first part'})
+        self.assertEqual(similarity.extract_text(data), 'first part\nsecond part')
+
+    def test_lsh_candidates(self):
+        signatures = {'a': [1, 2, 3, 4], 'b': [1, 2, 5, 6], 'c': [7, 8, 9, 10]}
+        self.assertEqual(similarity.lsh_candidates(signatures, n_bands=2), {('a', 'b')})
+
+
+class TestDetection(DBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = filecache.FileCache(self.tmpdir.name)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def test_detect_task(self):
+        users = register(6)
+        original = solution(0)
+        files = [zip_bytes({'main.py': original}),
+                 zip_bytes({'main.py': original}),  # resubmitted as is
+                 zip_bytes({'solution.py': original.replace('x5 =', 'z5 =')}),  # renamed and edited
+                 zip_bytes({'main.py': solution(1)}),
+                 solution(2).encode()]
+        for user, data in zip(users, files):
+            file_id = f'file{user.tg_id}'
+            TasksDB.add_task(user, 1, 1, Document(file_id, 'solution.zip', len(data), 'application/zip'))
+            self.cache.put(file_id, [data])
+        TasksDB.add_task(users[5], 1, 1, Document('not_cached', 'solution.zip', 1, 'application/zip'))
+        corrupt = zip_bytes({'main.py': solution(3)}).replace(b'x1 =', b'x1 !', 1)  # CRC does not match
+        TasksDB.add_task(users[5], 1, 1, Document('corrupt', 'solution.zip', len(corrupt), 'application/zip'),
+                         force=True)
+        self.cache.put('corrupt', [corrupt])
+
+        report = similarity.ingest_task(self.cache, 1, 1)
+        self.assertEqual((report['indexed'], report['not_cached']), (5, ['not_cached']))
+        self.assertEqual(list(report['unreadable']), ['corrupt'])
+        self.assertEqual(similarity.ingest_task(self.cache, 1, 1)['already_indexed'], 5)
+
+        ids = [TasksDB.get_user_info(user)['_id'] for user in users]
+        pairs = similarity.detect_task(1, 1)
+        self.assertEqual({frozenset(pair[:2]) for pair in pairs},
+                         {frozenset(ids[:2]), frozenset(ids[::2][:2]), frozenset([ids[1], ids[2]])})
+
+        task = TasksDB._db.task.find_one({'user_id': ids[0]})
+        self.assertEqual(task['similarity']['duplicates'], [ids[1]])
+        self.assertEqual([s['user_id'] for s in task['similarity']['similar']], [ids[2]])
+        task = TasksDB._db.task.find_one({'user_id': ids[3]})
+        self.assertEqual(task['similarity']['duplicates'] + task['similarity']['similar'], [])
+
+    def test_evicted_file_is_skipped(self):
+        users = register(2)
+        for user in users:
+            file_id = f'file{user.tg_id}'
+            data = zip_bytes({'main.py': solution(user.tg_id)})
+            TasksDB.add_task(user, 1, 1, Document(file_id, 'solution.zip', len(data), 'application/zip'))
+            self.cache.put(file_id, [data])
+
+        class EvictingCache:
+            """Removes the file of the first submission right after the lookup, as a concurrent eviction would"""
+            def get(_, file_id):
+                cached = self.cache.get(file_id)
+                if file_id == f'file{users[0].tg_id}':
+                    os.remove(cached[0])
+                return cached
+
+        report = similarity.ingest_task(EvictingCache(), 1, 1)
+        self.assertEqual(report['indexed'], 1)
+        self.assertEqual(list(report['unreadable']), [f'file{users[0].tg_id}'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import json
+import time
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from peer_review_bot import transport, metrics
+
+
+class StubAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    n_connections = 0
+
+    def setup(self):
+        super().setup()
+        type(self).n_connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.do_GET()
+
+    def do_GET(self):
+        if self.path.endswith('/failing'):
+            return self._respond(503, {'ok': False, 'error_code': 503, 'description': 'Unavailable'})
+        if self.path.endswith('/slow'):
+            time.sleep(0.5)
+        self._respond(200, {'ok': True, 'result': True})
+
+    def _respond(self, code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestPooledSender(unittest.TestCase):
+    def setUp(self):
+        self.handler = type('Handler', (StubAPIHandler,), {'n_connections': 0})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/bot1:test/'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_are_reused(self):
+        n_observed = metrics.api_latency.count('sendMessage')
+        sender = transport.PooledSender(pool_size=4)
+        for i in range(20):
+            resp = sender('post', self.url + 'sendMessage', params={'chat_id': 1, 'text': str(i)})
+            self.assertEqual(resp.json(), {'ok': True, 'result': True})
+
+        stats = sender.stats()
+        self.assertEqual(stats['requests'], 20)
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(self.handler.n_connections, 1)
+        self.assertGreater(stats['reuse_ratio'], 0.9)
+        self.assertEqual(stats['latency']['sendMessage']['count'], 20)
+        self.assertEqual(metrics.api_latency.count('sendMessage') - n_observed, 20)
+        self.assertIn('prb_api_request_seconds_count{method="sendMessage"}', metrics.render())
+
+    def test_shared_between_threads(self):
+        sender = transport.PooledSender(pool_size=2)
+
+        def send():
+            for _ in range(10):
+                sender('post', self.url + 'sendMessage')
+
+        threads = [threading.Thread(target=send) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(self.handler.n_connections, 4)
+        self.assertEqual(sender.stats()['latency']['sendMessage']['count'], 40)
+
+    def test_retries_unavailable(self):
+        sender = transport.PooledSender(retries=2, backoff=0)
+        resp = sender('get', self.url + 'failing')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(sender.stats()['requests'], 3)
+
+    def test_post_is_not_retried(self):
+        sender = transport.PooledSender(retries=2, backoff=0)
+        resp = sender('post', self.url + 'failing')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(sender.stats()['requests'], 1)
+
+    def test_timeout_of_the_caller(self):
+        sender = transport.PooledSender(read_timeout=30.)
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            sender('post', self.url + 'slow', timeout=(5., 0.1))
+        self.assertEqual(sender('post', self.url + 'slow').status_code, 200)
+
+    def test_telebot_uses_sender(self):
+        try:
+            import telebot
+        except ImportError:
+            self.skipTest('pyTelegramBotAPI is not installed')
+        sender = transport.PooledSender()
+        old = telebot.apihelper.CUSTOM_REQUEST_SENDER, telebot.apihelper.API_URL
+        telebot.apihelper.CUSTOM_REQUEST_SENDER = sender
+        telebot.apihelper.API_URL = self.url.replace('bot1:test/', 'bot{0}/{1}')
+        try:
+            telebot.apihelper._make_request('1:test', 'sendMessage', 'post', {'chat_id': 1, 'text': 'a'})
+            telebot.apihelper._make_request('1:test', 'sendMessage', 'post', {'chat_id': 1, 'text': 'b'})
+        finally:
+            telebot.apihelper.CUSTOM_REQUEST_SENDER, telebot.apihelper.API_URL = old
+        self.assertEqual(sender.stats()['requests'], 2)
+        self.assertEqual(self.handler.n_connections, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+import unittest
+import urllib.error
+import urllib.request
+
+from peer_review_bot import webhook
+
+
+def message_update(update_id, chat_id):
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': 0, 'text': str(update_id),
+                        'chat': {'id': chat_id, 'type': 'private'}}}
+
+
+class TestWebhook(unittest.TestCase):
+    def start(self, process_update, n_workers=4, queue_size=16, secret=None):
+        self.pool = webhook.ShardedWorkerPool(process_update, n_workers, queue_size)
+        self.server = webhook.make_server(self.pool, '127.0.0.1', 0, '/hook', secret)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/hook'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.pool.shutdown()
+
+    def post(self, update, headers=None):
+        request = urllib.request.Request(self.url, json.dumps(update).encode(),
+                                         {'Content-Type': 'application/json', **(headers or {})})
+        try:
+            with urllib.request.urlopen(request) as resp:
+                return resp.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def test_per_chat_order(self):
+        handled = []
+        lock = threading.Lock()
+
+        def process_update(update):
+            time.sleep(0.001)
+            with lock:
+                handled.append((update['message']['chat']['id'], update['update_id']))
+
+        self.start(process_update)
+        updates = [message_update(i, i % 5) for i in range(50)]
+        for update in updates:
+            self.assertEqual(self.post(update), 200)
+        self.pool.join()
+
+        self.assertEqual(len(handled), len(updates))
+        for chat_id in range(5):
+            ids = [i for c, i in handled if c == chat_id]
+            self.assertEqual(ids, sorted(ids))
+
+    def test_backpressure(self):
+        release = threading.Event()
+        self.start(lambda update: release.wait(), n_workers=1, queue_size=2)
+
+        # one update is being handled, two are queued, the rest is rejected
+        statuses = [self.post(message_update(i, 1)) for i in range(5)]
+        release.set()
+        self.assertEqual(statuses.count(200), 3, statuses)
+        self.assertEqual(statuses[-1], 503)
+
+    def test_secret_and_path(self):
+        self.start(lambda update: None, secret='secret')
+        self.assertEqual(self.post(message_update(1, 1)), 403)
+        self.assertEqual(self.post(message_update(1, 1), {'X-Telegram-Bot-Api-Secret-Token': 'secret'}), 200)
+        self.url = self.url.replace('/hook', '/other')
+        self.assertEqual(self.post(message_update(1, 1)), 404)
+
+    def test_bad_body(self):
+        self.start(lambda update: None)
+        for body in ([], 1, 'update', None):
+            self.assertEqual(self.post(body), 400)
+        self.assertEqual(self.post(message_update(1, 1)), 200)
+
+    def test_metrics(self):
+        self.start(lambda update: None)
+        with urllib.request.urlopen(self.url.replace('/hook', '/metrics')) as resp:
+            self.assertEqual(resp.status, 200)
+            self.assertIn('# TYPE prb_handler_seconds histogram', resp.read().decode())
+
+
+class TestStartup(unittest.TestCase):
+    def test_webhook_url_is_required(self):
+        env = {**os.environ, 'PRB_TOKEN': '1:token', 'PRB_RUNTIME': 'webhook'}
+        env.pop('PRB_WEBHOOK_URL', None)
+        result = subprocess.run([sys.executable, '-c', 'import peer_review_bot.telegram_ui'],
+                                env=env, capture_output=True, text=True)
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn('Set PRB_WEBHOOK_URL', result.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()